@@ -4,6 +4,9 @@
 # Usage:
 # bash batch_execution.sh 220329_feature_list.txt 
 #
+# The same in one process, building every patient graph only once:
+# python generate_graphs.py akgs-batch 220329_feature_list.txt 5000 . -t 25
+#
 
 # Maybe uncomment
 # conda activate <env-name>
@@ -0,0 +1,154 @@
+"""
+Benchmarks of graph construction, found associations, aggregation and plotting on synthetic cohorts.
+
+try : python benchmarks/run_benchmarks.py --sizes 100,1000,10000 --visits 10,40 -o benchmark_results.csv
+
+Stage times come from the built-in profiler (see src/profiling.py), summed over all patients of a cohort.
+Peak memory is measured in a second pass with tracemalloc, so it does not slow down the timed pass.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO, 'src'), os.path.dirname(os.path.abspath(__file__))]
+
+import click
+import matplotlib
+import pandas as pd
+
+from aggregate import EdgeAggregator
+from associations import AssociationIndex
+from imp_features import create_akg
+from labels import LabelResolver
+from make_graph import PKG, PlotPKG
+from profiling import profiler
+from synthetic import SyntheticSource
+
+
+def _chunks(patient_ids, chunk_size):
+    for start in range(0, len(patient_ids), chunk_size):
+        yield patient_ids[start:start + chunk_size]
+
+
+def _plot(graphs, aggregator, num_patients, label_resolver, output_folder):
+    """ Patient plots of the sampled graphs and the averaged plot of the edges in at least 10% of the patients """
+    import matplotlib.pyplot as plt
+
+    for patient_id, graph in graphs:
+        pkg = PlotPKG.from_graph(graph, label_resolver=label_resolver)
+        figures = [('complete', pkg.complete_PKG()), ('without-isolates', pkg.connected_PKG()),
+                   ('only-found', pkg.real_associations_PKG())]
+        with profiler.stage('plot.save'):
+            for name, fig in figures:
+                fig.savefig(os.path.join(output_folder, f"{patient_id}_{name}.png"))
+        plt.close("all")
+
+    edges = aggregator.edge_table()
+    edges = edges[edges['count'] >= num_patients * 0.1].copy()
+    edges[['node1', 'node2']] = edges['edge'].str.split('_', n=1, expand=True).reindex(columns=[0, 1]).values
+    edges['strength'] = (edges['count'] / num_patients * 100).round(2)
+    nodes = aggregator.node_table()
+    nodes = nodes[nodes.node.isin(edges.node1) | nodes.node.isin(edges.node2)]
+    with profiler.stage('plot.averaged'):
+        fig = create_akg(nodes, edges, db_helper=None, labels=True, label_resolver=label_resolver)
+    with profiler.stage('plot.save'):
+        fig.savefig(os.path.join(output_folder, "averaged_plot.png"))
+    plt.close("all")
+
+
+def _run(source, association_index, chunk_size, plot_sample):
+    """ Build, aggregate and plot the graphs of the whole cohort, returns graph counts and build seconds """
+    aggregator = EdgeAggregator()
+    plotted = []
+    nodes = edges = found = 0
+    build_seconds = 0.0
+
+    for chunk in _chunks(source.get_patient_ids(source.num_patients), chunk_size):
+        with profiler.stage('generate'):
+            drugs, diags = source.get_patients_bulk(chunk)
+        start = time.perf_counter()
+
+        for patient_id in chunk:
+            lit_drugs, mdas, lit_diagnosis, ddas = association_index.patient_associations(drugs[patient_id], diags[patient_id])
+            pkg = PKG(patient_drugs=drugs[patient_id], patient_diagnosis=diags[patient_id],
+                lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, real_associations=True, compact=True)
+
+            with profiler.stage('aggregate'):
+                aggregator.add(pkg.graph.iter_edges(), pkg.graph.node_colors())
+
+            nodes += len(pkg.graph.nodes)
+            edges += len(pkg.graph.edges)
+            found += len(pkg.found_edges)
+            if len(plotted) < plot_sample:
+                plotted.append((patient_id, pkg.graph))
+        build_seconds += time.perf_counter() - start
+
+    if plot_sample > 0:
+        with tempfile.TemporaryDirectory() as output_folder:
+            _plot(plotted, aggregator, source.num_patients, LabelResolver(source), output_folder)
+
+    return {'mean_nodes': nodes / source.num_patients, 'mean_edges': edges / source.num_patients,
+            'mean_found_edges': found / source.num_patients, 'aggregated_edges': len(aggregator.edge_ids),
+            'build_seconds': round(build_seconds, 4)}
+
+
+@click.command()
+@click.option("--table-dir", type=click.Path(exists=True), default=os.path.join(REPO, '..', 'table_files'),
+    help="Folder with medi_associations.csv and disgenet_uml_mappings.csv")
+@click.option("--sizes", type=str, default="100,1000,10000", help="Cohort sizes, comma separated (up to 50000)")
+@click.option("--visits", type=str, default="10,40", help="Mean visits per patient (history lengths), comma separated")
+@click.option("-s", "--seed", type=int, default=0, help="Seed of the synthetic cohorts")
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients generated at once")
+@click.option("--plot-sample", type=int, default=3, help="Number of patients plotted per cohort, 0 to skip plots")
+@click.option("--memory/--no-memory", default=True, help="Measure peak memory in a second, traced pass")
+@click.option("-o", "--output", type=str, default="benchmark_results.csv", help="CSV file for the results")
+def benchmark(table_dir, sizes, visits, seed, chunk_size, plot_sample, memory, output):
+    """ Time graph construction, found associations, aggregation and plotting over cohort sizes and history lengths. """
+    matplotlib.use("Agg")
+    profiler.enabled = True
+    results = []
+
+    for num_visits in [int(value) for value in visits.split(',')]:
+        for size in [int(value) for value in sizes.split(',')]:
+            source = SyntheticSource(table_dir, size, visits=num_visits, seed=seed)
+            association_index = AssociationIndex(source.get_medi(), source.get_icd_associations())
+
+            profiler.reset()
+            start = time.perf_counter()
+            stats = _run(source, association_index, chunk_size, plot_sample)
+            total = time.perf_counter() - start
+            timings = profiler.snapshot()
+
+            peak = None
+            if memory:
+                profiler.enabled = False
+                tracemalloc.start()
+                _run(source, association_index, chunk_size, plot_sample=0)
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+                profiler.enabled = True
+
+            run = {'patients': size, 'visits': num_visits}
+            for stage, seconds in timings['seconds'].items():
+                calls = timings['calls'][stage]
+                results.append({**run, 'stage': stage, 'calls': calls, 'seconds': round(seconds, 4),
+                    'ms_per_call': round(1000 * seconds / calls, 4),
+                    'patients_per_second': round(size / seconds, 1) if seconds else None})
+            # throughput of building and aggregating, without data generation and plots
+            build = stats['build_seconds']
+            results.append({**run, 'stage': 'total', 'seconds': round(total, 4),
+                'patients_per_second': round(size / build, 1), 'peak_memory_mb': round(peak, 1) if peak else None, **stats})
+            memory_note = f", peak {peak:.1f} MB" if peak else ""
+            print(f"{size} patients, {num_visits} visits : {size / build:.1f} patients/s{memory_note}")
+
+    results = pd.DataFrame(results)
+    results.to_csv(output, index=False, header=True)
+    print(results.pivot_table(index=['visits', 'patients'], columns='stage', values='seconds').round(3).to_string())
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,149 @@
+"""Synthetic EHR cohort for benchmarks, with codes from the shipped table files"""
+
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from data_source import DataSource, _group_by_patient, _sample
+
+
+START_DATE = np.datetime64('2015-01-01')
+
+
+class SyntheticSource(DataSource):
+    """
+    Data source of synthetic patients, a drop-in for DbHelper in benchmarks.
+
+    Drugs come from medi_associations.csv and diagnoses from medi and disgenet_uml_mappings.csv,
+    plus a share of codes without literature. Common codes (many medi rows) are drawn more often.
+    Every patient has about `visits` visits spread over `years` years, and a small set of chronic codes
+    that come back over several visits. The icd associations are the icd pairs mapped to the same disgenet concept, plus random pairs.
+
+    A patient's history only depends on the seed and the patient id, so runs are reproducible.
+    """
+
+    def __init__(self, table_dir: str, num_patients: int, visits: int = 20, years: int = 6, seed: int = 0,
+                 num_icd_associations: int = 20000, non_literature_share: float = 0.2) -> None:
+        self.num_patients = num_patients
+        self.visits = visits
+        self.years = years
+        self.seed = seed
+        self.non_literature_share = non_literature_share
+        rng = np.random.default_rng(seed)
+
+        self.medi = pd.read_csv(os.path.join(table_dir, 'medi_associations.csv'), header=None,
+            names=['rxcui', 'icd_code'], dtype=str).dropna().reset_index(drop=True)
+        mappings = pd.read_csv(os.path.join(table_dir, 'disgenet_uml_mappings.csv'), header=None,
+            names=['disease_id', 'vocabulary', 'icd_code'], dtype=str).dropna()
+
+        # drug and diagnosis codes, weighted by their number of medi rows
+        drug_counts = self.medi.rxcui.value_counts()
+        self._drugs = drug_counts.index.values
+        self._drug_cdf = np.cumsum(drug_counts.values) / drug_counts.values.sum()
+        diag_counts = pd.concat([self.medi.icd_code, mappings.icd_code]).value_counts()
+        self._diags = diag_counts.index.values
+        self._diag_cdf = np.cumsum(diag_counts.values) / diag_counts.values.sum()
+        self._other_diags = np.array([f"Z{i:02d}.{j}" for i in range(100) for j in range(10)])
+
+        # disease pairs: same disgenet concept, then random literature pairs
+        same_concept = mappings.merge(mappings, on='disease_id')
+        same_concept = same_concept[same_concept.icd_code_x != same_concept.icd_code_y]
+        pairs = same_concept[['icd_code_x', 'icd_code_y']].drop_duplicates().values[:num_icd_associations]
+        random_pairs = self._draw(rng, self._diags, self._diag_cdf, (max(num_icd_associations - len(pairs), 0), 2))
+        self.icd_associations = pd.DataFrame(np.concatenate([pairs, random_pairs]), columns=['disease1', 'disease2'])
+
+        self._labels = {}
+        for name, columns in [('medi_drug_labels.csv', [0, 1]), ('medi_disease_labels.csv', [1, 2])]:
+            labels = pd.read_csv(os.path.join(table_dir, name), header=None, dtype=str).dropna()
+            self._labels.update(zip(labels[columns[0]], labels[columns[1]]))
+
+        self.patient_ids = list(range(1, num_patients + 1))
+
+    @staticmethod
+    def _draw(rng, codes, cdf, size):
+        """ Codes drawn by weight, cdf is the cumulative weight of the codes """
+        return codes[np.minimum(np.searchsorted(cdf, rng.random(size)), len(codes) - 1)]
+
+    def _history(self, patient_id: int):
+        """ (codes, dates) of the drugs and of the diagnoses of one patient """
+        rng = np.random.default_rng([self.seed, patient_id])
+        num_visits = rng.poisson(self.visits) + 1
+        visit_dates = START_DATE + np.sort(rng.integers(0, self.years * 365, num_visits))
+
+        # chronic codes come back at several visits, the others are drawn per visit
+        chronic_drugs = self._draw(rng, self._drugs, self._drug_cdf, rng.poisson(4) + 1)
+        chronic_diags = self._draw(rng, self._diags, self._diag_cdf, rng.poisson(6) + 1)
+
+        drug_dates = np.repeat(visit_dates, rng.poisson(1.5, num_visits))
+        drug_codes = np.where(
+            rng.random(len(drug_dates)) < 0.6,
+            rng.choice(chronic_drugs, len(drug_dates)),
+            self._draw(rng, self._drugs, self._drug_cdf, len(drug_dates)),
+        )
+
+        diag_dates = np.repeat(visit_dates, rng.poisson(2, num_visits))
+        kind = rng.random(len(diag_dates))
+        diag_codes = np.where(
+            kind < self.non_literature_share,
+            rng.choice(self._other_diags, len(diag_dates)),
+            np.where(
+                kind < self.non_literature_share + 0.5 * (1 - self.non_literature_share),
+                rng.choice(chronic_diags, len(diag_dates)),
+                self._draw(rng, self._diags, self._diag_cdf, len(diag_dates)),
+            ),
+        )
+        return (drug_codes, drug_dates), (diag_codes, diag_dates)
+
+    def _tables(self, patient_ids: list):
+        """ Drug and diagnosis tables of the patients, in the column layout of DbHelper """
+        histories = [self._history(patient_id) for patient_id in patient_ids]
+        tables = []
+        for i, (code_column, date_column) in enumerate([('rx_cui', 'prescription_date'), ('icd_code', 'diagnosis_date')]):
+            lengths = [len(history[i][0]) for history in histories]
+            codes = [history[i][0] for history in histories]
+            dates = [history[i][1] for history in histories]
+            table = pd.DataFrame({
+                'explorys_patient_id': np.repeat(np.asarray(patient_ids, dtype=np.int64), lengths),
+                code_column: np.concatenate(codes) if codes else np.array([], dtype=object),
+                date_column: (np.concatenate(dates) if dates else np.array([], dtype='datetime64[D]')).astype('datetime64[ns]'),
+            })
+            table['new_date'] = table[date_column]
+            tables.append(table)
+
+        drugs, diags = tables
+        drugs.insert(3, 'ingredient_descriptions', '')
+        diags.insert(2, 'icd_version', 10)
+        return drugs, diags
+
+    def get_patient_ids(self, limit: int) -> list:
+        return self.patient_ids[:limit]
+
+    def sample_patient_ids(self, count: int, seed: int = None) -> list:
+        return _sample(self.patient_ids, count, seed)
+
+    def get_drugs_bulk(self, patient_ids: list) -> dict:
+        return _group_by_patient(self._tables(patient_ids)[0], patient_ids)
+
+    def get_diags_bulk(self, patient_ids: list) -> dict:
+        return _group_by_patient(self._tables(patient_ids)[1], patient_ids)
+
+    def get_patients_bulk(self, patient_ids: list):
+        """ Drugs and diagnoses of a chunk of patients, generated once for both tables """
+        drugs, diags = self._tables(patient_ids)
+        return _group_by_patient(drugs, patient_ids), _group_by_patient(diags, patient_ids)
+
+    def get_medi(self) -> pd.DataFrame:
+        return self.medi.copy()
+
+    def get_icd_associations(self) -> pd.DataFrame:
+        return self.icd_associations.copy()
+
+    def get_feature_patients(self, phewas_code: str) -> list:
+        # a reproducible fifth of the cohort per phecode
+        rng = np.random.default_rng([self.seed, zlib.crc32(phewas_code.encode())])
+        return sorted(rng.choice(self.patient_ids, size=max(len(self.patient_ids) // 5, 1), replace=False).tolist())
+
+    def get_labels_bulk(self, nodes: list) -> dict:
+        return {node: self._labels.get(str(node), node) for node in nodes}
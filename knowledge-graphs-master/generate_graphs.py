@@ -6,6 +6,7 @@ from copy import deepcopy
 from email import header
 from email.policy import default
 import os
+import sys
 from pathlib import Path
 from typing import List
 
@@ -17,99 +18,350 @@ import matplotlib.pyplot as plt
 from ast import literal_eval
 import pandas as pd
 import random
+import cProfile
+import time
+from collections import Counter, deque
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
 
-from src.db_functions import DbHelper
-from src.make_graph import PKG, PlotPKG
-from src.imp_features import unique_feature_patients, create_akg
+# the src modules import each other by bare name, one module instance each for the script and them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
 
+from aggregate import EdgeAggregator
+from associations import AssociationIndex
+from cohort_matrix import CohortMatrix, edge_statistics
+from data_source import open_source
+from db_functions import DbHelper, reserve_connections
+from features import FeatureMatrix, graph_features
+from file_source import FileSource
+from graph_store import GraphStore
+from render import PlotRenderer
+from make_graph import FOUND, PKG, TemporalPKG
+from imp_features import unique_feature_patients, create_akg
+from incremental import last_visit, update_graph, window_start
+from labels import LabelResolver
+from layout import LayoutCache
+from prefetch import prefetch, thread_source
+from results_index import ResultsIndex
+from table_source import TableSource
+from temporal_store import TemporalStore
+from profiling import profiler
 
 
+def _chunks(patient_ids, chunk_size):
+    """ Split the patient list into chunks, one bulk DB fetch per chunk. """
+    for start in range(0, len(patient_ids), chunk_size):
+        yield patient_ids[start:start + chunk_size]
+
+
+def _fetch_chunk(db_helper, chunk):
+    """ Fetch drugs and diagnoses of all patients in the chunk, in patient order. """
+    with profiler.stage('fetch'):
+        drugs = db_helper.get_drugs_bulk(chunk)
+        diags = db_helper.get_diags_bulk(chunk)
+    profiler.count('patients', len(chunk))
+    return [(patient_id, drugs[patient_id], diags[patient_id]) for patient_id in chunk]
+
+
+def _prefetch_chunk(chunk, source='db'):
+    """ Fetch a chunk in a prefetch thread, with the thread's own data source. """
+    return _fetch_chunk(thread_source(source), chunk)
+
+
+# per process state, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(association_index, profile=False):
+    """ Set up the process, the patient data comes fetched from the main process. """
+    _worker['association_index'] = association_index
+    profiler.enabled = profile
+
+
+def _run_chunk(func, rows):
+    """ func in a worker process, with the stage times of the chunk for the main process profiler """
+    return func(rows), profiler.snapshot(reset=True) if profiler.enabled else None
+
+
+def _fetched_chunks(chunks, db_helper, source='db', prefetch_depth=2):
+    """
+    Fetched chunks in chunk order.
+
+    The next prefetch_depth chunks are fetched in threads while the current ones are processed,
+    with prefetch_depth 0 every chunk is fetched by db_helper when it is its turn.
+    """
+    if prefetch_depth > 0:
+        if source == 'db':
+            # a connection per fetch thread, next to those of the main thread and the label lookups
+            reserve_connections(prefetch_depth + 2)
+        return prefetch(partial(_prefetch_chunk, source=source), chunks, depth=prefetch_depth)
+    return (_fetch_chunk(db_helper, chunk) for chunk in chunks)
+
+
+def _map_chunks(func, chunks, workers, association_index, db_helper, source='db', prefetch_depth=2):
+    """ Run func over the fetched chunks, in a process pool if workers > 1. Results come back in chunk order. """
+    fetched = _fetched_chunks(chunks, db_helper, source, prefetch_depth)
+
+    if workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(association_index, profiler.enabled)) as pool:
+            # one chunk per worker in flight, fetching does not run further ahead than prefetch_depth
+            pending = deque()
+            for rows in fetched:
+                pending.append(pool.apply_async(_run_chunk, (func, rows)))
+                if len(pending) >= workers:
+                    result, profile = pending.popleft().get()
+                    profiler.merge(profile)
+                    yield result
+            while pending:
+                result, profile = pending.popleft().get()
+                profiler.merge(profile)
+                yield result
+    else:
+        _init_worker(association_index, profiler.enabled)
+        yield from map(func, fetched)
+
+
+def _pkgs_chunk(fetched, output_folder, pickles):
+    """ Create the PKGs of a fetched chunk of patients, returns their stats rows, graphs and last visit dates. """
+    rows = []
+    for patient_id, drugs, diags in fetched:
+
+        # Commom drugs and icd codes between patient data and literature (medi and disgenet),
+        # and the drug_diagnosis and diagnosis_diagnosis realtions between them
+        lit_drugs, mdas, lit_diagnosis, ddas = _worker['association_index'].patient_associations(drugs, diags)
+
+        # create KGs
+        current_pkg = PKG(patient_drugs=drugs, patient_diagnosis=diags,
+            lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, real_associations=True, compact=True)
+
+        rows.append((patient_id, len(current_pkg.graph.nodes), len(current_pkg.graph.edges), len(current_pkg.found_edges),
+            current_pkg.graph, last_visit(drugs, diags)))
+
+        # store pickle file
+        if pickles:
+            with profiler.stage('pickle'):
+                nx.write_gpickle(current_pkg.graph.to_networkx(), os.path.join(output_folder, f"{patient_id}_graph.pkl"),)
+
+    return rows
+
+
+def _features_chunk(fetched):
+    """ Create the PKGs of a fetched chunk of patients, returns their graph features. """
+    rows = []
+    for patient_id, drugs, diags in fetched:
+        lit_drugs, mdas, lit_diagnosis, ddas = _worker['association_index'].patient_associations(drugs, diags)
+
+        current_pkg = PKG(patient_drugs=drugs, patient_diagnosis=diags,
+            lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, real_associations=True, compact=True)
+
+        with profiler.stage('features'):
+            rows.append((patient_id, graph_features(current_pkg.graph)))
+
+    return rows
+
+
+def _temporal_chunk(fetched, window):
+    """ Create the visit by visit PKGs of a fetched chunk of patients, returns them as TemporalPKG. """
+    sequences = []
+    for patient_id, drugs, diags in fetched:
+        lit_drugs, mdas, lit_diagnosis, ddas = _worker['association_index'].patient_associations(drugs, diags)
+
+        sequence = TemporalPKG(patient_drugs=drugs, patient_diagnosis=diags,
+            lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, window=window)
+        sequences.append((patient_id, sequence))
+
+    return sequences
+
+
+def _akgs_chunk(fetched):
+    """ Create the PKGs of a fetched chunk of patients, returns them as CompactGraph. """
+    graphs = []
+    for patient_id, drugs, diags in fetched:
+
+        lit_drugs, mdas, lit_diagnosis, ddas = _worker['association_index'].patient_associations(drugs, diags)
+
+        # create KGs
+        current_pkg = PKG(patient_drugs=drugs, patient_diagnosis=diags,
+            lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, real_associations=False, compact=True)
+
+        graphs.append((patient_id, current_pkg.graph))
+
+    return graphs
+
+
+def _cohort_matrix(patient_ids, association_index, db_helper, chunk_size, source='db', prefetch_depth=2):
+    """ CohortMatrix of the distinct patients, fetched in chunks. """
+    matrix = CohortMatrix(association_index)
+    patient_ids = list(dict.fromkeys(patient_ids))
+    with tqdm(desc="Fetch patients", total=len(patient_ids)) as progress:
+        for fetched in _fetched_chunks(list(_chunks(patient_ids, chunk_size)), db_helper, source, prefetch_depth):
+            with profiler.stage('matrix.add'):
+                matrix.add_chunk(fetched)
+            progress.update(len(fetched))
+    return matrix
+
+
+def _background_samples(db_helper, cohorts: dict, num_background: int, seed=None) -> dict:
+    """
+    Background patients of every cohort, sampled without replacement from the patients outside the cohort.
+
+    :param cohorts: dict of name to all patient ids of the cohort (e.g. of a phecode)
+    :return: dict of name to background patient ids
+    """
+    # one random sample of the whole population, large enough that every cohort leaves num_background of it
+    excluded = max((len(set(patient_ids)) for patient_ids in cohorts.values()), default=0)
+    candidates = list(dict.fromkeys(db_helper.sample_patient_ids(num_background + excluded, seed)))
+
+    samples = {}
+    for name, patient_ids in cohorts.items():
+        patient_ids = set(patient_ids)
+        samples[name] = [patient_id for patient_id in candidates if patient_id not in patient_ids][:num_background]
+    return samples
+
+
+def _write_edge_statistics(aggregator, num_patients, background, output_folder, name):
+    """ Store lift, odds ratio and p-value of every counted edge against the background EdgeAggregator. """
+    stats = edge_statistics(aggregator.edge_table(), num_patients, background.edge_table(), background.processed)
+    stats.to_csv(os.path.join(output_folder, f'{name}_edge_stats.csv'), index=False, header=True)
+
+
+def _write_averaged_graph(aggregator, num_patients, threshold, output_folder, phecode, label_resolver, fast_layout=False, name=None):
+    """ Filter the counted edges by threshold, store the averaged edge and node list and plot (files named after name, default the phecode). """
+    name = phecode if name is None else name
+
+    # averaged edges
+    edges_df = aggregator.edge_table()
+    nodes_df = aggregator.node_table()
+
+    # filter edges based on threshold
+    cutoff = num_patients * ( threshold / 100 )
+    averaged_edges = edges_df[edges_df['count'] >= cutoff].copy()
+
+    # process nodelist and edgelist
+    # seperate edge str and add strength of edges and create nodelist
+    ## reindex keeps both columns when no edge passes the threshold
+    averaged_edges[['node1', 'node2']] = averaged_edges['edge'].str.split('_', n=1, expand=True).reindex(columns=[0, 1])
+    averaged_edges.drop(columns='edge', inplace=True)
+    averaged_edges = averaged_edges[['node1', 'node2', 'count', 'color']]
+
+    strength = averaged_edges['count'].apply(lambda x : round((x/num_patients) * 100, 2))
+    averaged_edges.insert(averaged_edges.shape[1], column='strength', value=strength)
+
+    averaged_nodes = nodes_df[(nodes_df['node'].isin(averaged_edges.node1.unique())) |
+        (nodes_df['node'].isin(averaged_edges.node2.unique()))]
+    
+    # Create averaged plot and store
+    # unchanged graphs reuse their layout, changed ones start from the cached node positions
+    layout_cache = LayoutCache(os.path.join(output_folder, f"{phecode}_layout.pkl"))
+    akg_plot = create_akg(node_list=averaged_nodes, edge_list=averaged_edges, db_helper=None,
+        label_resolver=label_resolver, layout_cache=layout_cache, fast_layout=fast_layout)
+
+    with profiler.stage('plot.save'):
+        akg_plot.savefig(os.path.join(output_folder, f"{name}_averaged_plot.png"))
+
+    plt.close("all")
+
+    # store averaged edge and node list
+    averaged_edges.to_csv(os.path.join(output_folder, f'{name}_edgelist.csv'), index=False, header=True)
+    averaged_nodes.to_csv(os.path.join(output_folder, f'{name}_nodelist.csv'), index=False, header=True)
+
+    return edges_df
+
 
 @click.group()
 def cli():
   pass
 
 
+def _start_profile(profile, cprofile_file):
+    """ Enable the stage profiler with --profile, and cProfile of the main process with --cprofile. """
+    profiler.enabled = profile
+    profiler.reset()
+    cprof = None
+    if cprofile_file is not None:
+        cprof = cProfile.Profile()
+        cprof.enable()
+    return cprof, time.perf_counter()
+
+
+def _finish_profile(started, cprofile_file, report_path, **run):
+    """ Write the stage report to <report_path>.json/.csv and the cProfile stats to cprofile_file. """
+    cprof, start = started
+    if cprof is not None:
+        cprof.disable()
+        cprof.dump_stats(cprofile_file)
+    if profiler.enabled:
+        profiler.write(report_path, total_seconds=round(time.perf_counter() - start, 6), **run)
+        print(f"Profile written to {report_path}.json and {report_path}.csv")
+
+
 @cli.command('pkgs')
 @click.argument("num_patients", type=int)
 @click.argument("output_folder", type=str)
 @click.argument("output_file", type=str)   # store stats table to file
 @click.option('-p', '--plots', is_flag=True)
-def personalised_kgs(num_patients, output_folder, output_file, plots):
+@click.option("--plot-workers", type=int, default=2, help="Number of processes rendering the plots")
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("-w", "--workers", type=int, default=1, help="Number of worker processes")
+@click.option("--prefetch", "prefetch_depth", type=int, default=2, help="Number of chunks fetched ahead while graphs are built")
+@click.option("--label-cache", type=str, default=None, help="CSV file to cache node labels across runs")
+@click.option("--label-tables", type=click.Path(exists=True), default=None, help="Folder of the label table dumps, labels are read from it first")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+@click.option("--pickles", is_flag=True, help="Store one gpickle file per patient instead of the graph store")
+@click.option("--window", "windows", type=int, multiple=True, default=[30, 90, 180, 365],
+    help="Days of a found_edges_<days> stats column, can be given several times")
+@click.option("--profile", is_flag=True, help="Time the stages of the run and write a profile report")
+@click.option("--cprofile", "cprofile_file", type=str, default=None, help="Also dump cProfile stats of the main process to this file")
+def personalised_kgs(num_patients, output_folder, output_file, plots, plot_workers, chunk_size, workers, prefetch_depth, label_cache, label_tables, source, pickles,
+                     windows, profile, cprofile_file):
     """
     Main program to generate patients
 
     Run with python - for instance - generate-patients.py 100 reports.
     """
+    started = _start_profile(profile, cprofile_file)
     Path(output_folder).mkdir(exist_ok=True, parents=True)
 
-    db_helper = DbHelper()
+    db_helper = open_source(source)
 
-    medi_associations = db_helper.get_medi()
-    icd_associations = db_helper.get_icd_associations()
-    unique_icds = icd_associations['disease1'].append(icd_associations['disease2']).unique()
+    association_index = AssociationIndex(db_helper.get_medi(), db_helper.get_icd_associations())
 
     # list of patients
-    patient_ids = db_helper.get_data(
-        f"SELECT * FROM ml_covid_joined_id LIMIT {num_patients}"
-    ).explorys_patient_id.values
+    patient_ids = db_helper.get_patient_ids(num_patients)
 
     # store stats
     ids: List[int] = [] 
     number_of_nodes: List[int] = []
     number_of_edges: List[int] = []
     number_of_found_edges: List[int] = []
-
-    for i, patient_id in tqdm(
-        enumerate(patient_ids),
-        desc="Generate graphs",
-        total=num_patients,
-    ):
-
-        drugs = db_helper.get_drugs(patient_id)
-        diags = db_helper.get_diags(patient_id)
-
-        # Commom drugs between patient data and medi data
-        lit_drugs = drugs[(drugs['rx_cui'].isin(medi_associations.rxcui.unique()))]
-        
-        # Commom icd codes between patient data and literature (medi and disgenet)
-        lit_diagnosis = diags[(diags['icd_code'].isin(medi_associations.icd_code.unique())) | 
-            (diags['icd_code'].isin(unique_icds))]
-
-        # drug_diagnosis realtions between common drugs and diagnosis
-        mdas = medi_associations[(medi_associations['rxcui'].isin(lit_drugs.rx_cui.unique())) & 
-            (medi_associations['icd_code'].isin(lit_diagnosis.icd_code.unique()))]
-        
-        # diagnosis_diagnosis realtions between common icds
-        ddas = icd_associations[(icd_associations['disease1'].isin(lit_diagnosis.icd_code.unique())) & 
-            (icd_associations['disease2'].isin(lit_diagnosis.icd_code.unique()))]
-
-        ids.append(patient_id)    ## store patient ids
-
-        # create KGs
-        current_pkg = PlotPKG(patient_drugs=drugs, patient_diagnosis=diags,
-            lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, real_associations=True)
-        
-        number_of_nodes.append(len(current_pkg.graph.nodes))    ## add total nodes
-        number_of_edges.append(len(current_pkg.graph.edges))    ## add total edges
-        number_of_found_edges.append(len(current_pkg.found_edges))    ## add total found edges
-
-        # store pickle file
-        nx.write_gpickle(current_pkg.graph, os.path.join(output_folder, f"{patient_id}_graph.pkl"),)
-
-        # plots
-        if plots:
-
-            pkg_complete = current_pkg.complete_PKG()
-            pkg_connected = current_pkg.connected_PKG()
-            pkg_real_associations = current_pkg.real_associations_PKG()
-
-            # store plots
-            pkg_complete.savefig(os.path.join(output_folder, f"{patient_id}_complete.png"))
-            pkg_connected.savefig(os.path.join(output_folder, f"{patient_id}_without-isolates.png"))
-            pkg_real_associations.savefig(os.path.join(output_folder, f"{patient_id}_only-found.png"))
-            
-            plt.close("all")
+    found_edges_per_window: List[List[int]] = []    ## found edges of every window, from the edge lags
+
+    chunks = list(_chunks(patient_ids, chunk_size))
+    pkgs_chunk = partial(_pkgs_chunk, output_folder=output_folder, pickles=pickles)
+
+    # all patient graphs in one store, see GraphStore
+    graph_store = None if pickles else GraphStore(os.path.join(output_folder, "graph_store"))
+
+    # plots are rendered by their own processes, generation does not wait for them
+    renderer = PlotRenderer(plot_workers, source=source, label_cache=label_cache, label_tables=label_tables) if plots else nullcontext()
+
+    with renderer, tqdm(desc="Generate graphs", total=num_patients) as progress:
+        for rows in _map_chunks(pkgs_chunk, chunks, workers, association_index, db_helper, source, prefetch_depth):
+            for patient_id, nodes, edges, found_edges, graph, watermark in rows:
+                ids.append(patient_id)    ## store patient ids
+                number_of_nodes.append(nodes)    ## add total nodes
+                number_of_edges.append(edges)    ## add total edges
+                number_of_found_edges.append(found_edges)    ## add total found edges
+                found_edges_per_window.append(graph.found_counts(windows))
+                if graph_store is not None:
+                    graph_store.append(patient_id, graph, watermark)
+                if plots:
+                    renderer.submit(patient_id, graph, output_folder)
+            if graph_store is not None:
+                with profiler.stage('store'):
+                    graph_store.flush()
+            progress.update(len(rows))
     
     # statistics table
     stats_table = pd.DataFrame(columns=['patient_ids', 'nodes', 'edges', 'found_edges'])
@@ -118,6 +370,8 @@ def personalised_kgs(num_patients, output_folder, output_file, plots):
     stats_table['nodes'] = number_of_nodes
     stats_table['edges'] = number_of_edges
     stats_table['found_edges'] = number_of_found_edges
+    for i, days in enumerate(windows):
+        stats_table[f'found_edges_{days}'] = [counts[i] for counts in found_edges_per_window]
 
     stats_table.to_csv(output_file, index=False, header=True)    ## store table in file
     
@@ -125,125 +379,460 @@ def personalised_kgs(num_patients, output_folder, output_file, plots):
     print(f"Average Number of edges: {sum(number_of_edges)/num_patients}")
     print(f"Average Number of found edges: {sum(number_of_found_edges)/num_patients}")
 
+    # report next to the stats table
+    _finish_profile(started, cprofile_file, f"{os.path.splitext(output_file)[0]}_profile", command='pkgs',
+        num_patients=num_patients, chunk_size=chunk_size, workers=workers, prefetch=prefetch_depth, source=source)
 
+@cli.command('features')
+@click.argument("num_patients", type=int)
+@click.argument("output_prefix", type=str)
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("-w", "--workers", type=int, default=1, help="Number of worker processes")
+@click.option("--prefetch", "prefetch_depth", type=int, default=2, help="Number of chunks fetched ahead while graphs are built")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+@click.option("--vocabulary", type=click.Path(exists=True), default=None,
+    help="<prefix>_features.parquet of an earlier run, to get the same columns (other features are left out)")
+def graph_feature_matrix(num_patients, output_prefix, chunk_size, workers, prefetch_depth, source, vocabulary):
+    """
+    Command to export per patient graph features as a sparse patients x features matrix.
 
-@cli.command('akgs')
+    Features are node presence, node degree, found edges and graph stats (see src/features.py). Writes
+    <output_prefix>.npz (CSR), <output_prefix>_features.parquet (column names) and <output_prefix>_patients.parquet (row ids).
+
+    try : python generate_graphs.py features 10000 features/cohort
+    """
+    Path(output_prefix).parent.mkdir(exist_ok=True, parents=True)
+
+    db_helper = open_source(source)
+    association_index = AssociationIndex(db_helper.get_medi(), db_helper.get_icd_associations())
+    patient_ids = db_helper.get_patient_ids(num_patients)
+
+    columns = pd.read_parquet(vocabulary).sort_values('column').feature.tolist() if vocabulary else None
+    feature_matrix = FeatureMatrix(columns)
+
+    chunks = list(_chunks(patient_ids, chunk_size))
+    with tqdm(desc="Generate features", total=len(patient_ids)) as progress:
+        for rows in _map_chunks(_features_chunk, chunks, workers, association_index, db_helper, source, prefetch_depth):
+            feature_matrix.add_chunk(rows)
+            progress.update(len(rows))
+
+    feature_matrix.save(output_prefix)
+    print(f"{len(feature_matrix.patient_ids)} patients x {len(feature_matrix.vocabulary)} features")
+
+
+@cli.command('temporal-pkgs')
 @click.argument("num_patients", type=int)
 @click.argument("output_folder", type=str)
-@click.argument("phecode", type=str, default='278.11') # morbid obesity
-@click.option("-t", "--threshold", type=int, default=50)
-def averaged_kgs(num_patients, output_folder, phecode, threshold):
+@click.option('-p', '--plots', is_flag=True, help="Plot the graph of every step")
+@click.option("--plot-workers", type=int, default=2, help="Number of processes rendering the plots")
+@click.option("--window", type=int, default=None, help="Days per step, default one step per visit date")
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("-w", "--workers", type=int, default=1, help="Number of worker processes")
+@click.option("--prefetch", "prefetch_depth", type=int, default=2, help="Number of chunks fetched ahead while graphs are built")
+@click.option("--label-cache", type=str, default=None, help="CSV file to cache node labels across runs")
+@click.option("--label-tables", type=click.Path(exists=True), default=None, help="Folder of the label table dumps, labels are read from it first")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+def temporal_kgs(num_patients, output_folder, plots, plot_workers, window, chunk_size, workers, prefetch_depth, label_cache, label_tables, source):
     """
-    Command to generate averaged graphs.
+    Command to generate the PKG of every patient after each visit (or window of days).
 
-    try : python generate_graphs.py akgs  500 ..//..//averaged -t 25
-    """
+    The patient sequences are stored in <output_folder>/temporal_store, see TemporalStore, as deltas between the steps.
+    Plots are named <patient_id>_<step>_complete.png, _without-isolates.png and _only-found.png.
 
+    try : python generate_graphs.py temporal-pkgs 100 reports/temporal --window 30 -p
+    """
     Path(output_folder).mkdir(exist_ok=True, parents=True)
 
-    db_helper = DbHelper()
+    db_helper = open_source(source)
+    association_index = AssociationIndex(db_helper.get_medi(), db_helper.get_icd_associations())
+    patient_ids = db_helper.get_patient_ids(num_patients)
 
-    medi_associations = db_helper.get_medi()
-    icd_associations = db_helper.get_icd_associations()
-    unique_icds = icd_associations['disease1'].append(icd_associations['disease2']).unique()
+    chunks = list(_chunks(patient_ids, chunk_size))
+    temporal_chunk = partial(_temporal_chunk, window=window)
 
-    # list of patients
-    patient_ids = unique_feature_patients(phecode, db_helper=db_helper)
-    patient_ids = random.choices(patient_ids, k=num_patients)
+    # all patient sequences in one store, see TemporalStore
+    temporal_store = TemporalStore(os.path.join(output_folder, "temporal_store"))
+    renderer = PlotRenderer(plot_workers, source=source, label_cache=label_cache, label_tables=label_tables) if plots else nullcontext()
 
-    # store common edges and node attributes
-    common_edges = {}
-    all_nodes = {}
+    steps = 0
+    with renderer, tqdm(desc="Generate graphs", total=len(patient_ids)) as progress:
+        for sequences in _map_chunks(temporal_chunk, chunks, workers, association_index, db_helper, source, prefetch_depth):
+            for patient_id, sequence in sequences:
+                steps += len(sequence)
+                temporal_store.append(patient_id, sequence)
+                if plots:
+                    for step, (date, graph) in enumerate(sequence.snapshots(), start=1):
+                        renderer.submit(f"{patient_id}_{step:02d}", graph, output_folder)
+            with profiler.stage('store'):
+                temporal_store.flush()
+            progress.update(len(sequences))
 
-    # store stats
-    ids: List[int] = [] 
-    number_of_nodes: List[int] = []
-    number_of_edges: List[int] = []
-    number_of_found_edges: List[int] = []
+    print(f"Average Number of steps: {steps / max(len(patient_ids), 1)}")
 
-    for i, patient_id in tqdm(
-        enumerate(patient_ids),
-        desc="Generate graphs",
-        total=num_patients,
-    ):
 
-        drugs = db_helper.get_drugs(patient_id)
-        diags = db_helper.get_diags(patient_id)
+@cli.command('pkgs-update')
+@click.argument("output_folder", type=str)
+@click.argument("output_file", type=str)   # store stats table of the updated patients to file
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+@click.option("--max-lag", type=int, default=365, help="Days before the watermark fetched again. Edge lags up to it stay exact, "
+              "lags longer than it can only shrink and are not recomputed from the full history")
+def personalised_kgs_update(output_folder, output_file, chunk_size, source, max_lag):
+    """
+    Add the visits since the last run to the graphs in the graph store of a pkgs output folder.
 
-        # Commom drugs between patient data and medi data
-        lit_drugs = drugs[(drugs['rx_cui'].isin(medi_associations.rxcui.unique()))]
-        
-        # Commom icd codes between patient data and literature (medi and disgenet)
-        lit_diagnosis = diags[(diags['icd_code'].isin(medi_associations.icd_code.unique())) | 
-            (diags['icd_code'].isin(unique_icds))]
+    Only the visits after a patient's watermark (and the max lag before it) are fetched, patients
+    stored without a watermark are rebuilt from their full history. Changed graphs are appended to the store.
+    Edge lags longer than --max-lag can only shrink and are not recomputed from the full history, run pkgs
+    again to get them exact.
 
-        # drug_diagnosis realtions between common drugs and diagnosis
-        mdas = medi_associations[(medi_associations['rxcui'].isin(lit_drugs.rx_cui.unique())) & 
-            (medi_associations['icd_code'].isin(lit_diagnosis.icd_code.unique()))]
-        
-        # diagnosis_diagnosis realtions between common icds
-        ddas = icd_associations[(icd_associations['disease1'].isin(lit_diagnosis.icd_code.unique())) & 
-            (icd_associations['disease2'].isin(lit_diagnosis.icd_code.unique()))]
+    try : python generate_graphs.py pkgs-update reports reports/update_stats.csv
+    """
+    graph_store = GraphStore(os.path.join(output_folder, "graph_store"))
+    db_helper = open_source(source)
+    association_index = AssociationIndex(db_helper.get_medi(), db_helper.get_icd_associations())
+    _init_worker(association_index, profiler.enabled)
+
+    # latest record of every stored patient, in first stored order
+    patient_ids = list(dict.fromkeys(graph_store.patient_ids().tolist()))
+
+    stats = []
+    with tqdm(desc="Update graphs", total=len(patient_ids)) as progress:
+        for chunk in _chunks(patient_ids, chunk_size):
+            watermarks = {patient_id: graph_store.watermark(patient_id) for patient_id in chunk}
+            since = {patient_id: window_start(watermark, max(max_lag, 90)) for patient_id, watermark in watermarks.items() if watermark is not None}
+
+            if since:
+                with profiler.stage('fetch'):
+                    drugs = db_helper.get_drugs_since(since)
+                    diags = db_helper.get_diags_since(since)
+                for patient_id in since:
+                    graph, watermark = update_graph(graph_store.get(patient_id), drugs[patient_id], diags[patient_id],
+                        watermarks[patient_id], association_index)
+                    if watermark != watermarks[patient_id]:
+                        graph_store.append(patient_id, graph, watermark)
+                        stats.append((patient_id, 'update', len(graph.nodes), len(graph.edges),
+                            int((graph.edge_states & FOUND).astype(bool).sum())))
+
+            rebuild = [patient_id for patient_id, watermark in watermarks.items() if watermark is None]
+            if rebuild:
+                for patient_id, nodes, edges, found_edges, graph, watermark in _pkgs_chunk(_fetch_chunk(db_helper, rebuild), output_folder, False):
+                    graph_store.append(patient_id, graph, watermark)
+                    stats.append((patient_id, 'rebuild', nodes, edges, found_edges))
+
+            with profiler.stage('store'):
+                graph_store.flush()
+            progress.update(len(chunk))
+
+    stats_table = pd.DataFrame(stats, columns=['patient_ids', 'mode', 'nodes', 'edges', 'found_edges'])
+    stats_table.to_csv(output_file, index=False, header=True)    ## store table in file
+    print(f"Updated {int((stats_table['mode'] == 'update').sum())} and rebuilt {int((stats_table['mode'] == 'rebuild').sum())} of {len(patient_ids)} patient graphs")
 
-        ids.append(patient_id)    ## store patient ids
 
-        # create KGs
-        current_pkg = PKG(patient_drugs=drugs, patient_diagnosis=diags,
-            lit_drugs=lit_drugs, mdas=mdas, lit_diagnosis=lit_diagnosis, ddas=ddas, real_associations=False)
-        
-        number_of_nodes.append(len(current_pkg.graph.nodes))    ## add total nodes
-        number_of_edges.append(len(current_pkg.graph.edges))    ## add total edges
-
-        # store edges and node attributes
-        for edge1, edge2, data in current_pkg.graph.edges(data=True):
-            edge = '_'.join(sorted((edge1, edge2)))
-            if edge in common_edges:
-                common_edges[edge]['count'] += 1
-            else:
-                common_edges[edge] = {'count' : 1, 'color' : data['color']}
-            
-            if edge1 not in all_nodes:
-                all_nodes[edge1] = {'color' : current_pkg.graph.nodes[edge1]['color']}
-            if edge2 not in all_nodes:
-                all_nodes[edge2] = {'color' : current_pkg.graph.nodes[edge2]['color']}
-        
-        # # store pickle file
-        # nx.write_gpickle(current_pkg.graph, os.path.join(output_folder, f"{patient_id}_graph.pkl"),)
+@cli.command('akgs')
+@click.argument("num_patients", type=int)
+@click.argument("output_folder", type=str)
+@click.argument("phecode", type=str, default='278.11') # morbid obesity
+@click.option("-t", "--threshold", type=int, default=50)
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("-w", "--workers", type=int, default=1, help="Number of worker processes")
+@click.option("--prefetch", "prefetch_depth", type=int, default=2, help="Number of chunks fetched ahead while graphs are built")
+@click.option("-s", "--seed", type=int, default=None, help="Seed for sampling the patients")
+@click.option("--checkpoint-every", type=int, default=1000, help="Checkpoint the edge counts every n patients")
+@click.option("--resume", is_flag=True, help="Continue from the last checkpoint in the output folder, 'graphs' engine only")
+@click.option("--cohort-cache", type=str, default=None, help="Folder to cache the patient ids of each phecode")
+@click.option("--refresh-cohorts", is_flag=True, help="Query the cohorts again instead of reading them from --cohort-cache")
+@click.option("--label-cache", type=str, default=None, help="CSV file to cache node labels across runs")
+@click.option("--label-tables", type=click.Path(exists=True), default=None, help="Folder of the label table dumps, labels are read from it first")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+@click.option("--fast-layout", is_flag=True, help="Spectral start and few spring iterations, for large averaged graphs")
+@click.option("--engine", type=click.Choice(['graphs', 'matrix']), default='graphs',
+    help="'graphs' counts the edges of every patient graph, 'matrix' counts them with sparse products over the cohort")
+@click.option("--background", type=int, default=0, help="Number of background patients outside the cohort to compare the edges with, 0 to skip")
+@click.option("--profile", is_flag=True, help="Time the stages of the run and write a profile report")
+@click.option("--cprofile", "cprofile_file", type=str, default=None, help="Also dump cProfile stats of the main process to this file")
+def averaged_kgs(num_patients, output_folder, phecode, threshold, chunk_size, workers, prefetch_depth, seed, checkpoint_every, resume, cohort_cache, refresh_cohorts, label_cache, label_tables, source, fast_layout,
+                 engine, background, profile, cprofile_file):
+    """
+    Command to generate averaged graphs.
 
-    # averaged edges
-    edges_df = pd.DataFrame(common_edges).T.rename_axis('edge').reset_index()
-    nodes_df = pd.DataFrame(all_nodes).T.rename_axis('node').reset_index()
+    try : python generate_graphs.py akgs  500 ..//..//averaged -t 25
+    """
+    started = _start_profile(profile, cprofile_file)
 
-    # filter edges based on threshold
-    cutoff = num_patients * ( threshold / 100 )
-    averaged_edges = edges_df[edges_df['count'] >= cutoff]
+    Path(output_folder).mkdir(exist_ok=True, parents=True)
 
-    # process nodelist and edgelist
-    # seperate edge str and add strength of edges and create nodelist
-    averaged_edges[['node1', 'node2']] = averaged_edges['edge'].str.split('_', 1, expand=True)
-    averaged_edges.drop(columns='edge', inplace=True)
-    averaged_edges = averaged_edges[['node1', 'node2', 'count', 'color']]
+    db_helper = open_source(source)
+
+    association_index = AssociationIndex(db_helper.get_medi(), db_helper.get_icd_associations())
+
+    checkpoint = os.path.join(output_folder, f"{phecode}_checkpoint.pkl")
+
+    if resume and os.path.exists(checkpoint):
+        if engine == 'matrix':
+            raise click.UsageError("--resume continues the counts of the 'graphs' engine, 'matrix' counts the whole cohort again")
+        # continue with the sampled patients and counts of the interrupted run
+        aggregator, run = EdgeAggregator.load(checkpoint)
+        if seed is not None and seed != run['seed']:
+            raise click.BadParameter(f"{seed} differs from the seed {run['seed']} of the checkpoint", param_hint="--seed")
+        seed = run['seed']
+        patient_ids = run['patient_ids']
+        num_patients = len(patient_ids)
+        print(f'Resuming after {aggregator.processed} of {len(patient_ids)} patients')
+    else:
+        # list of patients
+        patient_ids = unique_feature_patients(phecode, db_helper=db_helper, cache_dir=cohort_cache, refresh=refresh_cohorts)
+        random.seed(seed)
+        patient_ids = random.choices(patient_ids, k=num_patients)
+
+        # store common edges and node attributes
+        aggregator = EdgeAggregator()
+
+    if engine == 'matrix':
+        # same counts without building the patient graphs, the whole cohort is counted at once
+        matrix = _cohort_matrix(patient_ids, association_index, db_helper, chunk_size, source, prefetch_depth)
+        aggregator = matrix.aggregator(Counter(patient_ids))
+    else:
+        chunks = list(_chunks(patient_ids[aggregator.processed:], chunk_size))
+        last_checkpoint = aggregator.processed
+
+        with tqdm(desc="Generate graphs", total=len(patient_ids), initial=aggregator.processed) as progress:
+            for graphs in _map_chunks(_akgs_chunk, chunks, workers, association_index, db_helper, source, prefetch_depth):
+                with profiler.stage('aggregate'):
+                    for patient_id, graph in graphs:
+                        aggregator.add(graph.iter_edges(), graph.node_colors())    ## store edges and node attributes
+                progress.update(len(graphs))
+
+                if aggregator.processed - last_checkpoint >= checkpoint_every:
+                    aggregator.save(checkpoint, patient_ids=patient_ids, seed=seed)
+                    last_checkpoint = aggregator.processed
+
+    # full counts of the run, other thresholds are derived from them by 'akgs-threshold'
+    aggregator.save(os.path.join(output_folder, f"{phecode}_counts.pkl"), patient_ids=patient_ids, seed=seed)
+
+    label_resolver = LabelResolver.open(db_helper, cache_file=label_cache, table_dir=label_tables)
+    edges_df = _write_averaged_graph(aggregator, num_patients, threshold, output_folder, phecode, label_resolver, fast_layout)
+
+    if background > 0:
+        cohort = unique_feature_patients(phecode, db_helper=db_helper, cache_dir=cohort_cache, refresh=refresh_cohorts)
+        background_ids = _background_samples(db_helper, {phecode: cohort}, background, seed)[phecode]
+        background_matrix = _cohort_matrix(background_ids, association_index, db_helper, chunk_size, source, prefetch_depth)
+        _write_edge_statistics(aggregator, num_patients, background_matrix.aggregator(), output_folder, phecode)
+
+    # run is complete, the checkpoint is not needed anymore
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
-    strength = averaged_edges['count'].apply(lambda x : round((x/num_patients) * 100, 2))
-    averaged_edges.insert(averaged_edges.shape[1], column='strength', value=strength)
+    print(f'Total edges : {edges_df.shape[0]}')
 
-    averaged_nodes = nodes_df[(nodes_df['node'].isin(averaged_edges.node1.unique())) |
-        (nodes_df['node'].isin(averaged_edges.node2.unique()))]
-    
-    # Create averaged plot and store
-    akg_plot = create_akg(node_list=averaged_nodes, edge_list=averaged_edges, db_helper=db_helper)
+    _finish_profile(started, cprofile_file, os.path.join(output_folder, f"{phecode}_profile"), command='akgs',
+        num_patients=num_patients, phecode=phecode, chunk_size=chunk_size, workers=workers, prefetch=prefetch_depth, source=source, engine=engine)
 
-    akg_plot.savefig(os.path.join(output_folder, f"{phecode}_averaged_plot.png"))
 
-    plt.close("all")
+@cli.command('akgs-batch')
+@click.argument("feature_file", type=click.Path(exists=True))
+@click.argument("num_patients", type=int)
+@click.argument("output_folder", type=str, default='results')
+@click.option("-t", "--threshold", type=int, default=50)
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("-w", "--workers", type=int, default=1, help="Number of worker processes")
+@click.option("--prefetch", "prefetch_depth", type=int, default=2, help="Number of chunks fetched ahead while graphs are built")
+@click.option("-s", "--seed", type=int, default=None, help="Seed for sampling the patients of every phecode")
+@click.option("--cohort-cache", type=str, default=None, help="Folder to cache the patient ids of each phecode")
+@click.option("--refresh-cohorts", is_flag=True, help="Query the cohorts again instead of reading them from --cohort-cache")
+@click.option("--label-cache", type=str, default=None, help="CSV file to cache node labels across runs")
+@click.option("--label-tables", type=click.Path(exists=True), default=None, help="Folder of the label table dumps, labels are read from it first")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+@click.option("--fast-layout", is_flag=True, help="Spectral start and few spring iterations, for large averaged graphs")
+@click.option("--engine", type=click.Choice(['graphs', 'matrix']), default='graphs',
+    help="'graphs' counts the edges of every patient graph, 'matrix' counts them with sparse products over the cohort")
+@click.option("--background", type=int, default=0, help="Number of background patients outside the cohort to compare the edges with, 0 to skip")
+@click.option("--profile", is_flag=True, help="Time the stages of the run and write a profile report")
+@click.option("--cprofile", "cprofile_file", type=str, default=None, help="Also dump cProfile stats of the main process to this file")
+def averaged_kgs_batch(feature_file, num_patients, output_folder, threshold, chunk_size, workers, prefetch_depth, seed, cohort_cache, refresh_cohorts, label_cache, label_tables, source, fast_layout,
+                       engine, background, profile, cprofile_file):
+    """
+    Command to generate the averaged graphs of all phecodes in a feature list in one pass.
 
-    # store averaged edge and node list
-    averaged_edges.to_csv(os.path.join(output_folder, f'{phecode}_edgelist.csv'), index=False, header=True)
-    averaged_nodes.to_csv(os.path.join(output_folder, f'{phecode}_nodelist.csv'), index=False, header=True)
+    Every distinct patient graph is built once and counted for each phecode cohort it was sampled into.
+    Output goes to <output_folder>/<phecode>_graph/, like batch_execution.sh.
 
+    try : python generate_graphs.py akgs-batch data/220329_feature_list.txt 5000 results -t 25
+    """
+    started = _start_profile(profile, cprofile_file)
+
+    with open(feature_file) as f:
+        phecodes = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    db_helper = open_source(source)
+
+    association_index = AssociationIndex(db_helper.get_medi(), db_helper.get_icd_associations())
+
+    # sampled patients per phecode, patient_id -> [(phecode, times sampled, first position in the sample)]
+    memberships = {}
+    samples = {}
+    cohorts = {}
+    for phecode in tqdm(phecodes, desc="Resolve cohorts"):
+        patient_ids = cohorts[phecode] = unique_feature_patients(phecode, db_helper=db_helper, cache_dir=cohort_cache, refresh=refresh_cohorts)
+        random.seed(seed)    ## same sample as 'akgs' with this seed
+        samples[phecode] = random.choices(patient_ids, k=num_patients)
+        for order, (patient_id, weight) in enumerate(Counter(samples[phecode]).items()):
+            memberships.setdefault(patient_id, []).append((phecode, weight, order))
+
+    if engine == 'matrix':
+        # one incidence matrix of all sampled patients, counted per phecode with the sample weights
+        matrix = _cohort_matrix(list(memberships), association_index, db_helper, chunk_size, source, prefetch_depth)
+        aggregators = {phecode: matrix.aggregator(Counter(samples[phecode])) for phecode in phecodes}
+    else:
+        aggregators = {phecode: EdgeAggregator() for phecode in phecodes}
+
+        chunks = list(_chunks(list(memberships), chunk_size))
+
+        with tqdm(desc="Generate graphs", total=len(memberships)) as progress:
+            for graphs in _map_chunks(_akgs_chunk, chunks, workers, association_index, db_helper, source, prefetch_depth):
+                with profiler.stage('aggregate'):
+                    for patient_id, graph in graphs:
+                        for phecode, weight, order in memberships[patient_id]:
+                            aggregators[phecode].add(graph.iter_edges(), graph.node_colors(), weight=weight, order=order)
+                progress.update(len(graphs))
+
+        # rows and colors as a single 'akgs' run of the phecode writes them
+        aggregators = {phecode: aggregator.in_sample_order() for phecode, aggregator in aggregators.items()}
+
+    background_matrix = None
+    if background > 0:
+        # one matrix of all background patients, counted per phecode over the patients outside its cohort
+        background_samples = _background_samples(db_helper, cohorts, background, seed)
+        background_matrix = _cohort_matrix([patient_id for patient_ids in background_samples.values() for patient_id in patient_ids],
+            association_index, db_helper, chunk_size, source, prefetch_depth)
+
+    label_resolver = LabelResolver.open(db_helper, cache_file=label_cache, table_dir=label_tables)
+    for phecode, aggregator in aggregators.items():
+        phecode_folder = os.path.join(output_folder, f"{phecode}_graph")
+        Path(phecode_folder).mkdir(exist_ok=True, parents=True)
+
+        aggregator.save(os.path.join(phecode_folder, f"{phecode}_counts.pkl"), patient_ids=samples[phecode], seed=seed)
+        edges_df = _write_averaged_graph(aggregator, num_patients, threshold, phecode_folder, phecode, label_resolver, fast_layout)
+        if background_matrix is not None:
+            _write_edge_statistics(aggregator, num_patients, background_matrix.aggregator(Counter(background_samples[phecode])),
+                phecode_folder, phecode)
+
+        print(f'{phecode} total edges : {edges_df.shape[0]}')
+
+    _finish_profile(started, cprofile_file, os.path.join(output_folder, "batch_profile"), command='akgs-batch',
+        num_patients=num_patients, phecodes=phecodes, chunk_size=chunk_size, workers=workers, prefetch=prefetch_depth, source=source, engine=engine)
+
+
+@cli.command('akgs-threshold')
+@click.argument("output_folder", type=str)
+@click.argument("phecode", type=str, default='278.11')
+@click.option("-t", "--threshold", "thresholds", type=int, multiple=True, default=[50], help="Threshold, can be given several times")
+@click.option("--label-cache", type=str, default=None, help="CSV file to cache node labels across runs")
+@click.option("--label-tables", type=click.Path(exists=True), default=None, help="Folder of the label table dumps, labels are read from it first")
+@click.option("--source", type=str, default='db', help="'db' or a data folder written by export-source")
+@click.option("--fast-layout", is_flag=True, help="Spectral start and few spring iterations, for large averaged graphs")
+def averaged_kgs_threshold(output_folder, phecode, thresholds, label_cache, label_tables, source, fast_layout):
+    """
+    Command to re-derive the averaged graph of an 'akgs' run for other thresholds, from its stored counts.
 
-    print(f'Total edges : {edges_df.shape[0]}')
+    Output is <phecode>_t<threshold>_edgelist.csv, _nodelist.csv and _averaged_plot.png per threshold.
 
+    try : python generate_graphs.py akgs-threshold ..//..//averaged 278.11 -t 10 -t 25 -t 50
+    """
+    aggregator, run = EdgeAggregator.load(os.path.join(output_folder, f"{phecode}_counts.pkl"))
+    num_patients = len(run['patient_ids'])
+    print(f"{num_patients} patients, seed {run['seed']}")
+
+    label_resolver = LabelResolver.open(source=source, cache_file=label_cache, table_dir=label_tables)    ## connects only for labels not cached
+    for threshold in thresholds:
+        _write_averaged_graph(aggregator, num_patients, threshold, output_folder, phecode, label_resolver, fast_layout,
+            name=f"{phecode}_t{threshold}")
+
+        cutoff = num_patients * ( threshold / 100 )
+        print(f"Threshold {threshold} : {int((aggregator.edge_table()['count'] >= cutoff).sum())} edges")
+
+
+@cli.command('query')
+@click.argument("results_folder", type=str, default='results')
+@click.option("--edge", "edge", type=str, nargs=2, default=None, help="Phecodes with the edge between two nodes")
+@click.option("--node", type=str, default=None, help="Strongest edges of a node across the phecodes")
+@click.option("--phecode", type=str, default=None, help="Averaged edges of one phecode")
+@click.option("-n", "--top", type=int, default=20, help="Number of rows shown, 0 for all")
+@click.option("--index", "index_folder", type=str, default=None, help="Index folder, default <results_folder>/index")
+@click.option("-o", "--output", "output_file", type=str, default=None, help="Also store the answer as CSV")
+def query_results(results_folder, edge, node, phecode, top, index_folder, output_file):
+    """
+    Look up edges across the averaged graphs of a results folder (akgs-batch output).
+
+    The index is updated first, only phecode folders added or changed since the last query are read
+    and the edges of deleted ones are dropped.
+
+    try : python generate_graphs.py query results --edge 278.01 E66.9
+    """
+    start = time.perf_counter()
+    results_index = ResultsIndex(index_folder or os.path.join(results_folder, 'index'))
+    indexed = results_index.update(results_folder)
+    if indexed:
+        print(f"Updated {len(indexed)} phecodes in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    if edge is not None:
+        answer = results_index.edge(*edge)
+    elif node is not None:
+        answer = results_index.node(node)
+    elif phecode is not None:
+        answer = results_index.phecode(phecode)
+    else:
+        raise click.UsageError("Give one of --edge, --node or --phecode")
+    elapsed = time.perf_counter() - start
+
+    print(answer.to_string(index=False) if top == 0 else answer.head(top).to_string(index=False))
+    print(f"{len(answer)} rows in {elapsed * 1000:.1f} ms")
+    if output_file is not None:
+        answer.to_csv(output_file, index=False, header=True)
+
+
+@cli.command('export-source')
+@click.argument("num_patients", type=int)
+@click.argument("data_folder", type=str)
+@click.option("-f", "--feature-file", type=click.Path(exists=True), default=None, help="Also export the cohorts of these phecodes")
+@click.option("--partitions", type=int, default=64, help="Number of patient id partitions")
+@click.option("-c", "--chunk-size", type=int, default=500, help="Number of patients fetched per DB query")
+@click.option("--tables", "table_dir", type=click.Path(exists=True), default=None,
+    help="Folder of the table dumps (table_files/), read the literature and labels from it instead of the DB")
+@click.option("--drugs", "drugs_file", type=click.Path(exists=True), default=None, help="Prescriptions file (CSV or Parquet) with --tables")
+@click.option("--diagnoses", "diags_file", type=click.Path(exists=True), default=None, help="Diagnoses file (CSV or Parquet) with --tables")
+@click.option("--icd-associations", "icd_associations_file", type=click.Path(exists=True), default=None,
+    help="disease1, disease2 file with --tables, default <tables>/icd_associations.csv")
+@click.option("--phecode-map", "phecode_map_file", type=click.Path(exists=True), default=None,
+    help="icd_code, phewas_code file with --tables for the -f cohorts, default <tables>/icd_phewas.csv")
+def export_source(num_patients, data_folder, feature_file, partitions, chunk_size, table_dir, drugs_file, diags_file,
+                  icd_associations_file, phecode_map_file):
+    """
+    Copy patients and literature from the database into a local data folder, to run with --source <data_folder>.
+
+    With --tables the folder is built without the database, from the table dumps and the --drugs and --diagnoses files.
+
+    try : python generate_graphs.py export-source 1000 data/local -f data/220329_feature_list.txt
+    try : python generate_graphs.py export-source 1000 data/local --tables ../table_files --drugs drugs.csv --diagnoses diagnoses.csv
+    """
+    phecodes = []
+    if feature_file is not None:
+        with open(feature_file) as f:
+            phecodes = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    if table_dir is not None:
+        if drugs_file is None or diags_file is None:
+            raise click.UsageError("--tables needs the patient visits as --drugs and --diagnoses files")
+        source = TableSource(table_dir, drugs_file, diags_file, icd_associations_file, phecode_map_file)
+        if phecodes and source.phecode_map is None:
+            raise click.UsageError("-f needs an icd_code to phewas_code map, give --phecode-map")
+    elif drugs_file is not None or diags_file is not None:
+        raise click.UsageError("--drugs and --diagnoses are read with --tables")
+    else:
+        source = DbHelper()
+    FileSource.export(source, data_folder, source.get_patient_ids(num_patients), phecodes,
+        num_partitions=partitions, chunk_size=chunk_size)
 
 
 if __name__ == '__main__':
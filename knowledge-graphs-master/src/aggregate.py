@@ -0,0 +1,132 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+class EdgeAggregator:
+    """ Class to count edges over the patient graphs of a cohort """
+
+    def __init__(self) -> None:
+        # interned node and edge ids, in order of first appearance
+        self.node_ids = {}
+        self.node_colors = []
+        self.edge_ids = {}
+        self.edge_colors = []
+        self.counts = np.zeros(1024, dtype=np.int64)
+        # (patient order, position in the patient graph) of the first sighting, when add() gets an order
+        self._node_seen = {}
+        self._edge_seen = {}
+
+        self.processed = 0    ## number of patient graphs added
+
+    def _node_id(self, node, color) -> int:
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            node_id = self.node_ids[node] = len(self.node_colors)
+            self.node_colors.append(color)
+        return node_id
+
+    def _edge_id(self, node1, node2, color) -> int:
+        key = (self.node_ids[node1], self.node_ids[node2])
+        edge_id = self.edge_ids.get(key)
+        if edge_id is None:
+            edge_id = self.edge_ids[key] = len(self.edge_colors)
+            self.edge_colors.append(color)
+            if edge_id == len(self.counts):
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+        return edge_id
+
+    @staticmethod
+    def _seen(seen: dict, key: int, rank, colors: list, color) -> None:
+        """ Keep the earliest sighting of a node or edge and its color then """
+        if key not in seen or rank < seen[key]:
+            seen[key] = rank
+            colors[key] = color
+
+    def add(self, edges, node_colors, weight: int = 1, order: int = None) -> None:
+        """
+        Count the edges of one patient graph.
+
+        :param edges: list of (node1, node2, color)
+        :param node_colors: dict of node to color
+        :param weight: number of times the patient was sampled
+        :param order: first position of the patient in the sample, for patients added out of sample order (see in_sample_order)
+        """
+        ids = []
+        for position, (edge1, edge2, color) in enumerate(edges):
+            node1 = self._node_id(edge1, node_colors[edge1])
+            node2 = self._node_id(edge2, node_colors[edge2])
+            ids.append(self._edge_id(*sorted((edge1, edge2)), color))
+            if order is not None:
+                self._seen(self._node_seen, node1, (order, 2 * position), self.node_colors, node_colors[edge1])
+                self._seen(self._node_seen, node2, (order, 2 * position + 1), self.node_colors, node_colors[edge2])
+                self._seen(self._edge_seen, ids[-1], (order, position), self.edge_colors, color)
+        # a simple graph has every edge once, no repeated ids
+        self.counts[ids] += weight
+        self.processed += weight
+
+    def in_sample_order(self):
+        """
+        Aggregator with the nodes, edges and colors as if the patients had been added in sample order,
+        the order given to add(). Tables of a shared pass then equal those of a single cohort run.
+        """
+        nodes, edges = list(self.node_ids), list(self.edge_ids)
+        node_order = sorted(range(len(nodes)), key=self._node_seen.__getitem__)
+        edge_order = sorted(range(len(edges)), key=self._edge_seen.__getitem__)
+        positions = {old: new for new, old in enumerate(node_order)}
+        return EdgeAggregator.from_counts([nodes[i] for i in node_order], [self.node_colors[i] for i in node_order],
+            [(positions[edges[i][0]], positions[edges[i][1]]) for i in edge_order], [self.edge_colors[i] for i in edge_order],
+            self.counts[edge_order], self.processed)
+
+    def edge_table(self) -> pd.DataFrame:
+        """ All counted edges with columns edge ('node1_node2'), count and color """
+        nodes = list(self.node_ids)
+        return pd.DataFrame({
+            'edge': ['_'.join((nodes[node1], nodes[node2])) for node1, node2 in self.edge_ids],
+            'count': self.counts[:len(self.edge_colors)],
+            'color': self.edge_colors,
+        })
+
+    def node_table(self) -> pd.DataFrame:
+        """ All nodes of counted edges with columns node and color """
+        return pd.DataFrame({'node': list(self.node_ids), 'color': self.node_colors})
+
+    def save(self, path: str, **metadata) -> None:
+        """ Checkpoint the counts (and metadata to resume the run) to a pickle file """
+        state = {
+            'nodes': list(self.node_ids),
+            'node_colors': self.node_colors,
+            'edges': list(self.edge_ids),
+            'edge_colors': self.edge_colors,
+            'counts': self.counts[:len(self.edge_colors)],
+            'processed': self.processed,
+            'metadata': metadata,
+        }
+        # write next to the old checkpoint and swap, a crash never leaves a partial file
+        with open(f"{path}.tmp", 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def from_counts(cls, nodes, node_colors, edges, edge_colors, counts, processed: int):
+        """ Aggregator with counted edges, edges are (node1, node2) positions in nodes with node1 < node2 as codes """
+        aggregator = cls()
+        aggregator.node_ids = {node: i for i, node in enumerate(nodes)}
+        aggregator.node_colors = list(node_colors)
+        aggregator.edge_ids = {tuple(edge): i for i, edge in enumerate(edges)}
+        aggregator.edge_colors = list(edge_colors)
+        aggregator.counts = np.concatenate([np.asarray(counts, dtype=np.int64), np.zeros(1024, dtype=np.int64)])
+        aggregator.processed = processed
+        return aggregator
+
+    @classmethod
+    def load(cls, path: str):
+        """ Restore an aggregator from a checkpoint, returns (aggregator, metadata) """
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+
+        aggregator = cls.from_counts(state['nodes'], state['node_colors'], state['edges'], state['edge_colors'],
+            state['counts'], state['processed'])
+        return aggregator, state['metadata']
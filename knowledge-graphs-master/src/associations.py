@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+from profiling import profiler
+
+
+def _induced_rows(rows_by_code: dict, targets: np.ndarray, codes, target_codes) -> np.ndarray:
+    """ Sorted table positions of the associations from `codes` to `target_codes`. """
+    rows = [rows_by_code[code] for code in codes if code in rows_by_code]
+    if not rows:
+        return np.array([], dtype=np.intp)
+    rows = np.concatenate(rows)
+    rows = rows[np.isin(targets[rows], list(target_codes))]
+    return np.sort(rows)
+
+
+def _rows_with_codes(frame: pd.DataFrame, column: str, codes: set) -> pd.DataFrame:
+    """ Rows of the frame with a code in codes, one set lookup per distinct code of the frame """
+    inverse, unique_codes = pd.factorize(frame[column].values)
+    ## missing codes get -1 and pick the False appended last
+    keep = np.append(np.fromiter((code in codes for code in unique_codes), dtype=bool, count=len(unique_codes)), False)
+    return frame[keep[inverse]]
+
+
+class AssociationIndex:
+    """ Literature associations indexed by code, built once per run """
+
+    def __init__(self, medi_associations: pd.DataFrame, icd_associations: pd.DataFrame) -> None:
+        self.medi_associations = medi_associations
+        self.icd_associations = icd_associations
+
+        # table positions per source code, the targets are looked up in the column arrays
+        self._drug_rows = medi_associations.groupby("rxcui", observed=True).indices
+        self._drug_targets = medi_associations["icd_code"].values
+        self._disease_rows = icd_associations.groupby("disease1", observed=True).indices
+        self._disease_targets = icd_associations["disease2"].values
+
+        self.drug_codes = set(self._drug_rows)
+        self.diag_codes = set(medi_associations["icd_code"].unique()).union(
+            icd_associations["disease1"].unique(), icd_associations["disease2"].unique())
+
+    def literature_drugs(self, drugs: pd.DataFrame) -> pd.DataFrame:
+        """ Patient prescriptions of drugs in medi """
+        return _rows_with_codes(drugs, "rx_cui", self.drug_codes)
+
+    def literature_diagnosis(self, diags: pd.DataFrame) -> pd.DataFrame:
+        """ Patient diagnoses of icd codes in literature (medi and disgenet) """
+        return _rows_with_codes(diags, "icd_code", self.diag_codes)
+
+    def drug_diag_associations(self, drug_codes, diag_codes) -> pd.DataFrame:
+        """ Medi rows between the given drugs and diagnoses, in table order """
+        rows = _induced_rows(self._drug_rows, self._drug_targets, drug_codes, set(diag_codes))
+        return self.medi_associations.take(rows)
+
+    def diag_diag_associations(self, diag_codes) -> pd.DataFrame:
+        """ Icd association rows among the given diagnoses, in table order """
+        diag_codes = set(diag_codes)
+        rows = _induced_rows(self._disease_rows, self._disease_targets, diag_codes, diag_codes)
+        return self.icd_associations.take(rows)
+
+    def patient_associations(self, drugs: pd.DataFrame, diags: pd.DataFrame):
+        """
+        Literature subset of one patient.
+
+        :param drugs: patient prescriptions
+        :param diags: patient diagnoses
+        :return: lit_drugs, mdas, lit_diagnosis, ddas
+        """
+        with profiler.stage('literature_filter'):
+            lit_drugs = self.literature_drugs(drugs)
+            lit_diagnosis = self.literature_diagnosis(diags)
+
+            drug_codes = lit_drugs.rx_cui.unique()
+            diag_codes = lit_diagnosis.icd_code.unique()
+
+            mdas = self.drug_diag_associations(drug_codes, diag_codes)
+            ddas = self.diag_diag_associations(diag_codes)
+        return lit_drugs, mdas, lit_diagnosis, ddas
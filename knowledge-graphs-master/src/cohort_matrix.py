@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import hypergeom
+
+from aggregate import EdgeAggregator
+from make_graph import DDA, DIAG, DRUG, EDGE_COLORS, MDA, NODE_COLORS
+from profiling import profiler
+
+
+def _incidence(rows, codes, num_rows: int, index: pd.Index, values=None) -> sparse.csr_matrix:
+    """ 0/1 matrix of rows x codes of the index (or the values there), codes not in the index (and rows -1) are left out """
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = index.get_indexer(np.asarray(codes, dtype=object))
+    keep = (rows >= 0) & (columns >= 0)
+    data = np.ones(int(keep.sum()), dtype=np.int64) if values is None else np.asarray(values, dtype=np.int64)[keep]
+    matrix = sparse.csr_matrix((data, (rows[keep], columns[keep])), shape=(num_rows, len(index)))
+    if values is None:
+        matrix.data[:] = 1    ## a code seen at several visits counts once
+    return matrix
+
+
+def _first_rows(M1, M2, columns1, columns2, block: int = 1024) -> np.ndarray:
+    """ First row with both columns of every (columns1, columns2) pair, blocks of rows joined on the pairs not found yet """
+    first = np.full(len(columns1), -1, dtype=np.int64)
+    pairs = pd.DataFrame({'column1': columns1, 'column2': columns2, 'pair': np.arange(len(columns1))})
+    for start in range(0, M1.shape[0], block):
+        if pairs.empty:
+            break
+        rows1, rows2 = M1[start:start + block].tocoo(), M2[start:start + block].tocoo()
+        found = pd.DataFrame({'row': rows1.row, 'column1': rows1.col}).merge(pairs, on='column1').merge(
+            pd.DataFrame({'row': rows2.row, 'column2': rows2.col}), on=['row', 'column2'])
+        found = found.groupby('pair')['row'].min()
+        first[found.index.values] = found.values + start
+        pairs = pairs[first[pairs['pair'].values] < 0]
+    return first
+
+
+def _column(matrix, index: pd.Index, code) -> np.ndarray:
+    """ Rows with the code, as a boolean array """
+    if code not in index:
+        return np.zeros(matrix.shape[0], dtype=bool)
+    return matrix[:, index.get_loc(code)].toarray().ravel() > 0
+
+
+class CohortMatrix:
+    """
+    Patient x code incidence of a cohort, the literature edges of all patient graphs counted with sparse products.
+
+    With D the patient x literature drug and G the patient x literature diagnosis matrix and W the patient weights,
+    the drug-diag edge counts are D^T W G masked by the medi adjacency and the diag-diag edge counts G^T W G
+    masked by the icd associations. These are the counts an EdgeAggregator gets from the PKGs of the same patients.
+
+    The node id every code has in the PKG of a patient is kept with the incidence, to put the edges in the order
+    the EdgeAggregator sees them: by first patient, then as PKG stores them in that patient's graph.
+    """
+
+    def __init__(self, association_index) -> None:
+        self.association_index = association_index
+        self.patient_ids = []    ## row of every patient, in order of first appearance
+        self._positions = {}
+        # (row, code) entries of the drug, literature diagnosis and all diagnosis codes that are also drugs
+        self._entries = {'drug': ([], []), 'diag': ([], []), 'diag_as_drug': ([], [])}
+        self._node_ids = {'drug': [], 'diag': []}    ## PKG node id of the drug and diagnosis entries
+        self._matrices = None
+
+    def add_chunk(self, fetched) -> None:
+        """ Add a fetched chunk [(patient_id, drugs, diags)], patients added before are skipped """
+        drug_codes = self.association_index.drug_codes
+        diag_codes = self.association_index.diag_codes
+        for patient_id, drugs, diags in fetched:
+            if patient_id in self._positions:
+                continue
+            row = self._positions[patient_id] = len(self.patient_ids)
+            self.patient_ids.append(patient_id)
+
+            # PKG numbers the drugs, then the diagnoses that are no drug of the patient
+            patient_drugs, patient_diags = drugs.rx_cui.unique(), diags.icd_code.unique()
+            node_ids = {code: i for i, code in enumerate(patient_drugs)}
+            for code in patient_diags:
+                node_ids.setdefault(code, len(node_ids))
+
+            for name, codes in [('drug', [code for code in patient_drugs if code in drug_codes]),
+                                ('diag', [code for code in patient_diags if code in diag_codes]),
+                                ('diag_as_drug', [code for code in patient_diags if code in drug_codes])]:
+                rows, entries = self._entries[name]
+                rows.extend([row] * len(codes))
+                entries.extend(codes)
+                if name in self._node_ids:
+                    self._node_ids[name].extend(node_ids[code] for code in codes)
+        self._matrices = None
+
+    def _build(self):
+        """ Incidence matrices D, G and O (diagnoses that are drug codes) and the adjacency matrices A and S """
+        if self._matrices is not None:
+            return self._matrices
+
+        num_rows = len(self.patient_ids)
+        self.drug_index = pd.Index(sorted(set(self._entries['drug'][1])), dtype=object)
+        self.diag_index = pd.Index(sorted(set(self._entries['diag'][1])), dtype=object)    ## sorted, triu keeps code1 < code2
+
+        D = _incidence(*self._entries['drug'], num_rows, self.drug_index)
+        G = _incidence(*self._entries['diag'], num_rows, self.diag_index)
+        O = _incidence(*self._entries['diag_as_drug'], num_rows, self.drug_index)
+        # node id + 1, 0 where the patient has no such entry
+        self._drug_ids = _incidence(*self._entries['drug'], num_rows, self.drug_index, np.add(self._node_ids['drug'], 1))
+        self._diag_ids = _incidence(*self._entries['diag'], num_rows, self.diag_index, np.add(self._node_ids['diag'], 1))
+
+        medi = self.association_index.medi_associations
+        A = _incidence(self.drug_index.get_indexer(np.asarray(medi["rxcui"], dtype=object)), medi["icd_code"],
+            len(self.drug_index), self.diag_index)
+        icd = self.association_index.icd_associations
+        S = _incidence(self.diag_index.get_indexer(np.asarray(icd["disease1"], dtype=object)), icd["disease2"],
+            len(self.diag_index), self.diag_index)
+        S = (S + S.T).tolil()
+        S.setdiag(0)
+        S = S.tocsr()
+        S.eliminate_zeros()
+        S.data[:] = 1
+
+        # first table position of every association, the order PKG adds the edges in
+        self._medi_positions = {}
+        for position, pair in enumerate(zip(medi["rxcui"], medi["icd_code"])):
+            self._medi_positions.setdefault(pair, position)
+        self._icd_positions = {}
+        for position, (disease1, disease2) in enumerate(zip(icd["disease1"], icd["disease2"]), len(medi)):
+            self._icd_positions.setdefault(tuple(sorted((disease1, disease2))), position)
+
+        self._matrices = D, G, O, A, S
+        return self._matrices
+
+    def aggregator(self, weights: dict = None) -> EdgeAggregator:
+        """
+        Edge and node counts of the cohort, as an EdgeAggregator over the patient graphs counts them.
+
+        Nodes, edges and their colors are in the order of an EdgeAggregator that adds the patient graphs in the order
+        of the weights (first appearance in the sample for a Counter), the tables equal those of the patient graphs.
+
+        :param weights: dict of patient id to times sampled in sample order, patients not in it are left out,
+            default every patient once in the order they were added
+        """
+        with profiler.stage('matrix.build'):
+            D, G, O, A, S = self._build()
+
+        weights = dict.fromkeys(self.patient_ids, 1) if weights is None else weights
+        # rows in sample order, the first row with an edge is the patient it is first counted from
+        sampled = [(self._positions[patient_id], weight) for patient_id, weight in weights.items()
+            if weight > 0 and patient_id in self._positions]
+        rows = np.array([row for row, _ in sampled], dtype=np.int64)
+        w = np.array([weight for _, weight in sampled], dtype=np.int64)
+        D, G, O = D[rows], G[rows], O[rows]
+        drug_ids, diag_ids = self._drug_ids[rows], self._diag_ids[rows]
+
+        with profiler.stage('matrix.count'):
+            WG = sparse.diags(w) @ G
+            mdas = (D.T @ WG).multiply(A).tocoo()
+            ddas = sparse.triu((G.T @ WG).multiply(S), k=1).tocoo()
+
+        drugs, diags = self.drug_index.values, self.diag_index.values
+        edges = pd.DataFrame({
+            'code1': np.concatenate([drugs[mdas.row], diags[ddas.row]]),
+            'code2': np.concatenate([diags[mdas.col], diags[ddas.col]]),
+            'type': np.concatenate([np.full(mdas.nnz, MDA), np.full(ddas.nnz, DDA)]).astype(np.uint8),
+            'count': np.concatenate([mdas.data, ddas.data]).astype(np.int64),
+        })
+        with profiler.stage('matrix.order'):
+            edges['first'] = np.concatenate([_first_rows(D, G, mdas.row, mdas.col), _first_rows(G, G, ddas.row, ddas.col)])
+        edges['position'] = np.array(
+            [self._medi_positions[pair] for pair in zip(drugs[mdas.row], diags[mdas.col])]
+            + [self._icd_positions[pair] for pair in zip(diags[ddas.row], diags[ddas.col])], dtype=np.int64)
+        swap = (edges['code1'] > edges['code2']).values
+        edges['node1'] = np.where(swap, edges['code2'], edges['code1'])
+        edges['node2'] = np.where(swap, edges['code1'], edges['code2'])
+
+        # a code that is a drug and a diagnosis can give two edges between the same nodes (e.g. drug-diag and
+        # diag-diag), a patient graph has one edge there: counted again per patient
+        shared = edges.duplicated(['node1', 'node2'], keep=False).values
+        exact = [self._shared_edge(node1, node2, D, G, A, S, w)
+            for node1, node2 in edges.loc[shared, ['node1', 'node2']].drop_duplicates().itertuples(index=False, name=None)]
+        edges = pd.concat([edges[~shared], pd.DataFrame(exact, columns=['node1', 'node2', 'type', 'count', 'first', 'position'])])
+
+        # PKG stores an edge as (smaller node id, larger node id) in the order it adds them, and the patient
+        # graph yields them by smaller node id
+        first = edges['first'].values.astype(np.int64)
+        ids1 = self._patient_node_ids(drug_ids, diag_ids, first, edges['node1'].values)
+        ids2 = self._patient_node_ids(drug_ids, diag_ids, first, edges['node2'].values)
+        edges['id'] = np.minimum(ids1, ids2)
+        edges['smaller'] = np.where(ids1 <= ids2, edges['node1'], edges['node2'])
+        edges['larger'] = np.where(ids1 <= ids2, edges['node2'], edges['node1'])
+        edges = edges.sort_values(['first', 'id', 'position']).reset_index(drop=True)
+
+        nodes = pd.Index(pd.unique(edges[['smaller', 'larger']].values.ravel()), dtype=object)
+        node_colors = [NODE_COLORS[self._node_type(node, D, G, O, A, S)] for node in nodes]
+        profiler.count('matrix.edges', len(edges))
+
+        return EdgeAggregator.from_counts(nodes, node_colors,
+            np.stack([nodes.get_indexer(edges['node1']), nodes.get_indexer(edges['node2'])], axis=1).tolist(),
+            [EDGE_COLORS[edge_type] for edge_type in edges['type']], edges['count'].values, int(w.sum()))
+
+    def _shared_edge(self, node1, node2, D, G, A, S, w):
+        """
+        (node1, node2, type, count, first row, table position) of an edge with several literature associations,
+        type and position as in the first patient
+        """
+        drug_index, diag_index = self.drug_index, self.diag_index
+        terms = []
+        for drug, diag in [(node1, node2), (node2, node1)]:
+            if drug in drug_index and diag in diag_index and A[drug_index.get_loc(drug), diag_index.get_loc(diag)]:
+                terms.append((MDA, _column(D, drug_index, drug) & _column(G, diag_index, diag), self._medi_positions[(drug, diag)]))
+        if node1 != node2 and node1 in diag_index and node2 in diag_index and S[diag_index.get_loc(node1), diag_index.get_loc(node2)]:
+            terms.append((DDA, _column(G, diag_index, node1) & _column(G, diag_index, node2), self._icd_positions[(node1, node2)]))
+
+        present = np.logical_or.reduce([patients for _, patients, _ in terms])
+        # diag-diag edges are added after drug-diag edges in PKG and win, the edge keeps the place it was added at
+        first = int(np.argmax(present))
+        edge_type = DDA if any(edge_type == DDA and patients[first] for edge_type, patients, _ in terms) else MDA
+        position = min(position for _, patients, position in terms if patients[first])
+        return node1, node2, edge_type, int(w[present].sum()), first, position
+
+    def _patient_node_ids(self, drug_ids, diag_ids, rows, codes) -> np.ndarray:
+        """ Node id of every code in the PKG of the patient of its row """
+        ids = np.full(len(codes), -1, dtype=np.int64)
+        for index, patient_ids in [(self.drug_index, drug_ids), (self.diag_index, diag_ids)]:
+            columns = index.get_indexer(np.asarray(codes, dtype=object))
+            missing = (ids < 0) & (columns >= 0)
+            if missing.any():
+                ids[missing] = np.asarray(patient_ids[rows[missing], columns[missing]]).ravel() - 1
+        return ids
+
+    def _node_type(self, node, D, G, O, A, S) -> int:
+        """ Type of the node in the first patient graph with an edge of it, DIAG if that patient has it as diagnosis """
+        if node not in self.drug_index:
+            return DIAG
+        diagnosed = _column(O, self.drug_index, node)
+        if not diagnosed.any():
+            return DRUG
+
+        drug = self.drug_index.get_loc(node)
+        in_edge = _column(D, self.drug_index, node) & ((G @ A[drug, :].T).toarray().ravel() > 0)
+        if node in self.diag_index:
+            diag = self.diag_index.get_loc(node)
+            in_edge |= _column(G, self.diag_index, node) & (
+                ((D @ A[:, diag]).toarray().ravel() > 0) | ((G @ S[:, diag]).toarray().ravel() > 0))
+        return DIAG if diagnosed[np.argmax(in_edge)] else DRUG
+
+
+def edge_statistics(edges: pd.DataFrame, num_patients: int, background_edges: pd.DataFrame, num_background: int) -> pd.DataFrame:
+    """
+    Enrichment of the cohort edges against a background cohort.
+
+    lift is the edge frequency in the cohort over the background frequency, odds_ratio has 0.5 added to
+    every cell so edges missing in one cohort stay finite, p_value is the one-sided Fisher exact test
+    (hypergeometric) of the edge being more frequent in the cohort.
+
+    :param edges: EdgeAggregator.edge_table() of the cohort
+    :param background_edges: EdgeAggregator.edge_table() of the background cohort
+    """
+    stats = edges.merge(background_edges[['edge', 'count']].rename(columns={'count': 'background_count'}), on='edge', how='left')
+    stats['background_count'] = stats['background_count'].fillna(0).astype(np.int64)
+    stats[['node1', 'node2']] = stats['edge'].str.split('_', n=1, expand=True).reindex(columns=[0, 1]).values
+
+    a, b = stats['count'].values, stats['background_count'].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['lift'] = (a / num_patients) / (b / num_background)
+    stats['odds_ratio'] = ((a + 0.5) * (num_background - b + 0.5)) / ((num_patients - a + 0.5) * (b + 0.5))
+    stats['p_value'] = hypergeom.sf(a - 1, num_patients + num_background, a + b, num_patients)
+    return stats[['node1', 'node2', 'color', 'count', 'background_count', 'lift', 'odds_ratio', 'p_value']].sort_values('p_value')
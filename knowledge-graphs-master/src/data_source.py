@@ -0,0 +1,107 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+
+def _group_by_patient(table: pd.DataFrame, patient_ids: list) -> dict:
+    """Split a multi-patient table into one frame per patient (empty frame if no rows)"""
+    grouped = {
+        patient_id: frame.reset_index(drop=True)
+        for patient_id, frame in table.groupby("explorys_patient_id", sort=False)
+    }
+    empty = table.iloc[0:0]
+    return {patient_id: grouped.get(patient_id, empty) for patient_id in patient_ids}
+
+
+def _sample(patient_ids: list, count: int, seed: int = None) -> list:
+    """`count` distinct ids drawn without replacement from all patient ids, in random order"""
+    patient_ids = list(dict.fromkeys(patient_ids))
+    drawn = np.random.default_rng(seed).choice(len(patient_ids), min(count, len(patient_ids)), replace=False)
+    return [patient_ids[position] for position in drawn]
+
+
+def _since(frames: dict, since: dict) -> dict:
+    """Rows of each patient frame with new_date on or after the patient's date"""
+    return {
+        patient_id: frame[pd.to_datetime(frame["new_date"]).values >= np.datetime64(since[patient_id], "ns")].reset_index(drop=True)
+        for patient_id, frame in frames.items()
+    }
+
+
+class DataSource(ABC):
+    """Interface to the patient and literature tables the graphs are built from"""
+
+    @abstractmethod
+    def get_patient_ids(self, limit: int) -> list:
+        """Retrieve ids of the first `limit` patients"""
+
+    @abstractmethod
+    def sample_patient_ids(self, count: int, seed: int = None) -> list:
+        """Retrieve ids of `count` patients drawn at random from all patients, in random order"""
+
+    @abstractmethod
+    def get_drugs_bulk(self, patient_ids: list) -> dict:
+        """Get all prescriptions (with new_date) for a chunk of patients, dict of patient id to dataframe"""
+
+    @abstractmethod
+    def get_diags_bulk(self, patient_ids: list) -> dict:
+        """Get all diagnoses (with new_date) for a chunk of patients, dict of patient id to dataframe"""
+
+    @abstractmethod
+    def get_medi(self) -> pd.DataFrame:
+        """Get medi associations (rxcui, icd_code)"""
+
+    @abstractmethod
+    def get_icd_associations(self) -> pd.DataFrame:
+        """Retrieve associations between diseases (disease1, disease2)"""
+
+    @abstractmethod
+    def get_feature_patients(self, phewas_code: str) -> list:
+        """Retrieve list of unique patients diagnosed with any icd code mapped to given phewas code"""
+
+    @abstractmethod
+    def get_labels_bulk(self, nodes: list) -> dict:
+        """Retrieve names of many nodes, dict of node to name"""
+
+    def get_drugs(self, patient_id: int) -> pd.DataFrame:
+        """Get all prescriptions for one patient"""
+        return self.get_drugs_bulk([patient_id])[patient_id]
+
+    def get_diags(self, patient_id: int) -> pd.DataFrame:
+        """Get all diagnoses for one patient"""
+        return self.get_diags_bulk([patient_id])[patient_id]
+
+    def get_drugs_since(self, since: dict) -> dict:
+        """Prescriptions on or after a date per patient, dict of patient id to date -> dict of patient id to dataframe"""
+        return _since(self.get_drugs_bulk(list(since)), since)
+
+    def get_diags_since(self, since: dict) -> dict:
+        """Diagnoses on or after a date per patient, dict of patient id to date -> dict of patient id to dataframe"""
+        return _since(self.get_diags_bulk(list(since)), since)
+
+    def identity(self) -> str:
+        """Short id of the data behind the source, for cache file names"""
+        return type(self).__name__.lower()
+
+    def get_labels(self, node: str) -> str:
+        """Retrieve name of one node"""
+        return self.get_labels_bulk([node])[node]
+
+    def close(self) -> None:
+        """Release connections or files held by the source"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def open_source(source: str) -> DataSource:
+    """Data source: 'db' for the Postgres database, otherwise a data folder written by FileSource.export"""
+    if source == 'db':
+        from db_functions import DbHelper
+        return DbHelper()
+    from file_source import FileSource
+    return FileSource(source)
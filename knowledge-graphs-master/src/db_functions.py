@@ -1,41 +1,197 @@
+import hashlib
+import os
+import random
+import re
+from itertools import count
+
 import pandas as pd
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from pandas.api.types import union_categoricals
+
+from data_source import DataSource, _group_by_patient
+from profiling import profiler
+
+
+DSN = "dbname='coperimo' user='coperimo' host='localhost'"
+POOL_SIZE = 8    ## connections per process, raised by reserve_connections
+
+# names of the server-side cursors, unique per process
+_cursor_names = (f"stream_{i}" for i in count())
+
+# connection pool per process, connections are not shared with forked workers
+_pools = {}
+
+
+class _PreparedConnection(psycopg2.extensions.connection):
+    """Connection that remembers the statements prepared in its session"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Connection pool of this process, thread-safe for parallel fetches"""
+    pid = os.getpid()
+    if pid not in _pools:
+        _pools[pid] = psycopg2.pool.ThreadedConnectionPool(
+            1, POOL_SIZE, DSN, connection_factory=_PreparedConnection)
+    return _pools[pid]
+
+
+def reserve_connections(connections: int) -> None:
+    """Let the pool of this process hand out at least `connections` connections at once"""
+    global POOL_SIZE
+    POOL_SIZE = max(POOL_SIZE, connections)
+    pool = _pools.get(os.getpid())
+    if pool is not None:
+        pool.maxconn = max(pool.maxconn, connections)
 
 
-class DbHelper:
+def _prepared_statement(query: str):
+    """Statement name and PREPARE body ($n placeholders) of a query with %s parameters"""
+    name = "q_" + hashlib.md5(query.encode()).hexdigest()[:16]
+    numbers = count(1)
+    body = re.sub(r"%s", lambda _: f"${next(numbers)}", query.strip().rstrip(";"))
+    return name, body, next(numbers) - 1
+
+
+def _concat_chunks(chunks: list, categorical=()) -> pd.DataFrame:
+    """Concatenate streamed chunks, categorical columns are merged without decoding them to objects"""
+    if len(chunks) == 1:
+        return chunks[0]
+    table = pd.concat([chunk.drop(columns=list(categorical)) for chunk in chunks])
+    for column in categorical:
+        table[column] = union_categoricals([chunk[column].values for chunk in chunks])
+    return table[chunks[0].columns]
+
+
+class DbHelper(DataSource):
     """Class to manage queries and connection"""
 
     def __init__(self) -> None:
         self.conn = self._connect()
-        self._connect()
 
     def _connect(self):
-        """Private function to connect to db"""
-        return psycopg2.connect("dbname='coperimo' user='coperimo' host='localhost'")
+        """Private function to take a connection from the pool"""
+        return _pool().getconn()
 
-    def get_data(self, query: str):
-        """Get dataframe for specified query"""
-        cursor = self.conn.cursor()
-        cursor.execute(query)
-        table = cursor.fetchall()
+    def identity(self) -> str:
+        """Short id of the database, for cache file names"""
+        return "db-" + hashlib.md5(DSN.encode()).hexdigest()[:8]
+
+    def close(self) -> None:
+        """Give the connection back to the pool"""
+        if self.conn is not None:
+            _pool().putconn(self.conn)
+            self.conn = None
+
+    def _execute(self, cursor, query: str, params) -> None:
+        """Execute a parameterized query as a statement prepared once per connection"""
+        name, body, num_params = _prepared_statement(query)
+        if name not in self.conn.prepared:
+            cursor.execute(f"PREPARE {name} AS {body};")
+            self.conn.prepared.add(name)
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * num_params)});", params)
+
+    def get_data(self, query: str, params=None, chunk_size: int = None, categorical=()):
+        """
+        Get dataframe for specified query
+
+        :param chunk_size: stream the rows over a server-side cursor, chunk_size rows at a time
+        :param categorical: columns to decode as pandas categoricals
+        :return: pandas Dataframe
+        """
+        if chunk_size is not None:
+            return _concat_chunks(list(self.iter_data(query, params, chunk_size, categorical)), categorical)
+
+        with profiler.stage('db.query'):
+            cursor = self.conn.cursor()
+            try:
+                if params is None:
+                    cursor.execute(query)
+                else:
+                    self._execute(cursor, query, params)
+            except psycopg2.Error:
+                # leave the connection usable for the next query
+                self.conn.rollback()
+                raise
+            table = cursor.fetchall()
+        profiler.count('db.queries')
+        profiler.count('db.rows', len(table))
         df = pd.DataFrame(
             table, columns=[desc[0] for desc in cursor.description]
         ).dropna()
+        for column in categorical:
+            df[column] = df[column].astype('category')
         return df
 
+    def iter_data(self, query: str, params=None, chunk_size: int = 50000, categorical=()):
+        """
+        Stream the result of a query as dataframes of at most chunk_size rows, over a server-side cursor.
+
+        Rows keep the index they would have in get_data, at least one (maybe empty) dataframe is yielded.
+
+        :param chunk_size: rows fetched per round trip and per dataframe
+        :param categorical: columns to decode as pandas categoricals
+        """
+        try:
+            with self.conn.cursor(name=next(_cursor_names)) as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(query, params)
+                profiler.count('db.queries')
+                offset = 0
+                while True:
+                    with profiler.stage('db.query'):
+                        rows = cursor.fetchmany(chunk_size)
+                    profiler.count('db.rows', len(rows))
+                    df = pd.DataFrame(
+                        rows, columns=[desc[0] for desc in cursor.description],
+                        index=pd.RangeIndex(offset, offset + len(rows)),
+                    ).dropna()
+                    for column in categorical:
+                        df[column] = df[column].astype('category')
+                    if rows or offset == 0:
+                        yield df
+                    if len(rows) < chunk_size:
+                        break
+                    offset += len(rows)
+        except psycopg2.Error:
+            # leave the connection usable for the next query
+            self.conn.rollback()
+            raise
+
+    def get_patient_ids(self, limit: int) -> list:
+        """Retrieve ids of the first `limit` patients"""
+        patients = self.get_data("SELECT explorys_patient_id FROM ml_covid_joined_id LIMIT %s;", (limit,))
+        return list(patients.explorys_patient_id.values)
+
+    def sample_patient_ids(self, count: int, seed: int = None) -> list:
+        """Retrieve ids of `count` patients drawn at random from all patients, seeded through setseed"""
+        if seed is not None:
+            # setseed takes a value in [-1, 1], random() of the session repeats after it
+            self.get_data("SELECT setseed(%s);", (random.Random(seed).uniform(-1, 1),))
+        patients = self.get_data(
+            "SELECT explorys_patient_id FROM (SELECT DISTINCT explorys_patient_id FROM ml_covid_joined_id) AS patients "
+            "ORDER BY random() LIMIT %s;", (count,))
+        return list(patients.explorys_patient_id.values)
+
     def get_drugs(self, patient_id: int) -> pd.DataFrame:
         """Get dataframe for specified query"""
         return self.get_data(
-            f"""
+            """
             SELECT *, DATE(prescription_date) AS new_date FROM
             (SELECT explorys_patient_id, rx_cui, prescription_date, ingredient_descriptions
             FROM v_drug
-            WHERE explorys_patient_id = {patient_id}
+            WHERE explorys_patient_id = %s
             UNION ALL
             SELECT explorys_patient_id, rx_cui, prescription_date, ingredient_descriptions
             FROM v_drug_new
-            WHERE explorys_patient_id = {patient_id}) foo ORDER BY prescription_date;
-            """
+            WHERE explorys_patient_id = %s) foo ORDER BY prescription_date;
+            """,
+            (int(patient_id), int(patient_id)),
         )
 
     def get_diags(self, patient_id: int) -> pd.DataFrame:
@@ -46,17 +202,118 @@ class DbHelper:
         :return: pandas Dataframe
         """
         return self.get_data(
-            f"""
+            """
             SELECT *, DATE(diagnosis_date) AS new_date FROM
             (SELECT explorys_patient_id, icd_code, icd_version, diagnosis_date
             FROM v_diagnosis
-            WHERE explorys_patient_id = {patient_id}
+            WHERE explorys_patient_id = %s
             UNION ALL
             SELECT explorys_patient_id, icd_code, icd_version, diagnosis_date
             FROM v_diagnosis_new
-            WHERE explorys_patient_id = {patient_id}) bar ORDER BY diagnosis_date;
+            WHERE explorys_patient_id = %s) bar ORDER BY diagnosis_date;
+            """,
+            (int(patient_id), int(patient_id)),
+        )
+
+    def get_drugs_bulk(self, patient_ids: list) -> dict:
+        """
+        Get all prescriptions for a chunk of patients in one query
+
+        :param patient_ids: list of patient ids
+        :return: dict of patient id to pandas Dataframe
+        """
+        ids = [int(patient_id) for patient_id in patient_ids]
+        drugs = self.get_data(
             """
+            SELECT *, DATE(prescription_date) AS new_date FROM
+            (SELECT explorys_patient_id, rx_cui, prescription_date, ingredient_descriptions
+            FROM v_drug
+            WHERE explorys_patient_id = ANY(%s)
+            UNION ALL
+            SELECT explorys_patient_id, rx_cui, prescription_date, ingredient_descriptions
+            FROM v_drug_new
+            WHERE explorys_patient_id = ANY(%s)) foo ORDER BY explorys_patient_id, prescription_date;
+            """,
+            (ids, ids),
         )
+        return _group_by_patient(drugs, patient_ids)
+
+    def get_diags_bulk(self, patient_ids: list) -> dict:
+        """
+        Get all diagnoses for a chunk of patients in one query
+
+        :param patient_ids: list of patient ids
+        :return: dict of patient id to pandas Dataframe
+        """
+        ids = [int(patient_id) for patient_id in patient_ids]
+        diags = self.get_data(
+            """
+            SELECT *, DATE(diagnosis_date) AS new_date FROM
+            (SELECT explorys_patient_id, icd_code, icd_version, diagnosis_date
+            FROM v_diagnosis
+            WHERE explorys_patient_id = ANY(%s)
+            UNION ALL
+            SELECT explorys_patient_id, icd_code, icd_version, diagnosis_date
+            FROM v_diagnosis_new
+            WHERE explorys_patient_id = ANY(%s)) bar ORDER BY explorys_patient_id, diagnosis_date;
+            """,
+            (ids, ids),
+        )
+        return _group_by_patient(diags, patient_ids)
+
+    def get_drugs_since(self, since: dict) -> dict:
+        """
+        Get the prescriptions of a chunk of patients from a date on, in one query
+
+        :param since: dict of patient id to first date
+        :return: dict of patient id to pandas Dataframe
+        """
+        ids = [int(patient_id) for patient_id in since]
+        dates = [pd.Timestamp(date).date() for date in since.values()]
+        drugs = self.get_data(
+            """
+            SELECT foo.*, DATE(foo.prescription_date) AS new_date FROM
+            (SELECT explorys_patient_id, rx_cui, prescription_date, ingredient_descriptions
+            FROM v_drug
+            WHERE explorys_patient_id = ANY(%s)
+            UNION ALL
+            SELECT explorys_patient_id, rx_cui, prescription_date, ingredient_descriptions
+            FROM v_drug_new
+            WHERE explorys_patient_id = ANY(%s)) foo
+            JOIN UNNEST(%s::bigint[], %s::date[]) AS w(patient_id, since)
+            ON foo.explorys_patient_id = w.patient_id AND DATE(foo.prescription_date) >= w.since
+            ORDER BY foo.explorys_patient_id, foo.prescription_date;
+            """,
+            (ids, ids, ids, dates),
+        )
+        return _group_by_patient(drugs, list(since))
+
+    def get_diags_since(self, since: dict) -> dict:
+        """
+        Get the diagnoses of a chunk of patients from a date on, in one query
+
+        :param since: dict of patient id to first date
+        :return: dict of patient id to pandas Dataframe
+        """
+        ids = [int(patient_id) for patient_id in since]
+        dates = [pd.Timestamp(date).date() for date in since.values()]
+        diags = self.get_data(
+            """
+            SELECT bar.*, DATE(bar.diagnosis_date) AS new_date FROM
+            (SELECT explorys_patient_id, icd_code, icd_version, diagnosis_date
+            FROM v_diagnosis
+            WHERE explorys_patient_id = ANY(%s)
+            UNION ALL
+            SELECT explorys_patient_id, icd_code, icd_version, diagnosis_date
+            FROM v_diagnosis_new
+            WHERE explorys_patient_id = ANY(%s)) bar
+            JOIN UNNEST(%s::bigint[], %s::date[]) AS w(patient_id, since)
+            ON bar.explorys_patient_id = w.patient_id AND DATE(bar.diagnosis_date) >= w.since
+            ORDER BY bar.explorys_patient_id, bar.diagnosis_date;
+            """,
+            (ids, ids, ids, dates),
+        )
+        return _group_by_patient(diags, list(since))
 
     def get_shared_drugs(self, patient_id: int) -> pd.DataFrame:
         """
@@ -66,13 +323,14 @@ class DbHelper:
         :return: pandas.DataFrame
         """
         return self.get_data(
-            f"""
+            """
             SELECT * FROM
-            (SELECT rx_cui FROM v_drug WHERE explorys_patient_id = {patient_id}
+            (SELECT rx_cui FROM v_drug WHERE explorys_patient_id = %s
             UNION ALL
-            SELECT rx_cui FROM v_drug_new WHERE explorys_patient_id = {patient_id}) foo
+            SELECT rx_cui FROM v_drug_new WHERE explorys_patient_id = %s) foo
             WHERE rx_cui IN (SELECT rxcui FROM ka_medi_associations);
-            """
+            """,
+            (int(patient_id), int(patient_id)),
         )
 
     def get_medi_diags(self, patient_id: int) -> pd.DataFrame:
@@ -83,13 +341,14 @@ class DbHelper:
         :return: pandas.DataFrame
         """
         return self.get_data(
-            f"""
+            """
             SELECT * FROM
-            (SELECT icd_code FROM v_diagnosis WHERE explorys_patient_id = {patient_id}
+            (SELECT icd_code FROM v_diagnosis WHERE explorys_patient_id = %s
             UNION ALL
-            SELECT icd_code FROM v_diagnosis_new WHERE explorys_patient_id = {patient_id}) foo
+            SELECT icd_code FROM v_diagnosis_new WHERE explorys_patient_id = %s) foo
             WHERE(icd_code IN (SELECT icd_code FROM ka_disgenet_associations));
-            """
+            """,
+            (int(patient_id), int(patient_id)),
         )
 
     def get_disgenet_diags(self, patient_id: int) -> pd.DataFrame:
@@ -100,55 +359,94 @@ class DbHelper:
         :return: pandas.DataFrame
         """
         return self.get_data(
-            f"""
+            """
             SELECT * FROM
-            (SELECT icd_code FROM v_diagnosis WHERE explorys_patient_id = {patient_id}
+            (SELECT icd_code FROM v_diagnosis WHERE explorys_patient_id = %s
             UNION ALL
-            SELECT icd_code FROM v_diagnosis_new WHERE explorys_patient_id = {patient_id}) AS kd
+            SELECT icd_code FROM v_diagnosis_new WHERE explorys_patient_id = %s) AS kd
             JOIN ka_disgenet_mappings AS kdm
             ON kd.icd_code = kdm.icd_code
             WHERE kd.icd_code IN (SELECT icd_code FROM ka_disgenet_mappings);
-            """
+            """,
+            (int(patient_id), int(patient_id)),
         )
 
     def get_medi(self) -> pd.DataFrame:
         """Get media association"""
-        return self.get_data("SELECT * FROM ka_medi_associations;")
+        return self.get_data("SELECT * FROM ka_medi_associations;", chunk_size=50000, categorical=("rxcui", "icd_code"))
 
     def get_dda(self) -> pd.DataFrame:
         """Retrieve DisGeNet associations"""
-        return self.get_data("SELECT * FROM ka_disgenet_associations;")
+        return self.get_data("SELECT * FROM ka_disgenet_associations;", chunk_size=50000)
 
     def get_dda_mappings(self) -> pd.DataFrame:
         """Retrieve DisGeNet mappings"""
-        return self.get_data("SELECT * FROM ka_disgenet_mappings;")
+        return self.get_data("SELECT * FROM ka_disgenet_mappings;", chunk_size=50000)
     
     # new additions
     def get_icd_associations(self) -> pd.DataFrame:
         """Retrieve associations between diseases (icd) based on disgenet data"""
-        return self.get_data("SELECT * FROM ka_icd_associations;")
+        return self.get_data("SELECT * FROM ka_icd_associations;", chunk_size=50000, categorical=("disease1", "disease2"))
 
     def get_features(self, phewas_code:str) -> list:
         """Retrieve list of icd codes mapped to given phewas code."""
-        mapped_icds = self.get_data(f"""SELECT icd_code FROM icd_phewas WHERE phewas_code = '{phewas_code}';""")
+        mapped_icds = self.get_data("""SELECT icd_code FROM icd_phewas WHERE phewas_code = %s;""", (phewas_code,))
         return list(mapped_icds.icd_code.values)
 
+    def get_feature_patients(self, phewas_code:str) -> list:
+        """Retrieve list of unique patients diagnosed with any icd code mapped to given phewas code."""
+        # cohorts can be large, only the id column of each chunk is kept
+        chunks = self.iter_data(
+            """
+            SELECT DISTINCT vdc.explorys_patient_id
+            FROM icd_phewas AS ip
+            JOIN v_diagnosis_covid AS vdc
+            ON ip.icd_code = vdc.icd_code
+            WHERE ip.phewas_code = %s
+            ORDER BY vdc.explorys_patient_id;
+            """,
+            (phewas_code,),
+        )
+        return [patient_id for chunk in chunks for patient_id in chunk.explorys_patient_id.values]
+
     def get_patient_list(self, icd_code:str) -> list:
         """Retrieve list of patients diagnosed with specific disease (icd)."""
-        patients = self.get_data(f"""SELECT explorys_patient_id FROM v_diagnosis_covid WHERE icd_code = '{icd_code}';""")
+        patients = self.get_data("""SELECT explorys_patient_id FROM v_diagnosis_covid WHERE icd_code = %s;""", (icd_code,))
         return list(patients.drop_duplicates().explorys_patient_id.values)
     
-    def get_labels(self, node:str) -> str:
-        """ Retrieve names of the nodes. """
-        label = self.get_data(f""" SELECT drug_name FROM ka_medi_drugs WHERE rxcui='{node}'""").drug_name.values
-        if len(label) != 0:
-            return label[0] 
-        else:
-            label = self.get_data(f""" SELECT diagnosis_name FROM ka_medi_diagnosis WHERE icd_code='{node}'""").diagnosis_name.values
-            if len(label) != 0:
-                return label[0]
-            else:
-                dnet_id = self.get_data(f""" SELECT disease_id FROM ka_disgenet_mappings WHERE icd_code='{node}'""").disease_id.values
-                if len(dnet_id) != 0:
-                    label = self.get_data(f""" SELECT disease_name FROM ka_disgenet_labels WHERE disease_id='{dnet_id[0]}'""").disease_name.values
-                    return label[0] if len(label) != 0 else node
+    def get_labels_bulk(self, nodes: list) -> dict:
+        """
+        Retrieve names of many nodes in at most four queries.
+
+        Names are looked up in medi drugs, then medi diagnoses, then disgenet; nodes without a name keep their code.
+
+        :param nodes: list of node codes
+        :return: dict of node to name
+        """
+        codes = {str(node): node for node in nodes}
+        names = {}
+
+        def lookup(query, remaining):
+            table = self.get_data(query, (list(remaining),))
+            return dict(table.drop_duplicates(table.columns[0]).astype(str).values)
+
+        names.update(lookup(
+            """SELECT CAST(rxcui AS TEXT), drug_name FROM ka_medi_drugs WHERE CAST(rxcui AS TEXT) = ANY(%s);""",
+            codes))
+        remaining = [code for code in codes if code not in names]
+        if remaining:
+            names.update(lookup(
+                """SELECT icd_code, diagnosis_name FROM ka_medi_diagnosis WHERE icd_code = ANY(%s);""",
+                remaining))
+        remaining = [code for code in codes if code not in names]
+        if remaining:
+            dnet_ids = lookup(
+                """SELECT icd_code, disease_id FROM ka_disgenet_mappings WHERE icd_code = ANY(%s);""",
+                remaining)
+            if dnet_ids:
+                dnet_names = lookup(
+                    """SELECT disease_id, disease_name FROM ka_disgenet_labels WHERE disease_id = ANY(%s);""",
+                    set(dnet_ids.values()))
+                names.update({code: dnet_names[dnet_id] for code, dnet_id in dnet_ids.items() if dnet_id in dnet_names})
+
+        return {node: names.get(code, node) for code, node in codes.items()}
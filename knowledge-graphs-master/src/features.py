@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from make_graph import FOUND
+from profiling import profiler
+
+
+NODE_KINDS = ['drug', 'diag']    ## feature kind of a node, by node type
+
+
+def graph_features(graph) -> dict:
+    """
+    Features of one patient graph, name -> value, zeros left out.
+
+    drug:<code> / diag:<code>   node present (as drug or diagnosis)
+    degree:<code>               number of literature edges of the node
+    found:<code1>_<code2>       found edge, codes in edge list order
+    stat:<name>                 nodes, edges, found_edges, components, largest_component, isolates, max_degree
+    """
+    num_nodes = len(graph.nodes)
+    degrees = np.bincount(graph.edges.ravel(), minlength=num_nodes)
+    found = np.flatnonzero(graph.edge_states & FOUND)
+
+    features = {f"{NODE_KINDS[node_type]}:{node}": 1.0 for node, node_type in zip(graph.nodes, graph.node_types)}
+    features.update((f"degree:{node}", float(degree)) for node, degree in zip(graph.nodes, degrees) if degree)
+    for u, v in graph.edges[found]:
+        features["found:{}_{}".format(*sorted((str(graph.nodes[u]), str(graph.nodes[v]))))] = 1.0
+
+    # components with isolated nodes, each isolate is a component
+    adjacency = sparse.coo_matrix((np.ones(len(graph.edges)), (graph.edges[:, 0], graph.edges[:, 1])), shape=(num_nodes, num_nodes))
+    num_components, labels = connected_components(adjacency, directed=False)
+    stats = {
+        'nodes': num_nodes,
+        'edges': len(graph.edges),
+        'found_edges': len(found),
+        'components': num_components,
+        'largest_component': np.bincount(labels).max() if num_nodes else 0,
+        'isolates': int((degrees == 0).sum()),
+        'max_degree': degrees.max() if num_nodes else 0,
+    }
+    features.update((f"stat:{name}", float(value)) for name, value in stats.items() if value)
+    return features
+
+
+class FeatureMatrix:
+    """
+    Sparse patients x features matrix of a cohort, added chunk by chunk and never densified.
+
+    Columns get ids in order of first appearance while chunks are added, to_csr() orders them by name so the
+    vocabulary does not depend on the patient order. With a given vocabulary (e.g. of the training cohort),
+    its columns are kept in its order and other features are left out.
+    """
+
+    def __init__(self, vocabulary: list = None) -> None:
+        self.fixed = vocabulary is not None
+        self.vocabulary = {name: i for i, name in enumerate(vocabulary or [])}
+        self.patient_ids = []
+        self._chunks = []    ## (data, indices, row lengths) per chunk
+
+    def add_chunk(self, rows) -> None:
+        """ Add [(patient_id, features)] of a chunk """
+        data, indices, lengths = [], [], []
+        for patient_id, features in rows:
+            self.patient_ids.append(patient_id)
+            start = len(indices)
+            for name, value in features.items():
+                column = self.vocabulary.get(name)
+                if column is None:
+                    if self.fixed:
+                        continue
+                    column = self.vocabulary[name] = len(self.vocabulary)
+                indices.append(column)
+                data.append(value)
+            lengths.append(len(indices) - start)
+        self._chunks.append((np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32),
+            np.asarray(lengths, dtype=np.int64)))
+
+    def to_csr(self):
+        """ (CSR matrix of patients x features, feature names in column order) """
+        names = list(self.vocabulary)
+        order = np.arange(len(names)) if self.fixed else np.argsort(np.array(names, dtype=object), kind="stable")
+        columns = np.empty(len(names), dtype=np.int32)
+        columns[order] = np.arange(len(names), dtype=np.int32)
+
+        data = np.concatenate([chunk[0] for chunk in self._chunks]) if self._chunks else np.zeros(0, dtype=np.float32)
+        indices = np.concatenate([chunk[1] for chunk in self._chunks]) if self._chunks else np.zeros(0, dtype=np.int32)
+        lengths = np.concatenate([chunk[2] for chunk in self._chunks]) if self._chunks else np.zeros(0, dtype=np.int64)
+        matrix = sparse.csr_matrix((data, columns[indices], np.concatenate([[0], np.cumsum(lengths)])),
+            shape=(len(self.patient_ids), len(names)))
+        matrix.sort_indices()
+        return matrix, [names[i] for i in order]
+
+    def save(self, prefix: str) -> None:
+        """
+        Store <prefix>.npz (scipy CSR matrix), <prefix>_features.parquet (column, feature, kind)
+        and <prefix>_patients.parquet (row, explorys_patient_id)
+        """
+        with profiler.stage('features.save'):
+            matrix, names = self.to_csr()
+            sparse.save_npz(f"{prefix}.npz", matrix)
+            pd.DataFrame({
+                'column': np.arange(len(names)),
+                'feature': names,
+                'kind': [name.split(':', 1)[0] for name in names],
+            }).to_parquet(f"{prefix}_features.parquet", index=False)
+            pd.DataFrame({
+                'row': np.arange(len(self.patient_ids)),
+                'explorys_patient_id': np.asarray(self.patient_ids, dtype=np.int64),
+            }).to_parquet(f"{prefix}_patients.parquet", index=False)
+
+
+def load_features(prefix: str):
+    """ (CSR matrix, feature names, patient ids) stored by FeatureMatrix.save """
+    features = pd.read_parquet(f"{prefix}_features.parquet")
+    patients = pd.read_parquet(f"{prefix}_patients.parquet")
+    return sparse.load_npz(f"{prefix}.npz"), features.feature.tolist(), patients.explorys_patient_id.tolist()
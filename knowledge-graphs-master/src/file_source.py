@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from data_source import DataSource, _group_by_patient, _sample
+from profiling import profiler
+
+
+def _partition(patient_id, num_partitions: int) -> int:
+    return int(patient_id) % num_partitions
+
+
+class FileSource(DataSource):
+    """
+    Data source over local Parquet files, as a drop-in for DbHelper.
+
+    Layout of the data folder (written by FileSource.export):
+        manifest.json                   number of partitions
+        patients.parquet                explorys_patient_id, in DB order
+        drugs/part-NNNN.parquet         prescriptions, partitioned by patient id, sorted by patient and date
+        diagnoses/part-NNNN.parquet     diagnoses, partitioned the same way
+        medi_associations.parquet       rxcui, icd_code
+        icd_associations.parquet        disease1, disease2
+        feature_patients.parquet        phewas_code, explorys_patient_id
+        labels.parquet                  node, label
+    """
+
+    def __init__(self, data_dir: str) -> None:
+        self.data_dir = data_dir
+        with open(os.path.join(data_dir, 'manifest.json')) as f:
+            self.num_partitions = json.load(f)['num_partitions']
+
+    def identity(self) -> str:
+        return "files-" + hashlib.md5(os.path.abspath(self.data_dir).encode()).hexdigest()[:8]
+
+    def _path(self, *parts) -> str:
+        return os.path.join(self.data_dir, *parts)
+
+    def _read_patients(self, table: str, patient_ids: list) -> dict:
+        """Read the rows of the patients partition by partition"""
+        partitions = {}
+        for patient_id in patient_ids:
+            partitions.setdefault(_partition(patient_id, self.num_partitions), set()).add(int(patient_id))
+
+        with profiler.stage('file.read'):
+            frames = [
+                pd.read_parquet(
+                    self._path(table, f'part-{partition:04d}.parquet'),
+                    filters=[('explorys_patient_id', 'in', sorted(ids))],
+                )
+                for partition, ids in sorted(partitions.items())
+            ]
+            rows = pd.concat(frames, ignore_index=True) if frames else pd.read_parquet(self._path(table, 'part-0000.parquet'))
+        profiler.count('file.reads', len(frames))
+        profiler.count('file.rows', len(rows))
+        return _group_by_patient(rows, patient_ids)
+
+    def get_patient_ids(self, limit: int) -> list:
+        return list(pd.read_parquet(self._path('patients.parquet')).explorys_patient_id.values[:limit])
+
+    def sample_patient_ids(self, count: int, seed: int = None) -> list:
+        return _sample(pd.read_parquet(self._path('patients.parquet')).explorys_patient_id.tolist(), count, seed)
+
+    def get_drugs_bulk(self, patient_ids: list) -> dict:
+        return self._read_patients('drugs', patient_ids)
+
+    def get_diags_bulk(self, patient_ids: list) -> dict:
+        return self._read_patients('diagnoses', patient_ids)
+
+    def get_medi(self) -> pd.DataFrame:
+        return pd.read_parquet(self._path('medi_associations.parquet'))
+
+    def get_icd_associations(self) -> pd.DataFrame:
+        return pd.read_parquet(self._path('icd_associations.parquet'))
+
+    def get_feature_patients(self, phewas_code: str) -> list:
+        patients = pd.read_parquet(self._path('feature_patients.parquet'), filters=[('phewas_code', '==', phewas_code)])
+        return sorted(patients.explorys_patient_id.unique().tolist())
+
+    def get_labels_bulk(self, nodes: list) -> dict:
+        codes = [str(node) for node in nodes]
+        labels = pd.read_parquet(self._path('labels.parquet'), filters=[('node', 'in', codes)])
+        names = dict(zip(labels.node, labels.label))
+        return {node: names.get(str(node), node) for node in nodes}
+
+    @classmethod
+    def export(cls, source: DataSource, data_dir: str, patient_ids: list, phecodes: list = (),
+               num_partitions: int = 64, chunk_size: int = 500):
+        """
+        Copy the tables needed for the given patients and phecode cohorts from another source (DbHelper, or TableSource
+        over the table dumps and visit files).
+
+        :param source: data source to read from
+        :param data_dir: folder to write the Parquet files to
+        :param patient_ids: patients for 'pkgs', in order
+        :param phecodes: phecodes whose cohorts are exported for 'akgs'
+        :return: FileSource over the written folder
+        """
+        Path(data_dir, 'drugs').mkdir(exist_ok=True, parents=True)
+        Path(data_dir, 'diagnoses').mkdir(exist_ok=True, parents=True)
+
+        patient_ids = [int(patient_id) for patient_id in patient_ids]
+        pd.DataFrame({'explorys_patient_id': patient_ids}).to_parquet(os.path.join(data_dir, 'patients.parquet'))
+
+        feature_patients = pd.DataFrame(
+            [(phecode, int(patient_id)) for phecode in phecodes for patient_id in source.get_feature_patients(phecode)],
+            columns=['phewas_code', 'explorys_patient_id'],
+        )
+        feature_patients.to_parquet(os.path.join(data_dir, 'feature_patients.parquet'))
+
+        medi = source.get_medi()
+        icd_associations = source.get_icd_associations()
+        medi.to_parquet(os.path.join(data_dir, 'medi_associations.parquet'))
+        icd_associations.to_parquet(os.path.join(data_dir, 'icd_associations.parquet'))
+
+        all_patients = list(dict.fromkeys(patient_ids + feature_patients.explorys_patient_id.tolist()))
+        drugs, diags = [], []
+        for start in range(0, len(all_patients), chunk_size):
+            chunk = all_patients[start:start + chunk_size]
+            drugs.extend(source.get_drugs_bulk(chunk).values())
+            diags.extend(source.get_diags_bulk(chunk).values())
+
+        for table, frames in [('drugs', drugs), ('diagnoses', diags)]:
+            rows = pd.concat(frames, ignore_index=True)
+            partitions = rows.explorys_patient_id.map(lambda patient_id: _partition(patient_id, num_partitions))
+            for partition in range(num_partitions):
+                # every partition is written, also empty ones, so reads always find the columns
+                part = rows[partitions.values == partition].sort_values('explorys_patient_id', kind='stable')
+                part.to_parquet(os.path.join(data_dir, table, f'part-{partition:04d}.parquet'), index=False)
+
+        codes = pd.concat([medi.rxcui, medi.icd_code, icd_associations.disease1, icd_associations.disease2])
+        codes = codes.astype(str).unique().tolist()
+        labels = source.get_labels_bulk(codes)
+        pd.DataFrame({'node': list(labels), 'label': [str(label) for label in labels.values()]}).to_parquet(
+            os.path.join(data_dir, 'labels.parquet'))
+
+        with open(os.path.join(data_dir, 'manifest.json'), 'w') as f:
+            json.dump({'num_partitions': num_partitions}, f)
+
+        return cls(data_dir)
@@ -0,0 +1,235 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from make_graph import CompactGraph, NO_LAG
+
+
+NODE_DTYPE = np.dtype([('code', '<i4'), ('type', 'u1')])
+EDGE_DTYPE = np.dtype([('u', '<i4'), ('v', '<i4'), ('type', 'u1'), ('state', 'u1')])
+WATERMARK_DTYPE = np.dtype('<i4')    ## last processed visit date, days since 1970-01-01, -1 if unknown
+NO_WATERMARK = -1
+LAG_DTYPE = np.dtype('<i4')    ## smallest lag in days between the visits of an edge, NO_LAG if none
+INDEX_DTYPE = np.dtype([
+    ('patient_id', '<i8'),
+    ('node_offset', '<i8'), ('node_count', '<i4'),
+    ('edge_offset', '<i8'), ('edge_count', '<i4'),
+])
+
+
+class GraphStore:
+    """
+    Append-only store of the patient graphs of a cohort in one folder.
+
+    vocab.txt    node codes, the line number is the code id
+    nodes.bin    (code id, node type) per node, patient after patient
+    edges.bin    (node, node, edge type, state) per edge, nodes are positions in the patient's node list
+    index.bin    (patient_id, node offset, node count, edge offset, edge count) per stored graph
+    watermarks.bin  last visit date processed into each stored graph, one per index record
+    lags.bin     smallest lag in days of every edge, one per edge record
+
+    The tables are plain arrays, read memory-mapped. A patient appended again is superseded,
+    get() returns the latest graph while a scan yields every stored record.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        Path(path).mkdir(exist_ok=True, parents=True)
+
+        self.vocab = []
+        if os.path.exists(self._file('vocab.txt')):
+            with open(self._file('vocab.txt')) as f:
+                self.vocab = f.read().splitlines()
+        self._vocab_ids = {code: i for i, code in enumerate(self.vocab)}
+
+        self._pending = []
+        self._recovered = False
+        self._tables = None
+        self._watermarks = None
+        self._lags = None
+        self._latest = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read(self, name: str, dtype) -> np.ndarray:
+        file = self._file(name)
+        if not os.path.exists(file) or os.path.getsize(file) < dtype.itemsize:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file, dtype=dtype, mode='r', shape=(os.path.getsize(file) // dtype.itemsize,))
+
+    @property
+    def tables(self):
+        """ Memory-mapped (index, nodes, edges) """
+        if self._tables is None:
+            self._tables = (self._read('index.bin', INDEX_DTYPE), self._read('nodes.bin', NODE_DTYPE),
+                self._read('edges.bin', EDGE_DTYPE))
+        return self._tables
+
+    @property
+    def watermarks(self) -> np.ndarray:
+        """ Memory-mapped watermark per index record, may be shorter than the index for old stores """
+        if self._watermarks is None:
+            self._watermarks = self._read('watermarks.bin', WATERMARK_DTYPE)
+        return self._watermarks
+
+    @property
+    def lags(self) -> np.ndarray:
+        """ Memory-mapped lag per edge record, may be shorter than the edges for old stores """
+        if self._lags is None:
+            self._lags = self._read('lags.bin', LAG_DTYPE)
+        return self._lags
+
+    def _recover(self) -> None:
+        """ Drop node, edge, watermark and lag records written after the last index record (an interrupted flush). """
+        index = self.tables[0]
+        node_end = int(index['node_offset'][-1] + index['node_count'][-1]) if len(index) else 0
+        edge_end = int(index['edge_offset'][-1] + index['edge_count'][-1]) if len(index) else 0
+        num_records = len(index)
+        self._tables = None
+
+        # drop a partly written code, codes are identified by their line
+        if os.path.exists(self._file('vocab.txt')):
+            with open(self._file('vocab.txt'), 'rb+') as f:
+                f.truncate(f.read().rfind(b'\n') + 1)
+            with open(self._file('vocab.txt')) as f:
+                self.vocab = f.read().splitlines()
+            self._vocab_ids = {code: i for i, code in enumerate(self.vocab)}
+
+        for name, dtype, end in [('nodes.bin', NODE_DTYPE, node_end), ('edges.bin', EDGE_DTYPE, edge_end)]:
+            with open(self._file(name), 'ab') as f:
+                f.truncate(end * dtype.itemsize)
+
+        # stores written before watermarks and lags existed get unknown values for their records
+        for name, dtype, end, unknown in [('watermarks.bin', WATERMARK_DTYPE, num_records, NO_WATERMARK),
+                                          ('lags.bin', LAG_DTYPE, edge_end, NO_LAG)]:
+            with open(self._file(name), 'ab') as f:
+                missing = end - f.tell() // dtype.itemsize
+                if missing > 0:
+                    f.write(np.full(missing, unknown, dtype=dtype).tobytes())
+                else:
+                    f.truncate(end * dtype.itemsize)
+        self._watermarks = None
+        self._lags = None
+        self._recovered = True
+
+    def append(self, patient_id: int, graph: CompactGraph, watermark=None) -> None:
+        """ Add a patient graph, written with the next flush(). watermark is the last visit date in the graph. """
+        self._pending.append((int(patient_id), graph, watermark))
+
+    def flush(self) -> None:
+        """ Write the pending graphs. The index is written last, so a crash never leaves a half-stored graph. """
+        if not self._pending:
+            return
+        if not self._recovered:
+            self._recover()
+
+        index, nodes, edges = self.tables
+        node_offset = int(index['node_offset'][-1] + index['node_count'][-1]) if len(index) else 0
+        edge_offset = int(index['edge_offset'][-1] + index['edge_count'][-1]) if len(index) else 0
+
+        new_codes = []
+        node_records, edge_records, lag_records, index_records, watermarks = [], [], [], [], []
+        for patient_id, graph, watermark in self._pending:
+            codes = []
+            for node in graph.nodes:
+                code = str(node)
+                if code not in self._vocab_ids:
+                    self._vocab_ids[code] = len(self.vocab)
+                    self.vocab.append(code)
+                    new_codes.append(code)
+                codes.append(self._vocab_ids[code])
+
+            graph_nodes = np.zeros(len(codes), dtype=NODE_DTYPE)
+            graph_nodes['code'] = codes
+            graph_nodes['type'] = graph.node_types
+
+            graph_edges = np.zeros(len(graph.edges), dtype=EDGE_DTYPE)
+            graph_edges['u'] = graph.edges[:, 0]
+            graph_edges['v'] = graph.edges[:, 1]
+            graph_edges['type'] = graph.edge_types
+            graph_edges['state'] = graph.edge_states
+
+            node_records.append(graph_nodes)
+            edge_records.append(graph_edges)
+            lag_records.append(np.asarray(graph.edge_lags, dtype=LAG_DTYPE))
+            index_records.append((patient_id, node_offset, len(graph_nodes), edge_offset, len(graph_edges)))
+            watermarks.append(NO_WATERMARK if watermark is None
+                else np.datetime64(watermark, 'D').astype(np.int64))
+            node_offset += len(graph_nodes)
+            edge_offset += len(graph_edges)
+
+        with open(self._file('vocab.txt'), 'a') as f:
+            f.writelines(f"{code}\n" for code in new_codes)
+        with open(self._file('nodes.bin'), 'ab') as f:
+            f.write(np.concatenate(node_records).tobytes())
+        with open(self._file('edges.bin'), 'ab') as f:
+            f.write(np.concatenate(edge_records).tobytes())
+        with open(self._file('lags.bin'), 'ab') as f:
+            f.write(np.concatenate(lag_records).tobytes())
+        with open(self._file('watermarks.bin'), 'ab') as f:
+            f.write(np.array(watermarks, dtype=WATERMARK_DTYPE).tobytes())
+        with open(self._file('index.bin'), 'ab') as f:
+            f.write(np.array(index_records, dtype=INDEX_DTYPE).tobytes())
+
+        self._pending = []
+        self._tables = None
+        self._watermarks = None
+        self._lags = None
+        self._latest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self.tables[0])
+
+    def patient_ids(self) -> np.ndarray:
+        """ Patient ids of all stored records, in write order """
+        return np.asarray(self.tables[0]['patient_id'])
+
+    def _graph(self, record) -> CompactGraph:
+        _, nodes, edges = self.tables
+        graph_nodes = nodes[record['node_offset']:record['node_offset'] + record['node_count']]
+        graph_edges = edges[record['edge_offset']:record['edge_offset'] + record['edge_count']]
+        graph_lags = np.full(len(graph_edges), NO_LAG, dtype=LAG_DTYPE)
+        lags = self.lags[record['edge_offset']:record['edge_offset'] + record['edge_count']]
+        graph_lags[:len(lags)] = lags
+        # copies, the graph does not keep the files mapped
+        return CompactGraph(
+            [self.vocab[code] for code in graph_nodes['code']],
+            np.array(graph_nodes['type']),
+            np.stack([graph_edges['u'], graph_edges['v']], axis=1),
+            np.array(graph_edges['type']),
+            np.array(graph_edges['state']),
+            graph_lags,
+        )
+
+    def _latest_records(self) -> dict:
+        """ Position of the latest record of every patient """
+        if self._latest is None:
+            self._latest = {int(patient_id): i for i, patient_id in enumerate(self.patient_ids())}
+        return self._latest
+
+    def get(self, patient_id: int) -> CompactGraph:
+        """ Latest stored graph of one patient """
+        return self._graph(self.tables[0][self._latest_records()[int(patient_id)]])
+
+    def watermark(self, patient_id: int):
+        """ Last visit date processed into the latest graph of a patient, None if unknown """
+        position = self._latest_records()[int(patient_id)]
+        if position >= len(self.watermarks) or self.watermarks[position] == NO_WATERMARK:
+            return None
+        return np.datetime64(int(self.watermarks[position]), 'D')
+
+    def __contains__(self, patient_id) -> bool:
+        return int(patient_id) in self._latest_records()
+
+    def __iter__(self):
+        """ Stream (patient_id, CompactGraph) over all stored records """
+        for record in self.tables[0]:
+            yield int(record['patient_id']), self._graph(record)
@@ -1,12 +1,19 @@
 # script for imporatant features
 # for averaged KGs
 
+import os
+from pathlib import Path
+
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import networkx as nx
+import numpy as np
 import pandas as pd
 
 from db_functions import DbHelper
+from labels import LabelResolver
+from layout import LayoutCache
+from profiling import profiler
 
 
 # class ImpFeatures:
@@ -26,17 +33,27 @@ from db_functions import DbHelper
 
 #db_helper = DbHelper()
 
-def unique_feature_patients(phe_code: str, db_helper) -> set:
-    """ Gest list of unique patients with specific feature. """
-    icd_list = db_helper.get_features(phe_code)
-    unique_patients = set()
-    for icd in icd_list:
-        patients = db_helper.get_patient_list(icd)
-        unique_patients.update(patients)
-    return list(unique_patients)
-
-def create_akg(node_list: pd.DataFrame, edge_list: pd.DataFrame, db_helper, labels: bool = True):
-    """ Creates an averaged knowledge graph. """
+def unique_feature_patients(phe_code: str, db_helper, cache_dir: str = None, refresh: bool = False) -> list:
+    """
+    Gets list of unique patients with specific feature, cached as .npy in cache_dir if given.
+
+    The cache file is named by the phecode and the identity of the data source, refresh queries the cohort again.
+    """
+    if cache_dir is None:
+        return db_helper.get_feature_patients(phe_code)
+
+    cache_file = os.path.join(cache_dir, f"{phe_code}_{db_helper.identity()}_patients.npy")
+    if os.path.exists(cache_file) and not refresh:
+        return np.load(cache_file).tolist()
+
+    patients = db_helper.get_feature_patients(phe_code)
+    Path(cache_dir).mkdir(exist_ok=True, parents=True)
+    np.save(cache_file, np.array(patients, dtype=np.int64))
+    return patients
+
+def create_akg(node_list: pd.DataFrame, edge_list: pd.DataFrame, db_helper, labels: bool = True, label_resolver=None,
+               layout_cache: LayoutCache = None, fast_layout: bool = False):
+    """ Creates an averaged knowledge graph. Layouts are taken from / warm-started by layout_cache if given. """
     graph = nx.Graph()
 
     for _, node in node_list.iterrows():
@@ -57,10 +74,15 @@ def create_akg(node_list: pd.DataFrame, edge_list: pd.DataFrame, db_helper, labe
     node_weight = [node*200 for node in node_weight]
 
     fig, ax = plt.subplots(figsize=(15, 15))
-    layout = nx.spring_layout(graph, k=0.5)
+    if layout_cache is None:
+        layout_cache = LayoutCache()
+    with profiler.stage('plot.layout'):
+        layout = layout_cache.layout(graph, k=0.5, fast=fast_layout)
     
     if labels is True:
-        node_labels = {n: db_helper.get_labels(node=n) for n in graph.nodes}
+        if label_resolver is None:
+            label_resolver = LabelResolver(db_helper)
+        node_labels = label_resolver.labels(graph.nodes)
         nx.draw(graph, pos=layout, labels=node_labels, with_labels=True, node_size=node_weight, node_color=node_color, edge_color=edge_color, width=edge_weight)
     else:
         nx.draw(graph, pos=layout, with_labels=True, node_size=node_weight, node_color=node_color, edge_color=edge_color, width=edge_weight)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+from make_graph import CompactGraph, DDA, DIAG, DRUG, FOUND, MDA, NO_LAG, _dates_by_code, _edge_lag, _found
+from profiling import profiler
+
+
+def window_start(watermark, days: int = 90) -> np.datetime64:
+    """ First visit date a visit after the watermark can be matched with, for lags up to days """
+    return np.datetime64(watermark, 'D') - np.timedelta64(days, 'D')
+
+
+def last_visit(drugs: pd.DataFrame, diags: pd.DataFrame):
+    """ Latest new_date of the prescriptions and diagnoses, None without rows """
+    dates = np.concatenate([pd.to_datetime(drugs["new_date"]).values, pd.to_datetime(diags["new_date"]).values])
+    return dates.max().astype('datetime64[D]') if len(dates) else None
+
+
+def _drug_ends(graph: CompactGraph, association_index) -> set:
+    """ Codes that are the drug of a drug-diag edge of the graph, in either stored orientation """
+    pairs = [(graph.nodes[u], graph.nodes[v]) for (u, v), edge_type in zip(graph.edges.tolist(), graph.edge_types) if edge_type == MDA]
+    codes = {code for pair in pairs for code in pair}
+    medi = set(association_index.drug_diag_associations(codes, codes).itertuples(index=False, name=None))
+    return {code1 if (code1, code2) in medi else code2 for code1, code2 in pairs}
+
+
+def update_graph(graph: CompactGraph, drugs: pd.DataFrame, diags: pd.DataFrame, watermark, association_index, time_delta: int = 90):
+    """
+    Add the visits after the watermark to a stored patient graph, instead of building it from the full history.
+
+    New codes become nodes, the literature edges of codes new to their type (e.g. a drug now also diagnosed) are
+    added and the lag and found state are re-evaluated only for the edges of codes with a visit after the watermark.
+    Lags only get smaller, edges found before stay found unless a drug-diag edge becomes a diag-diag edge. Lags are
+    exact up to the days of visits passed before the watermark (at least time_delta), longer lags only shrink when a
+    new visit gives a shorter one and are never recomputed from the full history.
+    Visits are matched on their date, so rows dated on or before the watermark that arrive late are not picked up.
+
+    :param graph: stored graph of the patient, built up to the watermark
+    :param drugs: patient prescriptions from window_start(watermark, days) on, days >= time_delta
+    :param diags: patient diagnoses from window_start(watermark, days) on
+    :param watermark: last visit date processed into the graph
+    :param association_index: AssociationIndex of the run
+    :param time_delta: time span in days of found associations, as in PKG
+    :return: updated CompactGraph and its watermark, the same graph and watermark if nothing is new
+    """
+    watermark = np.datetime64(watermark, 'D')
+    new_drugs = drugs[pd.to_datetime(drugs["new_date"]).values.astype('datetime64[D]') > watermark]
+    new_diags = diags[pd.to_datetime(diags["new_date"]).values.astype('datetime64[D]') > watermark]
+    if len(new_drugs) == 0 and len(new_diags) == 0:
+        return graph, watermark
+
+    nodes = list(graph.nodes)
+    node_ids = dict(graph.node_ids)
+    node_types = list(graph.node_types)
+    edges = [tuple(edge) for edge in graph.edges.tolist()]
+    edge_ids = {frozenset(edge): i for i, edge in enumerate(edges)}
+    edge_types = list(graph.edge_types)
+    edge_states = list(graph.edge_states)
+    edge_lags = list(graph.edge_lags)
+
+    # literature codes of the graph per type, before the new visits. A code prescribed and diagnosed is a DIAG node,
+    # it counts as prescribed when it is the drug of a drug-diag edge or prescribed in the window
+    graph_diags = {node for node, node_type in zip(nodes, node_types) if node_type == DIAG and node in association_index.diag_codes}
+    graph_drugs = {node for node, node_type in zip(nodes, node_types) if node_type == DRUG}
+    graph_drugs.update(_drug_ends(graph, association_index))
+    graph_drugs.update(drugs[pd.to_datetime(drugs["new_date"]).values.astype('datetime64[D]') <= watermark].rx_cui.unique())
+    graph_drugs.intersection_update(association_index.drug_codes)
+
+    # new nodes, a diagnosis wins over a drug with the same code as in PKG
+    added = set()
+    for codes, node_type in [(new_drugs.rx_cui.unique(), DRUG), (new_diags.icd_code.unique(), DIAG)]:
+        for code in codes:
+            if code not in node_ids:
+                node_ids[code] = len(nodes)
+                nodes.append(code)
+                node_types.append(node_type)
+                added.add(code)
+            elif node_type == DIAG:
+                node_types[node_ids[code]] = DIAG
+
+    # literature edges of the codes new to their type, also of codes already in the graph with the other type.
+    # drug-diag stored as (drug, diag) and diag-diag as (smaller id, larger id)
+    drug_codes = graph_drugs.union(association_index.literature_drugs(new_drugs).rx_cui.unique())
+    diag_codes = graph_diags.union(association_index.literature_diagnosis(new_diags).icd_code.unique())
+    new_drug_codes = drug_codes - graph_drugs
+    new_diag_codes = diag_codes - graph_diags
+
+    def add_edge(edge, edge_type):
+        key = frozenset(edge)
+        if key in edge_ids:
+            # diag-diag wins as in PKG, a retyped edge gets its lag and found state again
+            i = edge_ids[key]
+            if edge_type == DDA and edge_types[i] != DDA:
+                edges[i] = edge
+                edge_types[i] = DDA
+                edge_states[i] = int(edge_states[i]) & ~FOUND
+                edge_lags[i] = NO_LAG
+        else:
+            edge_ids[key] = len(edges)
+            edges.append(edge)
+            edge_types.append(edge_type)
+            edge_states.append(0)
+            edge_lags.append(NO_LAG)
+
+    if new_drug_codes or new_diag_codes:
+        mdas = pd.concat([association_index.drug_diag_associations(new_drug_codes, diag_codes),
+            association_index.drug_diag_associations(drug_codes, new_diag_codes)])
+        for rxcui, icd in mdas.drop_duplicates().itertuples(index=False, name=None):
+            add_edge((node_ids[rxcui], node_ids[icd]), MDA)
+
+    if new_diag_codes:
+        ddas = association_index.diag_diag_associations(diag_codes)
+        for disease1, disease2 in ddas.itertuples(index=False, name=None):
+            if disease1 != disease2 and (disease1 in new_diag_codes or disease2 in new_diag_codes):
+                add_edge(tuple(sorted((node_ids[disease1], node_ids[disease2]))), DDA)
+
+    # lag and found state of the edges of codes with new visits, matched on the visits in the window
+    changed = set(node_ids[code] for code in new_drugs.rx_cui.unique()).union(node_ids[code] for code in new_diags.icd_code.unique())
+    drug_dates = _dates_by_code(drugs, "rx_cui")
+    diag_dates = _dates_by_code(diags, "icd_code")
+    for i, ((u, v), edge_type) in enumerate(zip(edges, edge_types)):
+        if u not in changed and v not in changed:
+            continue
+        lag = _edge_lag(edge_type, nodes[u], nodes[v], drug_dates, diag_dates)
+        if lag != NO_LAG and (edge_lags[i] == NO_LAG or lag < edge_lags[i]):
+            edge_lags[i] = lag
+        if _found(edge_lags[i], time_delta):
+            edge_states[i] |= FOUND
+
+    profiler.count('incremental.nodes', len(added))
+    profiler.count('incremental.edges', len(edges) - len(graph.edges))
+    return CompactGraph(nodes, node_types, edges, edge_types, edge_states, edge_lags), last_visit(new_drugs, new_diags)
@@ -0,0 +1,123 @@
+import fcntl
+import os
+from collections import OrderedDict
+
+import pandas as pd
+
+from data_source import open_source
+
+
+def table_file_labels(table_dir: str) -> dict:
+    """
+    Labels of all codes in the table dumps (medi drug and disease labels, disgenet mappings and labels).
+
+    :param table_dir: folder with the *_labels.csv and disgenet_uml_mappings.csv files
+    :return: dict of code to name
+    """
+    def read(name, columns):
+        return pd.read_csv(os.path.join(table_dir, name), header=None, names=columns, dtype=str).dropna()
+
+    drugs = read('medi_drug_labels.csv', ['rxcui', 'drug_name'])
+    diagnosis = read('medi_disease_labels.csv', ['vocabulary', 'icd_code', 'diagnosis_name'])
+    mappings = read('disgenet_uml_mappings.csv', ['disease_id', 'vocabulary', 'icd_code'])
+    disgenet = read('disgenet_uml_labels.csv', ['disease_id', 'disease_name'])
+
+    disgenet = mappings.drop_duplicates('icd_code').merge(disgenet.drop_duplicates('disease_id'), on='disease_id')
+
+    labels = {}
+    # same precedence as DbHelper.get_labels: medi drugs, medi diagnoses, then disgenet
+    for codes, names in [(disgenet.icd_code, disgenet.disease_name),
+                         (diagnosis.icd_code, diagnosis.diagnosis_name),
+                         (drugs.rxcui, drugs.drug_name)]:
+        labels.update(zip(codes, names))
+    return labels
+
+
+class LabelResolver:
+    """
+    Class to resolve node names in bulk, with an in-process LRU cache and an optional on-disk cache.
+
+    Names not cached are looked up with db_helper, or with the data source named by source, opened on the first miss.
+    """
+
+    def __init__(self, db_helper=None, cache_file: str = None, maxsize: int = 100000, source: str = None) -> None:
+        self._db_helper = db_helper
+        self.source = source
+        self.cache_file = cache_file
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+        if cache_file is not None and os.path.exists(cache_file):
+            stored = pd.read_csv(cache_file, dtype=str, keep_default_na=False)
+            self._cache.update(zip(stored.node, stored.label))
+
+    @property
+    def db_helper(self):
+        if self._db_helper is None and self.source is not None:
+            self._db_helper = open_source(self.source)
+        return self._db_helper
+
+    @classmethod
+    def from_table_files(cls, table_dir: str, db_helper=None, cache_file: str = None, source: str = None):
+        """
+        Preload all labels from the table dumps (medi drug and disease labels, disgenet mappings and labels).
+
+        :param table_dir: folder with the *_labels.csv and disgenet_uml_mappings.csv files
+        :return: LabelResolver
+        """
+        resolver = cls(db_helper=db_helper, cache_file=cache_file, maxsize=None, source=source)
+        resolver._cache.update(table_file_labels(table_dir))
+        return resolver
+
+    @classmethod
+    def open(cls, db_helper=None, cache_file: str = None, table_dir: str = None, source: str = None):
+        """ Resolver of a run, preloaded from the table dumps in table_dir if given """
+        if table_dir is not None:
+            return cls.from_table_files(table_dir, db_helper=db_helper, cache_file=cache_file, source=source)
+        return cls(db_helper, cache_file=cache_file, source=source)
+
+    def labels(self, nodes) -> dict:
+        """
+        Names of the nodes, nodes without a name keep their code.
+
+        :param nodes: iterable of node codes
+        :return: dict of node to name
+        """
+        nodes = list(nodes)
+        missing = [node for node in dict.fromkeys(str(node) for node in nodes) if node not in self._cache]
+
+        if missing and (self._db_helper is not None or self.source is not None):
+            found = self.db_helper.get_labels_bulk(missing)
+            self._cache.update(found)
+            self._save(found)
+
+        labels = {}
+        for node in nodes:
+            key = str(node)
+            labels[node] = self._cache.get(key, node)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+
+        if self.maxsize is not None:
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return labels
+
+    def __call__(self, node) -> str:
+        return self.labels([node])[node]
+
+    def _save(self, found: dict) -> None:
+        """ Add the labels looked up to the cache file """
+        if self.cache_file is None:
+            return
+        # several processes may share the cache file: merge into what they stored under a lock, swap in a complete file
+        with open(f"{self.cache_file}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stored = {}
+            if os.path.exists(self.cache_file):
+                table = pd.read_csv(self.cache_file, dtype=str, keep_default_na=False)
+                stored.update(zip(table.node, table.label))
+            stored.update((str(node), str(label)) for node, label in found.items())
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            pd.DataFrame({'node': list(stored), 'label': list(stored.values())}).to_csv(tmp_file, index=False, header=True)
+            os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import networkx as nx
+
+
+def graph_hash(graph: nx.Graph) -> str:
+    """ Content hash of a graph, over its sorted nodes and edges """
+    nodes = sorted(str(node) for node in graph.nodes)
+    edges = sorted('\t'.join(sorted((str(node1), str(node2)))) for node1, node2 in graph.edges)
+    return hashlib.sha1('\n'.join(nodes + ['--'] + edges).encode()).hexdigest()
+
+
+class LayoutCache:
+    """
+    Class to cache plot layouts by graph content hash.
+
+    A new graph is warm-started from the last positions of the nodes already seen,
+    so nodes keep their place across runs and thresholds. With a cache_file the cache is kept on disk.
+    Only the maxsize layouts used last are kept, the node positions are kept for every node seen.
+    """
+
+    def __init__(self, cache_file: str = None, maxsize: int = 64) -> None:
+        self.cache_file = cache_file
+        self.maxsize = maxsize
+        self.layouts = OrderedDict()    ## graph hash -> {node: position}, least recently used first
+        self.positions = {}             ## node -> last position
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                layouts, self.positions = pickle.load(f)
+            self.layouts.update(layouts)
+            self._evict()
+
+    def layout(self, graph: nx.Graph, k: float = 0.5, fast: bool = False) -> dict:
+        """
+        Spring layout of the graph, from the cache if the same graph was laid out before.
+
+        :param graph: graph to lay out
+        :param k: optimal distance between nodes
+        :param fast: start from a spectral layout and run few spring iterations, for large graphs
+        :return: dict of node to position
+        """
+        key = graph_hash(graph)
+        if key in self.layouts:
+            self.layouts.move_to_end(key)
+            return self.layouts[key]
+
+        seed = int(key[:8], 16)    ## same graph, same layout
+        initial = {node: self.positions[node] for node in graph if node in self.positions}
+
+        if len(graph) == 0:
+            layout = {}
+        elif fast:
+            # spectral layout uses sparse eigenvectors, spring iterations only refine it
+            if len(initial) < len(graph) and len(graph) > 2:
+                initial = {**nx.spectral_layout(graph), **initial}
+            layout = nx.spring_layout(graph, k=k, pos=initial or None, iterations=15, seed=seed)
+        else:
+            layout = nx.spring_layout(graph, k=k, pos=initial or None, seed=seed)
+
+        self.layouts[key] = layout
+        self.positions.update(layout)
+        self._evict()
+        self._save()
+        return layout
+
+    def _evict(self) -> None:
+        if self.maxsize is not None:
+            while len(self.layouts) > self.maxsize:
+                self.layouts.popitem(last=False)
+
+    def _save(self) -> None:
+        if self.cache_file is None:
+            return
+        with open(f"{self.cache_file}.tmp", 'wb') as f:
+            pickle.dump((self.layouts, self.positions), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{self.cache_file}.tmp", self.cache_file)
@@ -1,11 +1,13 @@
-from datetime import timedelta
 from typing import Dict
-from copy import deepcopy
 
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
+import pandas as pd
 
-from db_functions import DbHelper
+from labels import LabelResolver
+from layout import LayoutCache
+from profiling import profiler
 from enum import Enum
 
 
@@ -25,6 +27,136 @@ class NodeColor(Enum):
     DRUG = "orange"
 
 
+_NO_DATES = np.array([], dtype="datetime64[D]")
+
+
+def _dates_by_code(frame, code_column):
+    """ Sorted unique visit dates (new_date) of every code in the frame. """
+    dates = pd.DataFrame({
+        "code": frame[code_column].values,
+        "date": pd.to_datetime(frame["new_date"]).values.astype("datetime64[D]"),
+    })
+    return {code: np.unique(group.values) for code, group in dates.groupby("code")["date"]}
+
+
+NO_LAG = -1    ## edge lag when the second event never follows the first
+
+
+def _min_lag(first_dates, second_dates) -> int:
+    """ Smallest number of days from a first date to a second date on or after it, NO_LAG if none. Both sorted. """
+    if len(first_dates) == 0 or len(second_dates) == 0:
+        return NO_LAG
+    # first second date on or after each first date
+    idx = np.searchsorted(second_dates, first_dates, side="left")
+    hit = idx < len(second_dates)
+    if not hit.any():
+        return NO_LAG
+    return int((second_dates[idx[hit]] - first_dates[hit]).min() // np.timedelta64(1, "D"))
+
+
+def _within_window(first_dates, second_dates, days):
+    """ True if any second date falls within [date, date + days] of a first date. Both sorted. """
+    return _found(_min_lag(first_dates, second_dates), days)
+
+
+def _found(lag, days):
+    """ True if an edge with this lag is found within a window of days """
+    return NO_LAG < lag <= days
+
+
+# node and edge type codes of CompactGraph, index into the color lists
+DRUG, DIAG = 0, 1
+MDA, DDA = 0, 1
+FOUND = 1    ## edge state bit
+
+NODE_COLORS = [NodeColor.DRUG.value, NodeColor.DIAG.value]
+EDGE_COLORS = [EdgeColor.MDA.value, EdgeColor.DDA.value]
+FOUND_EDGE_COLORS = [EdgeColor.FOUND_MDA.value, EdgeColor.FOUND_DDA.value]
+
+
+def _edge_lag(edge_type, node1, node2, drug_dates, diag_dates) -> int:
+    """
+    Smallest lag in days between the two events of an edge in the patient data, NO_LAG if they never follow each other.
+
+    drug-diag: prescription after a diagnosis; diag-diag: one diagnosis after the other, in either order.
+    The edge is found for a time_delta if its lag is at most time_delta.
+    """
+    if edge_type == MDA:
+        return _min_lag(diag_dates.get(node2, _NO_DATES), drug_dates.get(node1, _NO_DATES))
+    lags = [_min_lag(diag_dates.get(icd1, _NO_DATES), diag_dates.get(icd2, _NO_DATES))
+        for icd1, icd2 in [(node1, node2), (node2, node1)]]
+    return min([lag for lag in lags if lag != NO_LAG], default=NO_LAG)
+
+
+class CompactGraph:
+    """ Patient graph with interned integer node ids and array storage """
+
+    __slots__ = ("nodes", "node_ids", "node_types", "edges", "edge_types", "edge_states", "edge_lags")
+
+    def __init__(self, nodes, node_types, edges, edge_types, edge_states=None, edge_lags=None) -> None:
+        self.nodes = list(nodes)    ## node codes, position is the node id
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        self.node_types = np.asarray(node_types, dtype=np.uint8)
+        # edges in insertion order, (smaller id, larger id) as PKG builds them.
+        # TemporalPKG and update_graph store drug-diag edges as (drug, diag) whatever the ids
+        self.edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+        self.edge_types = np.asarray(edge_types, dtype=np.uint8)
+        self.edge_states = (np.zeros(len(self.edges), dtype=np.uint8) if edge_states is None
+            else np.asarray(edge_states, dtype=np.uint8))
+        self.edge_lags = (np.full(len(self.edges), NO_LAG, dtype=np.int32) if edge_lags is None
+            else np.asarray(edge_lags, dtype=np.int32))    ## smallest lag in days between the events of an edge
+
+    def __getstate__(self):
+        return self.nodes, self.node_types, self.edges, self.edge_types, self.edge_states, self.edge_lags
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def edge_order(self) -> np.ndarray:
+        """ Edge positions in the order networkx.Graph.edges iterates them """
+        return np.argsort(self.edges[:, 0], kind="stable")
+
+    def node_colors(self) -> Dict:
+        return {node: NODE_COLORS[node_type] for node, node_type in zip(self.nodes, self.node_types)}
+
+    def iter_edges(self):
+        """ Yield (node1, node2, color) like networkx.Graph.edges(data='color') """
+        for i in self.edge_order():
+            u, v = self.edges[i]
+            colors = FOUND_EDGE_COLORS if self.edge_states[i] & FOUND else EDGE_COLORS
+            yield self.nodes[u], self.nodes[v], colors[self.edge_types[i]]
+
+    def found_sets(self):
+        """ found_drugs, found_diags, found_mdas, found_ddas as PKG computes them, from the edge states """
+        found_drugs, found_diags, found_mdas, found_ddas = set(), set(), set(), set()
+        for i in np.flatnonzero(self.edge_states & FOUND):
+            node1, node2 = self.nodes[self.edges[i, 0]], self.nodes[self.edges[i, 1]]
+            if self.edge_types[i] == MDA:
+                found_drugs.add(node1)
+                found_diags.add(node2)
+                found_mdas.add((node1, node2))
+            else:
+                found_diags.update([node1, node2])
+                found_ddas.add(tuple(sorted((node1, node2))))
+        return found_drugs, found_diags, found_mdas, found_ddas
+
+    def found_counts(self, windows) -> list:
+        """ Number of edges found within each window of days, from the edge lags """
+        return [int(((self.edge_lags > NO_LAG) & (self.edge_lags <= days)).sum()) for days in windows]
+
+    def to_networkx(self) -> nx.Graph:
+        graph = nx.Graph()
+        for node, node_type in zip(self.nodes, self.node_types):
+            graph.add_node(node, color=NODE_COLORS[node_type])
+        for (u, v), edge_type, state, lag in zip(self.edges, self.edge_types, self.edge_states, self.edge_lags):
+            lag = None if lag == NO_LAG else int(lag)
+            if state & FOUND:
+                graph.add_edge(self.nodes[u], self.nodes[v], color=FOUND_EDGE_COLORS[edge_type], state="found", lag=lag)
+            else:
+                graph.add_edge(self.nodes[u], self.nodes[v], color=EDGE_COLORS[edge_type], state="literature", lag=lag)
+        return graph
+
+
 class PKG:
     """ Class to make patient PKG """
 
@@ -37,6 +169,7 @@ class PKG:
         ddas,
         time_delta = 90,
         real_associations = True,
+        compact = False,
     ) -> None:
         self.patient_drugs = patient_drugs
         self.patient_diagnosis = patient_diagnosis
@@ -46,32 +179,58 @@ class PKG:
         self.ddas = ddas
         self.time_delta = time_delta
 
-        self.graph = self._create_pkg()
+        # built as CompactGraph, converted to networkx only if asked for (e.g. to plot)
+        with profiler.stage('pkg.create'):
+            self.compact_graph = self._create_pkg()
         if real_associations is True:
-            self.found_drugs, self.found_diags, self.found_mdas, self.found_ddas = self._add_real_associations()
+            with profiler.stage('pkg.real_associations'):
+                self.found_drugs, self.found_diags, self.found_mdas, self.found_ddas = self._add_real_associations()
             self.found_edges = self.found_ddas.union(self.found_mdas)
+            profiler.count('pkg.found_edges', len(self.found_edges))
+        profiler.count('pkg.graphs')
+        profiler.count('pkg.nodes', len(self.compact_graph.nodes))
+        profiler.count('pkg.edges', len(self.compact_graph.edges))
+        self.graph = self.compact_graph if compact is True else self.compact_graph.to_networkx()
     
     def _create_pkg(self):
-        graph = nx.Graph()
+        node_ids = {}
+        node_types = []
+        edge_ids = {}
+        edge_types = []
+
+        def add_node(node, node_type):
+            if node in node_ids:
+                node_types[node_ids[node]] = node_type
+            else:
+                node_ids[node] = len(node_types)
+                node_types.append(node_type)
+
+        def add_edge(node1, node2, edge_type):
+            edge = tuple(sorted((node_ids[node1], node_ids[node2])))
+            if edge in edge_ids:
+                edge_types[edge_ids[edge]] = edge_type
+            else:
+                edge_ids[edge] = len(edge_types)
+                edge_types.append(edge_type)
 
         # Add drugs and diagnosis nodes
         for drug in self.patient_drugs.rx_cui.unique():
-            graph.add_node(drug, color=NodeColor.DRUG.value)
+            add_node(drug, DRUG)
 
         for diag in self.patient_diagnosis.icd_code.unique():
-            graph.add_node(diag, color=NodeColor.DIAG.value)
+            add_node(diag, DIAG)
         
         # Add drug-diag associations
-        for _, (rxcui, icd) in self.mdas.iterrows():
-            if rxcui in graph.nodes and icd in graph.nodes:
-                graph.add_edge(rxcui, icd, color=EdgeColor.MDA.value, state="literature")
+        for rxcui, icd in self.mdas.itertuples(index=False, name=None):
+            if rxcui in node_ids and icd in node_ids:
+                add_edge(rxcui, icd, MDA)
             
         # Add diag-diag associations
-        for _, (disease1, disease2) in self.ddas.iterrows():
-            if disease1 != disease2 and disease1 in graph.nodes and disease2 in graph.nodes:
-                graph.add_edge(disease1, disease2, color=EdgeColor.DDA.value, state="literature")
+        for disease1, disease2 in self.ddas.itertuples(index=False, name=None):
+            if disease1 != disease2 and disease1 in node_ids and disease2 in node_ids:
+                add_edge(disease1, disease2, DDA)
         
-        return graph
+        return CompactGraph(node_ids, node_types, list(edge_ids), edge_types)
     
 
     def _add_real_associations(self):
@@ -82,59 +241,363 @@ class PKG:
         found_mdas = set()
         found_ddas = set()
 
-        # drug-diag associations in real
-        for rx, icd in self.graph.edges:
-            if self.graph[rx][icd]["color"] == EdgeColor.MDA.value:
-                diag_date = self.lit_diagnosis.loc[self.lit_diagnosis["icd_code"] == icd, "new_date"]
-                drug_date = self.lit_drugs.loc[self.lit_drugs["rx_cui"] == rx, "new_date"]
-                for visit in diag_date:
-                    # time span in days between diagnosis and prescription date
-                    end_date = visit + timedelta(days=self.time_delta)
-                    for prescription in drug_date.unique():
-                        if visit <= prescription <= end_date:
-                            found_drugs.add(rx)
-                            found_diags.add(icd)
-                            found_mdas.add((rx, icd))
-                            self.graph[rx][icd]["color"] = EdgeColor.FOUND_MDA.value
-                            self.graph[rx][icd]["state"] = "found"
-
-        # diag-diag associations in real
-        for d1, d2 in self.graph.edges:
-            if self.graph[d1][d2]["color"] == EdgeColor.DDA.value:
-                for icd1, icd2 in [(d1, d2), (d2, d1)]:
-                    diag1_date = self.lit_diagnosis.loc[self.lit_diagnosis["icd_code"] == icd1, "new_date"]
-                    diag2_date = self.lit_diagnosis.loc[self.lit_diagnosis["icd_code"] == icd2, "new_date"]
-                    for diag1_visit in diag1_date:
-                        # time span in days between two diagnosis
-                        end_date = diag1_visit + timedelta(days=self.time_delta)
-                        for diag2_visit in diag2_date:
-                            if diag1_visit <= diag2_visit <= end_date:
-                                found_diags.update([icd1, icd2])
-                                assos = tuple(sorted((icd1, icd2)))
-                                found_ddas.add(assos)
-                                self.graph[icd1][icd2]["color"] = EdgeColor.FOUND_DDA.value
-                                self.graph[icd1][icd2]["state"] = "found"
+        # visit dates per code, looked up once instead of per edge
+        drug_dates = _dates_by_code(self.lit_drugs, "rx_cui")
+        diag_dates = _dates_by_code(self.lit_diagnosis, "icd_code")
+
+        # the lag of every edge once, found for this time_delta and any other window follows from it
+        graph = self.compact_graph
+        for i, ((u, v), edge_type) in enumerate(zip(graph.edges, graph.edge_types)):
+            node1, node2 = graph.nodes[u], graph.nodes[v]
+            graph.edge_lags[i] = _edge_lag(edge_type, node1, node2, drug_dates, diag_dates)
+            if not _found(graph.edge_lags[i], self.time_delta):
+                continue
+
+            # drug-diag associations in real
+            if edge_type == MDA:
+                found_drugs.add(node1)
+                found_diags.add(node2)
+                found_mdas.add((node1, node2))
+            # diag-diag associations in real
+            else:
+                found_diags.update([node1, node2])
+                found_ddas.add(tuple(sorted((node1, node2))))
+            graph.edge_states[i] |= FOUND
         
         return found_drugs, found_diags, found_mdas, found_ddas
 
 
+NODE_CHANGE_DTYPE = np.dtype([('step', '<i4'), ('node', '<i4'), ('type', 'u1')])
+EDGE_CHANGE_DTYPE = np.dtype([('step', '<i4'), ('edge', '<i4'), ('type', 'u1'), ('state', 'u1'), ('lag', '<i4')])
+
+
+def _visit_days(frame):
+    return pd.to_datetime(frame["new_date"]).values.astype("datetime64[D]")
+
+
+def _dates_until(dates_by_code, codes, last_date):
+    """ Visit dates of the codes up to last_date """
+    return {code: dates_by_code[code][:np.searchsorted(dates_by_code[code], last_date, side="right")]
+        for code in codes if code in dates_by_code}
+
+
+def _codes_by_step(codes, steps, num_steps):
+    """ Codes with a visit in each step, in order of their first row """
+    by_step = [[] for _ in range(num_steps)]
+    for code, step in dict.fromkeys(zip(codes, steps.tolist())):
+        by_step[step].append(code)
+    return by_step
+
+
+class TemporalPKG:
+    """
+    PKGs of a patient after every visit (or every window of days), built in one sweep over the visits.
+
+    The graph of step k is the PKG of the visits up to dates[k]. The sequence is stored as deltas: every node and
+    edge once with the step it appears in, plus the later changes of a node type (a drug code diagnosed later),
+    an edge type or an edge state and lag. Edges are re-evaluated only for the codes with a visit in the step.
+    """
+
+    def __init__(self,
+        patient_drugs,
+        patient_diagnosis,
+        lit_drugs,
+        mdas,
+        lit_diagnosis,
+        ddas,
+        time_delta = 90,
+        window = None,
+    ) -> None:
+        self.time_delta = time_delta
+        self.window = window
+
+        with profiler.stage('temporal.create'):
+            self._sweep(patient_drugs, patient_diagnosis, lit_drugs, mdas, lit_diagnosis, ddas)
+        profiler.count('temporal.graphs')
+        profiler.count('temporal.steps', len(self.dates))
+
+    def _steps(self, days):
+        """ Last date of every step, a step is a visit date or a window of days starting at the first visit """
+        if len(days) == 0:
+            return np.array([], dtype="datetime64[D]")
+        if self.window is None:
+            return np.unique(days)
+        first = days.min()
+        windows = np.unique((days - first) // np.timedelta64(self.window, "D"))
+        return first + ((windows + 1) * self.window - 1).astype("timedelta64[D]")
+
+    def _sweep(self, patient_drugs, patient_diagnosis, lit_drugs, mdas, lit_diagnosis, ddas):
+        drug_days, diag_days = _visit_days(patient_drugs), _visit_days(patient_diagnosis)
+        self.dates = self._steps(np.concatenate([drug_days, diag_days]))
+        num_steps = len(self.dates)
+        drugs_by_step = _codes_by_step(patient_drugs.rx_cui.values, np.searchsorted(self.dates, drug_days), num_steps)
+        diags_by_step = _codes_by_step(patient_diagnosis.icd_code.values, np.searchsorted(self.dates, diag_days), num_steps)
+
+        lit_drug_codes, lit_diag_codes = set(lit_drugs.rx_cui.unique()), set(lit_diagnosis.icd_code.unique())
+        mda_drugs, mda_diags, dda_diags = {}, {}, {}
+        for rxcui, icd in mdas.itertuples(index=False, name=None):
+            mda_drugs.setdefault(icd, []).append(rxcui)
+            mda_diags.setdefault(rxcui, []).append(icd)
+        for disease1, disease2 in ddas.itertuples(index=False, name=None):
+            if disease1 != disease2:
+                dda_diags.setdefault(disease1, []).append(disease2)
+                dda_diags.setdefault(disease2, []).append(disease1)
+        drug_dates = _dates_by_code(lit_drugs, "rx_cui")
+        diag_dates = _dates_by_code(lit_diagnosis, "icd_code")
+
+        # current graph, and per node and edge the step it appears in and its state at the end of that step
+        nodes, node_ids, node_types, node_steps = [], {}, [], []
+        edge_ids, edges, edge_types, edge_states, edge_lags, edge_steps = {}, [], [], [], [], []
+        initial_node_types, initial_edge_types, initial_edge_states, initial_edge_lags = [], [], [], []
+        node_edges = {}
+        node_changes, edge_changes = [], []
+        seen_drugs, seen_diags = set(), set()
+
+        for step, last_date in enumerate(self.dates):
+            num_nodes, num_edges = len(node_types), len(edges)
+            node_before, edge_before = {}, {}
+            changed_edges = set()
+
+            def add_node(node, node_type):
+                if node not in node_ids:
+                    node_ids[node] = len(nodes)
+                    nodes.append(node)
+                    node_types.append(node_type)
+                    node_steps.append(step)
+                elif node_type == DIAG and node_types[node_ids[node]] == DRUG:
+                    if node_ids[node] < num_nodes:
+                        node_before.setdefault(node_ids[node], DRUG)
+                    node_types[node_ids[node]] = DIAG
+
+            def add_edge(node1, node2, edge_type):
+                u, v = node_ids[node1], node_ids[node2]
+                if edge_type == DDA:
+                    u, v = min(u, v), max(u, v)
+                key = frozenset((u, v))
+                if key not in edge_ids:
+                    edge = edge_ids[key] = len(edges)
+                    edges.append((u, v))
+                    edge_types.append(edge_type)
+                    edge_states.append(0)
+                    edge_lags.append(NO_LAG)
+                    edge_steps.append(step)
+                    node_edges.setdefault(u, []).append(edge)
+                    if v != u:
+                        node_edges.setdefault(v, []).append(edge)
+                # diag-diag wins over drug-diag, as in PKG
+                elif edge_type == DDA and edge_types[edge_ids[key]] == MDA:
+                    edge = edge_ids[key]
+                    if edge < num_edges:
+                        edge_before.setdefault(edge, (edge_types[edge], edge_states[edge], edge_lags[edge]))
+                    edge_types[edge] = DDA
+                    changed_edges.add(edge)
+
+            for drug in drugs_by_step[step]:
+                add_node(drug, DRUG)
+            for diag in diags_by_step[step]:
+                add_node(diag, DIAG)
+
+            # literature edges of the codes seen for the first time
+            for drug in drugs_by_step[step]:
+                if drug in lit_drug_codes and drug not in seen_drugs:
+                    seen_drugs.add(drug)
+                    for diag in mda_diags.get(drug, []):
+                        if diag in seen_diags:
+                            add_edge(drug, diag, MDA)
+            for diag in diags_by_step[step]:
+                if diag in lit_diag_codes and diag not in seen_diags:
+                    seen_diags.add(diag)
+                    for drug in mda_drugs.get(diag, []):
+                        if drug in seen_drugs:
+                            add_edge(drug, diag, MDA)
+                    for other in dda_diags.get(diag, []):
+                        if other in seen_diags:
+                            add_edge(diag, other, DDA)
+
+            # lag and found state of the edges of codes with a visit in this step, on the visits up to its last date
+            visited = [node_ids[code] for code in drugs_by_step[step] + diags_by_step[step]]
+            candidates = changed_edges.union(*[node_edges.get(node, ()) for node in visited])
+            for edge in sorted(candidates):
+                u, v = edges[edge]
+                node1, node2 = nodes[u], nodes[v]
+                lag = _edge_lag(edge_types[edge], node1, node2,
+                    _dates_until(drug_dates, (node1, node2), last_date), _dates_until(diag_dates, (node1, node2), last_date))
+                state = FOUND if _found(lag, self.time_delta) else 0
+                if (state, lag) != (edge_states[edge], edge_lags[edge]):
+                    if edge < num_edges:
+                        edge_before.setdefault(edge, (edge_types[edge], edge_states[edge], edge_lags[edge]))
+                    edge_states[edge] = state
+                    edge_lags[edge] = lag
+
+            initial_node_types.extend(node_types[num_nodes:])
+            initial_edge_types.extend(edge_types[num_edges:])
+            initial_edge_states.extend(edge_states[num_edges:])
+            initial_edge_lags.extend(edge_lags[num_edges:])
+            node_changes.extend((step, node, node_types[node]) for node, old in sorted(node_before.items())
+                if node_types[node] != old)
+            edge_changes.extend((step, edge, edge_types[edge], edge_states[edge], edge_lags[edge])
+                for edge, old in sorted(edge_before.items()) if (edge_types[edge], edge_states[edge], edge_lags[edge]) != old)
+
+        self.nodes = nodes
+        self.node_types = np.asarray(initial_node_types, dtype=np.uint8)
+        self.node_steps = np.asarray(node_steps, dtype=np.int32)
+        self.edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+        self.edge_types = np.asarray(initial_edge_types, dtype=np.uint8)
+        self.edge_states = np.asarray(initial_edge_states, dtype=np.uint8)
+        self.edge_lags = np.asarray(initial_edge_lags, dtype=np.int32)
+        self.edge_steps = np.asarray(edge_steps, dtype=np.int32)
+        self.node_changes = np.array(node_changes, dtype=NODE_CHANGE_DTYPE)
+        self.edge_changes = np.array(edge_changes, dtype=EDGE_CHANGE_DTYPE)
+
+    @classmethod
+    def from_deltas(cls, dates, graph, node_steps, edge_steps, node_changes, edge_changes, time_delta=90, window=None):
+        """ TemporalPKG of stored deltas (e.g. read from a TemporalStore), graph holds every node and edge as it appears """
+        sequence = cls.__new__(cls)
+        sequence.time_delta = time_delta
+        sequence.window = window
+        sequence.dates = np.asarray(dates, dtype="datetime64[D]")
+        sequence.nodes = list(graph.nodes)
+        sequence.node_types = graph.node_types
+        sequence.node_steps = np.asarray(node_steps, dtype=np.int32)
+        sequence.edges = graph.edges
+        sequence.edge_types = graph.edge_types
+        sequence.edge_states = graph.edge_states
+        sequence.edge_lags = graph.edge_lags
+        sequence.edge_steps = np.asarray(edge_steps, dtype=np.int32)
+        sequence.node_changes = np.asarray(node_changes, dtype=NODE_CHANGE_DTYPE)
+        sequence.edge_changes = np.asarray(edge_changes, dtype=EDGE_CHANGE_DTYPE)
+        return sequence
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def _apply(self, step, node_types, edge_types, edge_states, edge_lags, node_change, edge_change):
+        """ Apply the changes of one step, returns the positions of the next changes """
+        changes = self.node_changes
+        while node_change < len(changes) and changes['step'][node_change] == step:
+            node_types[changes['node'][node_change]] = changes['type'][node_change]
+            node_change += 1
+        changes = self.edge_changes
+        while edge_change < len(changes) and changes['step'][edge_change] == step:
+            edge_types[changes['edge'][edge_change]] = changes['type'][edge_change]
+            edge_states[changes['edge'][edge_change]] = changes['state'][edge_change]
+            edge_lags[changes['edge'][edge_change]] = changes['lag'][edge_change]
+            edge_change += 1
+        return node_change, edge_change
+
+    def snapshots(self):
+        """ Yield (date, CompactGraph) after every step, the deltas applied one step after the other """
+        node_types, edge_types = self.node_types.copy(), self.edge_types.copy()
+        edge_states, edge_lags = self.edge_states.copy(), self.edge_lags.copy()
+        node_change = edge_change = 0
+        for step, date in enumerate(self.dates):
+            node_change, edge_change = self._apply(step, node_types, edge_types, edge_states, edge_lags, node_change, edge_change)
+            num_nodes = np.searchsorted(self.node_steps, step, side="right")
+            num_edges = np.searchsorted(self.edge_steps, step, side="right")
+            # copies, the next steps change the arrays
+            yield date, CompactGraph(self.nodes[:num_nodes], node_types[:num_nodes].copy(), self.edges[:num_edges],
+                edge_types[:num_edges].copy(), edge_states[:num_edges].copy(), edge_lags[:num_edges].copy())
+
+    def snapshot(self, step: int) -> CompactGraph:
+        """ Graph after one step, -1 for the graph of the whole history """
+        step = range(len(self))[step]
+        num_nodes = np.searchsorted(self.node_steps, step, side="right")
+        num_edges = np.searchsorted(self.edge_steps, step, side="right")
+        node_types, edge_types = self.node_types.copy(), self.edge_types.copy()
+        edge_states, edge_lags = self.edge_states.copy(), self.edge_lags.copy()
+        # changes are in step order, a later change of the same node or edge is assigned last
+        changes = self.node_changes[self.node_changes['step'] <= step]
+        node_types[changes['node']] = changes['type']
+        changes = self.edge_changes[self.edge_changes['step'] <= step]
+        edge_types[changes['edge']] = changes['type']
+        edge_states[changes['edge']] = changes['state']
+        edge_lags[changes['edge']] = changes['lag']
+        return CompactGraph(self.nodes[:num_nodes], node_types[:num_nodes], self.edges[:num_edges],
+            edge_types[:num_edges], edge_states[:num_edges], edge_lags[:num_edges])
+
+    @property
+    def graph(self) -> CompactGraph:
+        """ Graph of the whole history, the graph PKG builds """
+        return self.snapshot(-1)
+
+    def deltas(self):
+        """
+        Yield the changes of every step as dicts with the date, the new nodes (code, type), the new edges
+        (code, code, type, state, lag) and the changed nodes and edges with their new type (and state and lag).
+        """
+        node_changes = np.split(self.node_changes, np.searchsorted(self.node_changes['step'], np.arange(1, len(self))))
+        edge_changes = np.split(self.edge_changes, np.searchsorted(self.edge_changes['step'], np.arange(1, len(self))))
+        node_starts = np.searchsorted(self.node_steps, np.arange(len(self) + 1))
+        edge_starts = np.searchsorted(self.edge_steps, np.arange(len(self) + 1))
+        for step, date in enumerate(self.dates):
+            yield {
+                'date': date,
+                'nodes': [(self.nodes[node], int(self.node_types[node])) for node in range(node_starts[step], node_starts[step + 1])],
+                'edges': [(self.nodes[self.edges[edge, 0]], self.nodes[self.edges[edge, 1]], int(self.edge_types[edge]),
+                    int(self.edge_states[edge]), int(self.edge_lags[edge])) for edge in range(edge_starts[step], edge_starts[step + 1])],
+                'changed_nodes': [(self.nodes[node], int(node_type)) for _, node, node_type in node_changes[step]],
+                'changed_edges': [(self.nodes[self.edges[edge, 0]], self.nodes[self.edges[edge, 1]], int(edge_type), int(state), int(lag))
+                    for _, edge, edge_type, state, lag in edge_changes[step]],
+            }
+
+
 class PlotPKG(PKG):
 
-    def __init__(self, patient_drugs, patient_diagnosis, lit_drugs, mdas, lit_diagnosis, ddas, time_delta=90, real_associations=True,) -> None:
-        super().__init__(patient_drugs, patient_diagnosis, lit_drugs, mdas, lit_diagnosis, ddas, time_delta, real_associations)
+    def __init__(self, patient_drugs, patient_diagnosis, lit_drugs, mdas, lit_diagnosis, ddas, time_delta=90, real_associations=True, label_resolver=None, layout_cache=None,
+                 source='db') -> None:
+        super().__init__(patient_drugs, patient_diagnosis, lit_drugs, mdas, lit_diagnosis, ddas, time_delta, real_associations, compact=False)
 
         self.found_associations = real_associations
-        self.layout = nx.spring_layout(self.graph, k=0.5)
+        self._layout = None
+        self._label_resolver = label_resolver
+        self.layout_cache = layout_cache
+        self.source = source    ## data source of the labels when no label_resolver is given
+
+    @classmethod
+    def from_graph(cls, compact_graph, label_resolver=None, layout_cache=None, source='db'):
+        """ PlotPKG of an already built graph (e.g. read from a GraphStore), found edges from its edge states """
+        pkg = cls.__new__(cls)
+        pkg.compact_graph = compact_graph
+        pkg.graph = compact_graph.to_networkx()
+        pkg.found_drugs, pkg.found_diags, pkg.found_mdas, pkg.found_ddas = compact_graph.found_sets()
+        pkg.found_edges = pkg.found_ddas.union(pkg.found_mdas)
+        pkg.found_associations = True
+        pkg._layout = None
+        pkg._label_resolver = label_resolver
+        pkg.layout_cache = layout_cache
+        pkg.source = source
+        return pkg
+
+    @property
+    def layout(self):
+        # computed on the first plot, shared by all plots of this graph
+        if self._layout is None:
+            if self.layout_cache is None:
+                self.layout_cache = LayoutCache()
+            with profiler.stage('plot.layout'):
+                self._layout = self.layout_cache.layout(self.graph, k=0.5)
+        return self._layout
+
+    @property
+    def label_resolver(self):
+        # one connection for all labelled plots of this graph, only when labels are needed
+        if self._label_resolver is None:
+            self._label_resolver = LabelResolver(source=self.source)
+        return self._label_resolver
     
     def _make_plot(self, graph, labels = False):
+        layout = self.layout
+        with profiler.stage('plot.draw'):
+            return self._draw(graph, layout, labels)
+
+    def _draw(self, graph, layout, labels):
 
         fig, ax = plt.subplots(figsize=(15, 15))
-        layout = self.layout
         attr = list(nx.get_node_attributes(graph, "color").values())  # node_color
         attr2 = list(nx.get_edge_attributes(graph, "color").values())  # edge_color
 
         if labels is True:
-            node_labels = {n: DbHelper().get_labels(node=n) for n in graph.nodes}
+            node_labels = self.label_resolver.labels(graph.nodes)
             nx.draw(graph, pos=layout, labels=node_labels, with_labels=True, node_color=attr, edge_color=attr2, style='dashed', ax=ax,)
         else:
             nx.draw(graph, pos=layout, with_labels=True, node_color=attr, edge_color=attr2, style="dashed", ax=ax,)
@@ -163,8 +626,7 @@ class PlotPKG(PKG):
     
 
     def connected_PKG(self, with_labels=True):
-        sub_graph = deepcopy(self.graph)
-        sub_graph.remove_nodes_from(list(nx.isolates(sub_graph)))
+        sub_graph = nx.restricted_view(self.graph, list(nx.isolates(self.graph)), [])
         return self._make_plot(graph=sub_graph, labels=with_labels)
     
 
@@ -173,17 +635,14 @@ class PlotPKG(PKG):
         if self.found_associations is not True:
             raise AttributeError("'PlotPKG' object has no attribute 'real_associations'. Set parameter 'real_associations=True'.")
 
-        sub_graph = deepcopy(self.graph)
-
         found_nodes = self.found_drugs.union(self.found_diags)
-        remove_nodes = list(set(sub_graph.nodes) - found_nodes)
+        remove_nodes = list(set(self.graph.nodes) - found_nodes)
         remove_edges = set()
-        for n1, n2, state in sub_graph.edges(data='state'):
+        for n1, n2, state in self.graph.edges(data='state'):
             if state == 'literature':
                 remove_edges.add((n1,n2))
         
-        sub_graph.remove_nodes_from(remove_nodes)
-        sub_graph.remove_edges_from(remove_edges)
+        sub_graph = nx.restricted_view(self.graph, remove_nodes, remove_edges)
         return self._make_plot(graph=sub_graph, labels=with_labels)
     
     # @staticmethod
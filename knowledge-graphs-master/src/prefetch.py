@@ -0,0 +1,59 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from data_source import open_source
+
+
+# data source of each fetch thread, see thread_source
+_thread_sources = threading.local()
+
+
+def _start_thread(opened: list) -> None:
+    """ Initializer of the prefetch threads, the sources they open are listed in opened """
+    _thread_sources.opened = opened
+
+
+def thread_source(source: str = 'db'):
+    """
+    Data source owned by the calling thread, every fetch thread takes its own pooled connection.
+
+    Sources of prefetch threads are closed when their prefetch() pass ends.
+    """
+    if getattr(_thread_sources, 'source', None) is None:
+        _thread_sources.source = open_source(source)
+        getattr(_thread_sources, 'opened', []).append(_thread_sources.source)
+    return _thread_sources.source
+
+
+def prefetch(fetch, items, depth: int = 2):
+    """
+    Yield fetch(item) for the items in order, while the fetches of the next `depth` items run in threads.
+
+    The consumer works on item N while items N+1 .. N+depth are fetched; with depth 0 every item
+    is fetched when it is asked for.
+
+    :param fetch: function called with one item, must be thread-safe
+    :param items: iterable of items
+    :param depth: number of items fetched ahead
+    """
+    if depth < 1:
+        yield from map(fetch, items)
+        return
+
+    opened = []    ## sources opened by the threads of this pass, see thread_source
+    executor = ThreadPoolExecutor(depth, thread_name_prefix='prefetch', initializer=_start_thread, initargs=(opened,))
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fetch, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # also when the consumer stops early, fetches not yet started are dropped
+        executor.shutdown(wait=True, cancel_futures=True)
+        # the threads are gone, their connections go back to the pool
+        for source in opened:
+            source.close()
@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class Profiler:
+    """
+    Wall time per stage and counters of a run, off unless enabled.
+
+    Every process has its own profiler (the module level `profiler`). Stage times are summed over
+    threads and processes, so stages that overlap (prefetch, render processes) can add up to more than the run.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """ Time the block as one call of the stage """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def count(self, name: str, value: int = 1) -> None:
+        """ Add to a counter (e.g. rows fetched) """
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += int(value)
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """ Plain dict of the stages and counters, to send from a worker process to the main one """
+        with self._lock:
+            state = {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+            if reset:
+                self.reset()
+        return state
+
+    def merge(self, state: dict) -> None:
+        """ Add a snapshot of another process """
+        if not state:
+            return
+        with self._lock:
+            for name, seconds in state['seconds'].items():
+                self.seconds[name] += seconds
+            self.calls.update(state['calls'])
+            self.counters.update(state['counters'])
+
+    def report(self) -> pd.DataFrame:
+        """ Table of stages (calls, seconds, seconds per call) and counters """
+        stages = pd.DataFrame({
+            'name': list(self.seconds),
+            'kind': 'stage',
+            'calls': [self.calls[name] for name in self.seconds],
+            'seconds': [round(seconds, 6) for seconds in self.seconds.values()],
+        })
+        stages['seconds_per_call'] = (stages['seconds'] / stages['calls']).round(6)
+        counters = pd.DataFrame({'name': list(self.counters), 'kind': 'counter', 'value': list(self.counters.values())})
+        return pd.concat([stages.sort_values('seconds', ascending=False), counters], ignore_index=True)
+
+    def write(self, path: str, **run) -> None:
+        """ Store the report as <path>.json (with the run metadata) and <path>.csv """
+        report = self.report()
+        report.to_csv(f"{path}.csv", index=False, header=True)
+        with open(f"{path}.json", 'w') as f:
+            json.dump({'run': run, **self.snapshot()}, f, indent=2, default=str)
+
+
+# profiler of this process, enabled by --profile
+profiler = Profiler()
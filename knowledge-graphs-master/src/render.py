@@ -0,0 +1,80 @@
+import os
+from collections import deque
+from multiprocessing import Pool
+
+import matplotlib
+import matplotlib.pyplot as plt
+
+from labels import LabelResolver
+from layout import LayoutCache
+from make_graph import PlotPKG
+from profiling import profiler
+
+
+# per process state, set once by _init_renderer
+_renderer = {}
+
+
+def _init_renderer(source='db', label_cache=None, label_tables=None, profile=False):
+    """ Set up a render process: headless backend, own connection for the node labels, opened on the first label not cached. """
+    matplotlib.use("Agg")
+    profiler.enabled = profile
+    _renderer['label_resolver'] = LabelResolver.open(source=source, cache_file=label_cache, table_dir=label_tables)
+
+
+def render_pkg_plots(patient_id, compact_graph, output_folder, label_resolver=None, layout_cache=None):
+    """ Plot the complete, connected and found-only PKG of a patient graph and store them as png. """
+    current_pkg = PlotPKG.from_graph(compact_graph, label_resolver=label_resolver, layout_cache=layout_cache)
+
+    pkg_complete = current_pkg.complete_PKG()
+    pkg_connected = current_pkg.connected_PKG()
+    pkg_real_associations = current_pkg.real_associations_PKG()
+
+    # store plots
+    with profiler.stage('plot.save'):
+        pkg_complete.savefig(os.path.join(output_folder, f"{patient_id}_complete.png"))
+        pkg_connected.savefig(os.path.join(output_folder, f"{patient_id}_without-isolates.png"))
+        pkg_real_associations.savefig(os.path.join(output_folder, f"{patient_id}_only-found.png"))
+    profiler.count('plot.files', 3)
+
+    plt.close("all")
+
+
+def _render(patient_id, compact_graph, output_folder):
+    # a fresh layout cache per patient, the plots do not depend on the patients this process drew before
+    render_pkg_plots(patient_id, compact_graph, output_folder, label_resolver=_renderer['label_resolver'],
+        layout_cache=LayoutCache())
+    return profiler.snapshot(reset=True) if profiler.enabled else None
+
+
+class PlotRenderer:
+    """ Pool of processes that render patient plots from a queue of graphs, so graph generation does not wait on matplotlib """
+
+    def __init__(self, processes: int = 2, source: str = 'db', label_cache: str = None, label_tables: str = None, max_pending: int = None) -> None:
+        # render processes report their stage times back when the run is profiled
+        self.pool = Pool(processes, initializer=_init_renderer, initargs=(source, label_cache, label_tables, profiler.enabled))
+        # bounds the graphs held in the queue, submit() blocks when it is full
+        self.max_pending = max_pending if max_pending is not None else 4 * processes
+        self._pending = deque()
+
+    def submit(self, patient_id, compact_graph, output_folder) -> None:
+        """ Queue the plots of one patient graph """
+        while len(self._pending) >= self.max_pending:
+            profiler.merge(self._pending.popleft().get())    ## re-raises errors of the render process
+        self._pending.append(self.pool.apply_async(_render, (patient_id, compact_graph, output_folder)))
+
+    def close(self) -> None:
+        """ Wait for all queued plots """
+        while self._pending:
+            profiler.merge(self._pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
@@ -0,0 +1,277 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from make_graph import EDGE_COLORS
+
+
+PHECODE_DTYPE = np.dtype([
+    ('phecode', '<i4'),
+    ('edge_offset', '<i8'), ('edge_count', '<i4'),
+    ('mtime_ns', '<i8'),
+])
+RECORD_DTYPE = np.dtype([('node1', '<i4'), ('node2', '<i4'), ('phecode', '<i4'), ('count', '<i8'), ('strength', '<f4'), ('type', 'u1')])
+KEY_DTYPE = np.dtype([('node1', '<i4'), ('node2', '<i4'), ('offset', '<i8'), ('count', '<i4')])
+UNKNOWN_TYPE = 255    ## edge color not in EDGE_COLORS
+REMOVED = -1    ## mtime of the record of a phecode whose edgelist is gone, it has no edges
+GRAPH_SUFFIX = '_graph'
+
+
+class ResultsIndex:
+    """
+    Index over the averaged graphs of a results folder (<phecode>_graph/<phecode>_edgelist.csv), in one folder.
+
+    vocab.txt       node codes, the line number is the node id
+    phecodes.txt    phecodes, the line number is the phecode id
+    phecodes.bin    (phecode id, edge offset, edge count, edgelist mtime) per indexed edgelist
+    records.bin     (node1, node2, phecode id, count, strength, edge type) per averaged edge, phecode after phecode
+    keys.bin        (node1, node2, posting offset, posting count) per distinct edge, sorted by node ids
+    postings.bin    positions in records.bin, grouped by edge and ordered by strength
+    node_keys.bin   key positions per node, grouped by node
+    node_offsets.bin  start of every node in node_keys.bin, one more than the vocab
+    compiled.bin    number of phecode records the postings were compiled from
+
+    phecodes.bin and records.bin are appended like the GraphStore tables, an edgelist indexed again
+    supersedes its older records, a deleted one is superseded by a phecode record without edges. The postings
+    are compiled from the live records after every update, only new and changed edgelists are read.
+    All tables are read memory-mapped.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        Path(path).mkdir(exist_ok=True, parents=True)
+
+        self.vocab = self._read_lines('vocab.txt')
+        self._vocab_ids = {code: i for i, code in enumerate(self.vocab)}
+        self.phecodes = self._read_lines('phecodes.txt')
+        self._phecode_ids = {phecode: i for i, phecode in enumerate(self.phecodes)}
+        self._tables = None
+        self._pairs = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_lines(self, name: str) -> list:
+        if not os.path.exists(self._file(name)):
+            return []
+        with open(self._file(name)) as f:
+            return f.read().splitlines()
+
+    def _read(self, name: str, dtype) -> np.ndarray:
+        file = self._file(name)
+        if not os.path.exists(file) or os.path.getsize(file) < dtype.itemsize:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file, dtype=dtype, mode='r', shape=(os.path.getsize(file) // dtype.itemsize,))
+
+    @property
+    def tables(self):
+        """ Memory-mapped (phecode records, edge records, keys, postings, node keys, node offsets) """
+        if self._tables is None:
+            self._tables = (self._read('phecodes.bin', PHECODE_DTYPE), self._read('records.bin', RECORD_DTYPE),
+                self._read('keys.bin', KEY_DTYPE), self._read('postings.bin', np.dtype('<i8')),
+                self._read('node_keys.bin', np.dtype('<i8')), self._read('node_offsets.bin', np.dtype('<i8')))
+        return self._tables
+
+    @property
+    def pairs(self) -> np.ndarray:
+        """ (node1, node2) of every key as one int64, sorted like the keys """
+        if self._pairs is None:
+            keys = self.tables[2]
+            self._pairs = keys['node1'].astype(np.int64) << 32 | keys['node2'].astype(np.int64)
+        return self._pairs
+
+    def _intern(self, codes, ids: dict, values: list, new: list) -> np.ndarray:
+        """ Ids of the codes, unknown codes get the next ids """
+        result = np.empty(len(codes), dtype=np.int32)
+        for i, code in enumerate(codes):
+            code_id = ids.get(code)
+            if code_id is None:
+                code_id = ids[code] = len(values)
+                values.append(code)
+                new.append(code)
+            result[i] = code_id
+        return result
+
+    def _latest(self) -> dict:
+        """ Position of the latest phecode record of every phecode id """
+        return {int(phecode): i for i, phecode in enumerate(self.tables[0]['phecode'])}
+
+    def _recover(self) -> None:
+        """ Drop records and partial lines written after the last phecode record (an interrupted update). """
+        phecode_records = self.tables[0]
+        edge_end = int(phecode_records['edge_offset'][-1] + phecode_records['edge_count'][-1]) if len(phecode_records) else 0
+        self._tables = None
+
+        # codes and phecodes are identified by their line
+        for name in ['vocab.txt', 'phecodes.txt']:
+            if os.path.exists(self._file(name)):
+                with open(self._file(name), 'rb+') as f:
+                    f.truncate(f.read().rfind(b'\n') + 1)
+        self.vocab = self._read_lines('vocab.txt')
+        self._vocab_ids = {code: i for i, code in enumerate(self.vocab)}
+        self.phecodes = self._read_lines('phecodes.txt')
+        self._phecode_ids = {phecode: i for i, phecode in enumerate(self.phecodes)}
+
+        with open(self._file('records.bin'), 'ab') as f:
+            f.truncate(edge_end * RECORD_DTYPE.itemsize)
+
+    def _compiled(self) -> int:
+        if not os.path.exists(self._file('compiled.bin')):
+            return 0
+        return int(np.fromfile(self._file('compiled.bin'), dtype='<i8')[0])
+
+    def update(self, results_folder: str) -> list:
+        """
+        Index the edgelists of new phecode folders and of edgelists changed since they were indexed,
+        drop the edges of phecode folders and edgelists deleted since.
+
+        :return: phecodes (re)indexed or dropped
+        """
+        self._recover()
+        phecode_records, records = self.tables[:2]
+        latest = self._latest()
+        indexed = {self.phecodes[int(record['phecode'])]: int(record['mtime_ns'])
+            for record in (phecode_records[i] for i in latest.values())}
+
+        changed, present = [], set()
+        for folder in sorted(os.listdir(results_folder)):
+            if not folder.endswith(GRAPH_SUFFIX):
+                continue
+            phecode = folder[:-len(GRAPH_SUFFIX)]
+            edgelist = os.path.join(results_folder, folder, f"{phecode}_edgelist.csv")
+            if not os.path.exists(edgelist):
+                continue
+            present.add(phecode)
+            mtime_ns = os.stat(edgelist).st_mtime_ns
+            if indexed.get(phecode) != mtime_ns:
+                changed.append((phecode, edgelist, mtime_ns))
+        removed = [phecode for phecode, mtime_ns in indexed.items() if mtime_ns != REMOVED and phecode not in present]
+        if not changed and not removed:
+            if self._compiled() != len(phecode_records):
+                self._compile()
+            return []
+
+        new_codes, new_phecodes = [], []
+        edge_offset = int(phecode_records['edge_offset'][-1] + phecode_records['edge_count'][-1]) if len(phecode_records) else 0
+        new_records, new_phecode_records = [], []
+        for phecode, edgelist, mtime_ns in changed:
+            ## codes are read as strings, 250.20 stays 250.20
+            edges = pd.read_csv(edgelist, dtype={'node1': str, 'node2': str, 'color': str})
+            phecode_id = self._intern([phecode], self._phecode_ids, self.phecodes, new_phecodes)[0]
+
+            # edges stored with node1 < node2 as codes, as in the EdgeAggregator
+            codes1, codes2 = edges['node1'].values.astype(str), edges['node2'].values.astype(str)
+            swap = codes1 > codes2
+            node1, node2 = np.where(swap, codes2, codes1), np.where(swap, codes1, codes2)
+            phecode_edges = np.zeros(len(edges), dtype=RECORD_DTYPE)
+            phecode_edges['node1'] = self._intern(node1, self._vocab_ids, self.vocab, new_codes)
+            phecode_edges['node2'] = self._intern(node2, self._vocab_ids, self.vocab, new_codes)
+            phecode_edges['phecode'] = phecode_id
+            phecode_edges['count'] = edges['count'].values
+            phecode_edges['strength'] = edges['strength'].values
+            phecode_edges['type'] = [EDGE_COLORS.index(color) if color in EDGE_COLORS else UNKNOWN_TYPE for color in edges['color']]
+
+            new_records.append(phecode_edges)
+            new_phecode_records.append((phecode_id, edge_offset, len(phecode_edges), mtime_ns))
+            edge_offset += len(phecode_edges)
+        for phecode in removed:
+            new_phecode_records.append((self._phecode_ids[phecode], edge_offset, 0, REMOVED))
+
+        with open(self._file('vocab.txt'), 'a') as f:
+            f.writelines(f"{code}\n" for code in new_codes)
+        with open(self._file('phecodes.txt'), 'a') as f:
+            f.writelines(f"{phecode}\n" for phecode in new_phecodes)
+        with open(self._file('records.bin'), 'ab') as f:
+            f.write(np.concatenate(new_records).tobytes() if new_records else b'')
+        with open(self._file('phecodes.bin'), 'ab') as f:
+            f.write(np.array(new_phecode_records, dtype=PHECODE_DTYPE).tobytes())
+        self._tables = None
+
+        self._compile()
+        return [phecode for phecode, _, _ in changed] + removed
+
+    def _compile(self) -> None:
+        """ Rebuild keys, postings and node keys from the records of the latest phecode records """
+        phecode_records, records = self.tables[:2]
+        live = np.zeros(len(records), dtype=bool)
+        for i in self._latest().values():
+            record = phecode_records[i]
+            live[record['edge_offset']:record['edge_offset'] + record['edge_count']] = True
+
+        # postings by edge, the strongest phecode first
+        positions = np.flatnonzero(live)
+        live_records = records[positions]
+        order = np.lexsort((-live_records['strength'], live_records['node2'], live_records['node1']))
+        postings = positions[order].astype(np.int64)
+        node1, node2 = live_records['node1'][order], live_records['node2'][order]
+
+        starts = np.flatnonzero(np.concatenate([[True], (node1[1:] != node1[:-1]) | (node2[1:] != node2[:-1])])) if len(order) else np.zeros(0, dtype=np.int64)
+        keys = np.zeros(len(starts), dtype=KEY_DTYPE)
+        keys['node1'] = node1[starts]
+        keys['node2'] = node2[starts]
+        keys['offset'] = starts
+        keys['count'] = np.diff(np.concatenate([starts, [len(order)]]))
+
+        # every key under both of its nodes
+        key_nodes = np.concatenate([keys['node1'], keys['node2']]).astype(np.int64)
+        key_ids = np.concatenate([np.arange(len(keys)), np.arange(len(keys))])
+        node_order = np.argsort(key_nodes, kind='stable')
+        node_offsets = np.concatenate([[0], np.cumsum(np.bincount(key_nodes, minlength=len(self.vocab)))]).astype(np.int64)
+
+        # write next to the old tables and swap, readers never see a half written index
+        for name, table in [('keys.bin', keys), ('postings.bin', postings), ('node_keys.bin', key_ids[node_order].astype(np.int64)),
+                            ('node_offsets.bin', node_offsets)]:
+            with open(self._file(f"{name}.tmp"), 'wb') as f:
+                f.write(table.tobytes())
+            os.replace(self._file(f"{name}.tmp"), self._file(name))
+        ## last, an interrupted compile is redone by the next update
+        np.array([len(phecode_records)], dtype='<i8').tofile(self._file('compiled.bin'))
+        self._tables = None
+        self._pairs = None
+
+    def _postings(self, key_positions) -> pd.DataFrame:
+        """ Postings of the keys, in key order """
+        _, _, keys, postings = self.tables[:4]
+        positions = [postings[keys['offset'][i]:keys['offset'][i] + keys['count'][i]] for i in key_positions]
+        return self._records(np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64))
+
+    def _records(self, positions) -> pd.DataFrame:
+        """ Edge records as a table (node1, node2, phecode, count, strength, color) """
+        found = self.tables[1][positions]
+        return pd.DataFrame({
+            'node1': [self.vocab[code] for code in found['node1']],
+            'node2': [self.vocab[code] for code in found['node2']],
+            'phecode': [self.phecodes[phecode] for phecode in found['phecode']],
+            'count': found['count'].astype(np.int64),
+            'strength': found['strength'].astype(np.float64).round(2),
+            'color': [EDGE_COLORS[edge_type] if edge_type < len(EDGE_COLORS) else None for edge_type in found['type']],
+        })
+
+    def edge(self, node1: str, node2: str) -> pd.DataFrame:
+        """ Phecodes with the edge between two nodes, the strongest first """
+        code1, code2 = sorted((str(node1), str(node2)))
+        if code1 not in self._vocab_ids or code2 not in self._vocab_ids:
+            return self._postings([])
+        target = self._vocab_ids[code1] << 32 | self._vocab_ids[code2]
+        position = int(np.searchsorted(self.pairs, target))
+        return self._postings([position] if position < len(self.pairs) and self.pairs[position] == target else [])
+
+    def node(self, node: str, top: int = None) -> pd.DataFrame:
+        """ Postings of all edges of a node across the phecodes, the strongest first, top rows if given """
+        code = self._vocab_ids.get(str(node))
+        node_keys, node_offsets = self.tables[4:]
+        if code is None or code + 1 >= len(node_offsets):
+            return self._postings([])
+        edges = self._postings(node_keys[node_offsets[code]:node_offsets[code + 1]])
+        edges = edges.sort_values(['strength', 'phecode'], ascending=[False, True], kind='stable').reset_index(drop=True)
+        return edges if top is None else edges.head(top)
+
+    def phecode(self, phecode: str) -> pd.DataFrame:
+        """ Averaged edges of one phecode, in edgelist order """
+        position = self._latest().get(self._phecode_ids.get(str(phecode)))
+        if position is None:
+            return self._records(np.zeros(0, dtype=np.int64))
+        record = self.tables[0][position]
+        return self._records(np.arange(record['edge_offset'], record['edge_offset'] + record['edge_count']))
@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import pandas as pd
+
+from data_source import DataSource, _group_by_patient, _sample
+from labels import table_file_labels
+
+
+def _read_table(path: str, **kwargs) -> pd.DataFrame:
+    """CSV or Parquet file, by its extension"""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, **kwargs)
+
+
+def _visits(path: str, code_column: str, date_column: str) -> pd.DataFrame:
+    """Visit table in the column layout of DbHelper, sorted by patient and date"""
+    table = _read_table(path, dtype={code_column: str})
+    table['explorys_patient_id'] = table['explorys_patient_id'].astype('int64')
+    table[code_column] = table[code_column].astype(str)
+    table[date_column] = pd.to_datetime(table[date_column])
+    table['new_date'] = table[date_column].dt.normalize()
+    return table.dropna(subset=[code_column, date_column]).sort_values(
+        ['explorys_patient_id', date_column], kind='stable').reset_index(drop=True)
+
+
+class TableSource(DataSource):
+    """
+    Data source over the table dumps in table_files/ and patient visit files, to build a data folder without the DB.
+
+    The literature and labels come from the table dumps (medi_associations.csv, the *_labels.csv files and
+    disgenet_uml_mappings.csv), the patients from a drugs and a diagnoses file (CSV with a header or Parquet) with the
+    columns of v_drug (explorys_patient_id, rx_cui, prescription_date) and of v_diagnosis (explorys_patient_id,
+    icd_code, diagnosis_date). All tables are read into memory, it is meant as input of FileSource.export.
+
+    :param icd_associations_file: disease1, disease2 pairs, default icd_associations.csv of the table folder, none if missing
+    :param phecode_map_file: icd_code, phewas_code pairs for the phecode cohorts, default icd_phewas.csv of the table folder
+    """
+
+    def __init__(self, table_dir: str, drugs_file: str, diags_file: str, icd_associations_file: str = None,
+                 phecode_map_file: str = None) -> None:
+        self.files = [table_dir, drugs_file, diags_file]
+
+        self.medi = pd.read_csv(os.path.join(table_dir, 'medi_associations.csv'), header=None,
+            names=['rxcui', 'icd_code'], dtype=str).dropna().reset_index(drop=True)
+
+        icd_associations_file = icd_associations_file or os.path.join(table_dir, 'icd_associations.csv')
+        if os.path.exists(icd_associations_file):
+            self.icd_associations = _read_table(icd_associations_file, dtype=str)[['disease1', 'disease2']].dropna()
+            self.files.append(icd_associations_file)
+        else:
+            self.icd_associations = pd.DataFrame({'disease1': pd.Series(dtype=str), 'disease2': pd.Series(dtype=str)})
+
+        phecode_map_file = phecode_map_file or os.path.join(table_dir, 'icd_phewas.csv')
+        self.phecode_map = None
+        if os.path.exists(phecode_map_file):
+            self.phecode_map = _read_table(phecode_map_file, dtype=str)[['icd_code', 'phewas_code']].dropna()
+            self.files.append(phecode_map_file)
+
+        self.labels = table_file_labels(table_dir)
+        self.drugs = _visits(drugs_file, 'rx_cui', 'prescription_date')
+        self.diags = _visits(diags_file, 'icd_code', 'diagnosis_date')
+        self.patient_ids = list(dict.fromkeys(self.drugs.explorys_patient_id.tolist() + self.diags.explorys_patient_id.tolist()))
+
+    def identity(self) -> str:
+        return "tables-" + hashlib.md5("|".join(os.path.abspath(file) for file in self.files).encode()).hexdigest()[:8]
+
+    def get_patient_ids(self, limit: int) -> list:
+        return self.patient_ids[:limit]
+
+    def sample_patient_ids(self, count: int, seed: int = None) -> list:
+        return _sample(self.patient_ids, count, seed)
+
+    def get_drugs_bulk(self, patient_ids: list) -> dict:
+        return _group_by_patient(self.drugs[self.drugs.explorys_patient_id.isin(patient_ids)], patient_ids)
+
+    def get_diags_bulk(self, patient_ids: list) -> dict:
+        return _group_by_patient(self.diags[self.diags.explorys_patient_id.isin(patient_ids)], patient_ids)
+
+    def get_medi(self) -> pd.DataFrame:
+        return self.medi.copy()
+
+    def get_icd_associations(self) -> pd.DataFrame:
+        return self.icd_associations.copy()
+
+    def get_feature_patients(self, phewas_code: str) -> list:
+        if self.phecode_map is None:
+            raise FileNotFoundError("no icd_code to phewas_code map, give phecode_map_file")
+        icd_codes = set(self.phecode_map.icd_code[self.phecode_map.phewas_code == phewas_code])
+        return sorted(self.diags.explorys_patient_id[self.diags.icd_code.isin(icd_codes)].unique().tolist())
+
+    def get_labels_bulk(self, nodes: list) -> dict:
+        return {node: self.labels.get(str(node), node) for node in nodes}
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+
+from graph_store import GraphStore
+from make_graph import CompactGraph, EDGE_CHANGE_DTYPE, NODE_CHANGE_DTYPE, TemporalPKG
+
+
+STEP_DTYPE = np.dtype('<i4')    ## step a node or edge appears in
+DATE_DTYPE = np.dtype('<i4')    ## last visit date of a step, days since 1970-01-01
+NO_WINDOW = -1
+TEMPORAL_DTYPE = np.dtype([
+    ('date_offset', '<i8'), ('date_count', '<i4'),
+    ('node_change_offset', '<i8'), ('node_change_count', '<i4'),
+    ('edge_change_offset', '<i8'), ('edge_change_count', '<i4'),
+    ('time_delta', '<i4'), ('window', '<i4'),
+])
+
+
+class TemporalStore(GraphStore):
+    """
+    Append-only store of the TemporalPKG sequences of a cohort in one folder, a GraphStore with the deltas next to it.
+
+    The GraphStore tables hold every node and edge of a sequence with its type, state and lag of the step it appears in,
+    the watermark is the date of the last step.
+
+    node_steps.bin    step of every node, one per node record
+    edge_steps.bin    step of every edge, one per edge record
+    temporal.bin      (date offset, date count, node change offset, count, edge change offset, count, time delta, window) per index record
+    dates.bin         last visit date of every step
+    node_changes.bin  (step, node, node type) per later change of a node type
+    edge_changes.bin  (step, edge, edge type, state, lag) per later change of an edge
+
+    The delta tables are written before the index, a crash never leaves a half-stored sequence.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self._pending_sequences = []
+        self._temporal = None
+
+    @property
+    def temporal(self):
+        """ Memory-mapped (temporal records, node steps, edge steps, dates, node changes, edge changes) """
+        if self._temporal is None:
+            self._temporal = (self._read('temporal.bin', TEMPORAL_DTYPE), self._read('node_steps.bin', STEP_DTYPE),
+                self._read('edge_steps.bin', STEP_DTYPE), self._read('dates.bin', DATE_DTYPE),
+                self._read('node_changes.bin', NODE_CHANGE_DTYPE), self._read('edge_changes.bin', EDGE_CHANGE_DTYPE))
+        return self._temporal
+
+    def _recover(self) -> None:
+        """ Also drop the delta records written after the last index record. """
+        super()._recover()
+        index = self.tables[0]
+        records = self.temporal[0][:len(index)]
+        ends = [('node_steps.bin', STEP_DTYPE, int(index['node_offset'][-1] + index['node_count'][-1]) if len(index) else 0),
+                ('edge_steps.bin', STEP_DTYPE, int(index['edge_offset'][-1] + index['edge_count'][-1]) if len(index) else 0),
+                ('temporal.bin', TEMPORAL_DTYPE, len(records))]
+        for name, dtype, column in [('dates.bin', DATE_DTYPE, 'date'), ('node_changes.bin', NODE_CHANGE_DTYPE, 'node_change'),
+                                    ('edge_changes.bin', EDGE_CHANGE_DTYPE, 'edge_change')]:
+            ends.append((name, dtype, int(records[f'{column}_offset'][-1] + records[f'{column}_count'][-1]) if len(records) else 0))
+        self._temporal = None
+
+        for name, dtype, end in ends:
+            with open(self._file(name), 'ab') as f:
+                f.truncate(end * dtype.itemsize)
+
+    def append(self, patient_id: int, sequence: TemporalPKG) -> None:
+        """ Add a patient sequence, written with the next flush() """
+        first = CompactGraph(sequence.nodes, sequence.node_types, sequence.edges, sequence.edge_types,
+            sequence.edge_states, sequence.edge_lags)
+        super().append(patient_id, first, sequence.dates[-1] if len(sequence) else None)
+        self._pending_sequences.append(sequence)
+
+    def flush(self) -> None:
+        """ Write the pending sequences, the deltas first and the graphs with the index last. """
+        if not self._pending_sequences:
+            return
+        if not self._recovered:
+            self._recover()
+
+        records, _, _, dates, node_changes, edge_changes = self.temporal
+        last = records[-1] if len(records) else None
+        date_offset = int(last['date_offset'] + last['date_count']) if last is not None else 0
+        node_change_offset = int(last['node_change_offset'] + last['node_change_count']) if last is not None else 0
+        edge_change_offset = int(last['edge_change_offset'] + last['edge_change_count']) if last is not None else 0
+
+        temporal_records = []
+        for sequence in self._pending_sequences:
+            temporal_records.append((date_offset, len(sequence.dates), node_change_offset, len(sequence.node_changes),
+                edge_change_offset, len(sequence.edge_changes), sequence.time_delta,
+                NO_WINDOW if sequence.window is None else sequence.window))
+            date_offset += len(sequence.dates)
+            node_change_offset += len(sequence.node_changes)
+            edge_change_offset += len(sequence.edge_changes)
+
+        for name, dtype, values in [
+            ('node_steps.bin', STEP_DTYPE, [sequence.node_steps for sequence in self._pending_sequences]),
+            ('edge_steps.bin', STEP_DTYPE, [sequence.edge_steps for sequence in self._pending_sequences]),
+            ('dates.bin', DATE_DTYPE, [sequence.dates.astype(np.int64) for sequence in self._pending_sequences]),
+            ('node_changes.bin', NODE_CHANGE_DTYPE, [sequence.node_changes for sequence in self._pending_sequences]),
+            ('edge_changes.bin', EDGE_CHANGE_DTYPE, [sequence.edge_changes for sequence in self._pending_sequences]),
+        ]:
+            with open(self._file(name), 'ab') as f:
+                f.write(np.concatenate(values).astype(dtype).tobytes())
+        with open(self._file('temporal.bin'), 'ab') as f:
+            f.write(np.array(temporal_records, dtype=TEMPORAL_DTYPE).tobytes())
+
+        self._pending_sequences = []
+        self._temporal = None
+        super().flush()
+
+    def _sequence(self, position: int) -> TemporalPKG:
+        index = self.tables[0]
+        records, node_steps, edge_steps, dates, node_changes, edge_changes = self.temporal
+        record, temporal = index[position], records[position]
+        slice_of = lambda table, column: np.array(table[temporal[f'{column}_offset']:temporal[f'{column}_offset'] + temporal[f'{column}_count']])
+        return TemporalPKG.from_deltas(
+            slice_of(dates, 'date').astype('datetime64[D]'),
+            self._graph(record),
+            np.array(node_steps[record['node_offset']:record['node_offset'] + record['node_count']]),
+            np.array(edge_steps[record['edge_offset']:record['edge_offset'] + record['edge_count']]),
+            slice_of(node_changes, 'node_change'),
+            slice_of(edge_changes, 'edge_change'),
+            time_delta=int(temporal['time_delta']),
+            window=None if temporal['window'] == NO_WINDOW else int(temporal['window']),
+        )
+
+    def get(self, patient_id: int) -> TemporalPKG:
+        """ Latest stored sequence of one patient """
+        return self._sequence(self._latest_records()[int(patient_id)])
+
+    def __iter__(self):
+        """ Stream (patient_id, TemporalPKG) over all stored records """
+        for position, patient_id in enumerate(self.patient_ids().tolist()):
+            yield patient_id, self._sequence(position)
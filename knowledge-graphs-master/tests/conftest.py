@@ -0,0 +1,42 @@
+import os
+import sys
+
+import matplotlib
+import pandas as pd
+import pytest
+
+# the src modules import each other by bare name, as with PYTHONPATH=src
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+matplotlib.use("Agg")
+
+from associations import AssociationIndex
+
+
+@pytest.fixture
+def associations():
+    """ Literature where X is a drug in medi and a diagnosis with associations of its own """
+    return AssociationIndex(
+        pd.DataFrame({'rxcui': ['D1', 'D1', 'X', 'X', 'D2'], 'icd_code': ['I1', 'X', 'I1', 'I2', 'I2']}),
+        pd.DataFrame({'disease1': ['I1', 'I2'], 'disease2': ['X', 'I1']}),
+    )
+
+
+@pytest.fixture
+def visits():
+    """ Visit table of (code, date) rows, in the columns the graphs are built from """
+    def visits(rows, column):
+        return pd.DataFrame({column: [code for code, _ in rows], 'new_date': pd.to_datetime([date for _, date in rows])})
+    return visits
+
+
+@pytest.fixture
+def signature():
+    """ Node types and (edge, type, state, lag) of a CompactGraph by codes, independent of node ids """
+    def signature(graph):
+        nodes = dict(zip(graph.nodes, graph.node_types.tolist()))
+        edges = {(frozenset((graph.nodes[u], graph.nodes[v])), edge_type, state, lag) for (u, v), edge_type, state, lag
+            in zip(graph.edges.tolist(), graph.edge_types.tolist(), graph.edge_states.tolist(), graph.edge_lags.tolist())}
+        return nodes, edges
+    return signature
@@ -0,0 +1,54 @@
+from collections import Counter
+
+import pandas as pd
+
+from aggregate import EdgeAggregator
+
+
+def _graphs():
+    """ (edges, node colors) of 50 patient graphs, more distinct edges than the first counts buffer holds """
+    graphs = []
+    for patient in range(50):
+        edges = [('A0', 'B0', 'red')] + [(f'A{patient}', f'B{other}', 'blue') for other in range(1, 30)]
+        colors = {node: 'green' for edge in edges for node in edge[:2]}
+        colors['A0'] = 'orange' if patient % 2 else 'green'
+        graphs.append((edges, colors))
+    return graphs
+
+
+def test_resumed_checkpoint_counts_like_one_run(tmp_path):
+    graphs = _graphs()
+    expected = EdgeAggregator()
+    for edges, colors in graphs:
+        expected.add(edges, colors)
+
+    partial = EdgeAggregator()
+    for edges, colors in graphs[:20]:
+        partial.add(edges, colors)
+    partial.save(str(tmp_path / 'checkpoint.pkl'), seed=3)
+    resumed, metadata = EdgeAggregator.load(str(tmp_path / 'checkpoint.pkl'))
+    for edges, colors in graphs[20:]:
+        resumed.add(edges, colors)
+
+    assert metadata == {'seed': 3}
+    assert resumed.processed == len(graphs)
+    pd.testing.assert_frame_equal(resumed.edge_table(), expected.edge_table())
+    pd.testing.assert_frame_equal(resumed.node_table(), expected.node_table())
+    counts = Counter('_'.join(sorted(edge[:2])) for edges, _ in graphs for edge in edges)
+    assert dict(zip(expected.edge_table()['edge'], expected.edge_table()['count'])) == counts
+
+
+def test_patients_added_out_of_sample_order(tmp_path):
+    graphs = _graphs()
+    expected = EdgeAggregator()
+    for edges, colors in graphs:
+        expected.add(edges, colors, weight=2)
+
+    shuffled = EdgeAggregator()
+    for order in reversed(range(len(graphs))):
+        shuffled.add(*graphs[order], weight=2, order=order)
+    in_order = shuffled.in_sample_order()
+
+    assert in_order.processed == expected.processed
+    pd.testing.assert_frame_equal(in_order.edge_table(), expected.edge_table())
+    pd.testing.assert_frame_equal(in_order.node_table(), expected.node_table())
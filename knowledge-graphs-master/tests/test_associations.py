@@ -0,0 +1,18 @@
+import pandas as pd
+
+
+def test_patient_associations_equal_the_table_filters(associations, visits):
+    drugs = visits([('D1', '2020-01-01'), ('Q', '2020-01-02'), ('X', '2020-01-03'), ('D1', '2020-02-01')], 'rx_cui')
+    diags = visits([('I2', '2020-01-01'), ('Z', '2020-01-02'), ('X', '2020-01-03'), ('I1', '2020-01-04')], 'icd_code')
+    lit_drugs, mdas, lit_diagnosis, ddas = associations.patient_associations(drugs, diags)
+
+    # the filters over the whole tables the commands ran for every patient
+    medi, icd = associations.medi_associations, associations.icd_associations
+    unique_icds = pd.concat([icd['disease1'], icd['disease2']]).unique()
+    expected_drugs = drugs[drugs['rx_cui'].isin(medi.rxcui.unique())]
+    expected_diagnosis = diags[diags['icd_code'].isin(medi.icd_code.unique()) | diags['icd_code'].isin(unique_icds)]
+    expected_mdas = medi[medi['rxcui'].isin(expected_drugs.rx_cui.unique()) & medi['icd_code'].isin(expected_diagnosis.icd_code.unique())]
+    expected_ddas = icd[icd['disease1'].isin(expected_diagnosis.icd_code.unique()) & icd['disease2'].isin(expected_diagnosis.icd_code.unique())]
+
+    for found, expected in [(lit_drugs, expected_drugs), (mdas, expected_mdas), (lit_diagnosis, expected_diagnosis), (ddas, expected_ddas)]:
+        pd.testing.assert_frame_equal(found, expected)
@@ -0,0 +1,38 @@
+from collections import Counter
+
+import pandas as pd
+
+from aggregate import EdgeAggregator
+from cohort_matrix import CohortMatrix
+from make_graph import PKG
+
+
+# Z is in no association table
+PATIENTS = {
+    1: ([('D1', '2020-01-10'), ('X', '2020-02-01')], [('I1', '2020-01-20'), ('I2', '2020-03-01')]),
+    2: ([('D2', '2020-01-10'), ('Z', '2020-01-11')], [('X', '2020-01-15'), ('I2', '2020-05-01')]),
+    3: ([('X', '2020-01-10')], [('X', '2020-02-10'), ('I1', '2020-02-11'), ('Z', '2020-02-12')]),
+    4: ([], [('I1', '2020-01-01')]),
+}
+
+
+def test_counts_equal_edge_aggregator(associations, visits):
+    tables = {patient_id: (visits(drug_rows, 'rx_cui'), visits(diag_rows, 'icd_code'))
+        for patient_id, (drug_rows, diag_rows) in PATIENTS.items()}
+    # a sample drawn with replacement counts a patient once per draw, in another order than the patients were added
+    sample = [3, 2, 2, 1, 4, 3, 3]
+
+    expected = EdgeAggregator()
+    for patient_id in sample:
+        drugs, diags = tables[patient_id]
+        graph = PKG(drugs, diags, *associations.patient_associations(drugs, diags), real_associations=False, compact=True).graph
+        expected.add(graph.iter_edges(), graph.node_colors())
+
+    matrix = CohortMatrix(associations)
+    matrix.add_chunk([(patient_id, *tables[patient_id]) for patient_id in PATIENTS])
+    counted = matrix.aggregator(Counter(sample))
+
+    # same rows in the same order, the edgelist of the matrix engine equals that of the patient graphs
+    assert counted.processed == expected.processed
+    pd.testing.assert_frame_equal(counted.edge_table(), expected.edge_table())
+    pd.testing.assert_frame_equal(counted.node_table(), expected.node_table())
@@ -0,0 +1,39 @@
+import psycopg2
+import pytest
+
+from db_functions import DbHelper
+
+
+class _FailingCursor:
+    """ Named cursor whose query fails on the server """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, params=None):
+        raise psycopg2.errors.UndefinedTable('relation does not exist')
+
+
+class _Connection:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def cursor(self, *args, **kwargs):
+        return _FailingCursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_failed_stream_rolls_the_connection_back():
+    db_helper = DbHelper.__new__(DbHelper)    ## no pool, the connection is a stub
+    db_helper.conn = _Connection()
+    with pytest.raises(psycopg2.Error):
+        list(db_helper.iter_data("SELECT * FROM missing;"))
+    assert db_helper.conn.rollbacks == 1
@@ -0,0 +1,40 @@
+from features import FeatureMatrix, graph_features, load_features
+from make_graph import CompactGraph, DDA, DIAG, DRUG, FOUND, MDA
+
+
+def _graph(extra_diag: str) -> CompactGraph:
+    """ D1 - I1 found, I1 - I2 literature, extra_diag without edges """
+    return CompactGraph(['D1', 'I1', 'I2', extra_diag], [DRUG, DIAG, DIAG, DIAG], [(0, 1), (1, 2)], [MDA, DDA], [FOUND, 0])
+
+
+def test_graph_features():
+    assert graph_features(_graph('I3')) == {
+        'drug:D1': 1.0, 'diag:I1': 1.0, 'diag:I2': 1.0, 'diag:I3': 1.0,
+        'degree:D1': 1.0, 'degree:I1': 2.0, 'degree:I2': 1.0, 'found:D1_I1': 1.0,
+        'stat:nodes': 4.0, 'stat:edges': 2.0, 'stat:found_edges': 1.0, 'stat:components': 2.0,
+        'stat:largest_component': 3.0, 'stat:isolates': 1.0, 'stat:max_degree': 2.0,
+    }
+
+
+def test_columns_do_not_depend_on_the_patient_order(tmp_path):
+    rows = [(1, graph_features(_graph('I3'))), (2, graph_features(_graph('I4')))]
+    forward, backward = FeatureMatrix(), FeatureMatrix()
+    forward.add_chunk(rows)
+    backward.add_chunk(rows[::-1])
+    matrix, names = forward.to_csr()
+    reversed_matrix, reversed_names = backward.to_csr()
+
+    assert names == reversed_names == sorted(names)
+    assert (matrix[[1, 0]] != reversed_matrix).nnz == 0
+
+    # a given vocabulary keeps its columns, other features are left out
+    fixed = FeatureMatrix(['stat:nodes', 'diag:I5', 'diag:I3'])
+    fixed.add_chunk([(3, graph_features(_graph('I5')))])
+    fixed_matrix, fixed_names = fixed.to_csr()
+    assert fixed_names == ['stat:nodes', 'diag:I5', 'diag:I3']
+    assert fixed_matrix.toarray().tolist() == [[4.0, 1.0, 0.0]]
+
+    forward.save(str(tmp_path / 'features'))
+    loaded, loaded_names, patient_ids = load_features(str(tmp_path / 'features'))
+    assert loaded_names == names and patient_ids == [1, 2]
+    assert (loaded != matrix).nnz == 0
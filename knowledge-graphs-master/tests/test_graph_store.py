@@ -0,0 +1,40 @@
+import numpy as np
+
+from graph_store import GraphStore
+from make_graph import CompactGraph, DDA, DIAG, DRUG, FOUND, MDA
+
+
+def _graph(extra_diag: str) -> CompactGraph:
+    return CompactGraph(['D1', 'I1', extra_diag], [DRUG, DIAG, DIAG], [(0, 1), (1, 2)], [MDA, DDA], [FOUND, 0])
+
+
+def _assert_same(graph, expected):
+    assert graph.nodes == expected.nodes
+    for name in ['node_types', 'edges', 'edge_types', 'edge_states']:
+        np.testing.assert_array_equal(getattr(graph, name), getattr(expected, name))
+
+
+def test_store_survives_an_interrupted_flush(tmp_path):
+    path = str(tmp_path / 'graph_store')
+    with GraphStore(path) as store:
+        store.append(1, _graph('I2'))
+        store.append(2, _graph('I3'))
+    with GraphStore(path) as store:
+        store.append(1, _graph('I4'))
+
+    # node and edge records and a code written, the index record not
+    with open(tmp_path / 'graph_store' / 'nodes.bin', 'ab') as f:
+        f.write(bytes(10))
+    with open(tmp_path / 'graph_store' / 'vocab.txt', 'a') as f:
+        f.write('I5')
+    with GraphStore(path) as store:
+        store.append(3, _graph('I6'))
+
+    store = GraphStore(path)
+    assert store.patient_ids().tolist() == [1, 2, 1, 3]
+    assert 2 in store and 4 not in store
+    _assert_same(store.get(1), _graph('I4'))
+    _assert_same(store.get(3), _graph('I6'))
+    for (patient_id, graph), expected in zip(store, ['I2', 'I3', 'I4', 'I6']):
+        _assert_same(graph, _graph(expected))
+    assert store.vocab == ['D1', 'I1', 'I2', 'I3', 'I4', 'I6']
@@ -0,0 +1,33 @@
+import numpy as np
+
+from incremental import update_graph, window_start
+from make_graph import PKG
+
+
+WATERMARK = np.datetime64('2020-03-01', 'D')
+
+
+def _updated_and_rebuilt(associations, drugs, diags):
+    """ Graph built up to the watermark and updated with the rest, and the graph built from all visits """
+    before = lambda visits: visits[visits.new_date.values.astype('datetime64[D]') <= WATERMARK]
+    stored = PKG(before(drugs), before(diags), *associations.patient_associations(before(drugs), before(diags)), compact=True).graph
+
+    start = window_start(WATERMARK, 365)
+    window = lambda visits: visits[visits.new_date.values.astype('datetime64[D]') >= start]
+    updated, _ = update_graph(stored, window(drugs), window(diags), WATERMARK, associations)
+    rebuilt = PKG(drugs, diags, *associations.patient_associations(drugs, diags), compact=True).graph
+    return updated, rebuilt
+
+
+def test_drug_newly_diagnosed_gets_its_diagnosis_edges(associations, visits, signature):
+    updated, rebuilt = _updated_and_rebuilt(associations,
+        visits([('X', '2020-01-10'), ('D1', '2020-01-20')], 'rx_cui'),
+        visits([('I1', '2020-02-01'), ('X', '2020-03-20')], 'icd_code'))
+    assert signature(updated) == signature(rebuilt)
+
+
+def test_diagnosis_newly_prescribed_gets_its_drug_edges(associations, visits, signature):
+    updated, rebuilt = _updated_and_rebuilt(associations,
+        visits([('D2', '2020-01-10'), ('X', '2020-04-02')], 'rx_cui'),
+        visits([('X', '2020-01-15'), ('I1', '2020-02-01'), ('I2', '2020-02-03')], 'icd_code'))
+    assert signature(updated) == signature(rebuilt)
@@ -0,0 +1,25 @@
+from labels import LabelResolver
+
+
+class _Names:
+    """ Source of the node names, counts the lookups """
+
+    def __init__(self):
+        self.lookups = 0
+
+    def get_labels_bulk(self, nodes):
+        self.lookups += 1
+        return {node: f"name of {node}" for node in nodes}
+
+
+def test_resolvers_sharing_a_cache_file_keep_each_others_labels(tmp_path):
+    cache_file = str(tmp_path / 'labels.csv')
+    first, second = LabelResolver(_Names(), cache_file=cache_file), LabelResolver(_Names(), cache_file=cache_file)
+    first.labels(['A', 'B'])
+    second.labels(['C'])    ## started before the first saved, does not know A and B
+    first.labels(['D'])
+
+    names = _Names()
+    assert LabelResolver(names, cache_file=cache_file).labels(['A', 'B', 'C', 'D']) == {
+        'A': 'name of A', 'B': 'name of B', 'C': 'name of C', 'D': 'name of D'}
+    assert names.lookups == 0
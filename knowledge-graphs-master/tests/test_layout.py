@@ -0,0 +1,22 @@
+import networkx as nx
+import numpy as np
+
+from layout import LayoutCache, graph_hash
+
+
+def _path(length: int) -> nx.Graph:
+    return nx.path_graph([f"n{i}" for i in range(length)])
+
+
+def test_cache_file_keeps_the_layouts_used_last(tmp_path):
+    cache_file = str(tmp_path / 'layout.pkl')
+    cache = LayoutCache(cache_file, maxsize=2)
+    first = cache.layout(_path(3))
+    cache.layout(_path(4))
+    cache.layout(_path(3))    ## used again, the 4 node graph is used least recently
+    cache.layout(_path(5))
+
+    stored = LayoutCache(cache_file, maxsize=2)
+    assert list(stored.layouts) == [graph_hash(_path(3)), graph_hash(_path(5))]
+    np.testing.assert_equal(stored.layout(_path(3)), first)
+    assert set(stored.positions) == {f"n{i}" for i in range(5)}
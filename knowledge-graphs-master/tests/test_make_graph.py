@@ -0,0 +1,48 @@
+import networkx as nx
+import pandas as pd
+
+from make_graph import CompactGraph, PKG
+
+
+def _patient(visits):
+    """ D1 prescribed 10 days after I1, D2 before and 199 days after I2, I1 and I2 diagnosed 5 days apart, I3 230 days after I2 """
+    drugs = visits([('D1', '2020-01-20'), ('D2', '2020-01-10'), ('D2', '2020-08-01')], 'rx_cui')
+    diags = visits([('I1', '2020-01-10'), ('I2', '2020-01-15'), ('I3', '2020-09-01')], 'icd_code')
+    mdas = pd.DataFrame({'rxcui': ['D1', 'D2'], 'icd_code': ['I1', 'I2']})
+    ddas = pd.DataFrame({'disease1': ['I1', 'I2'], 'disease2': ['I2', 'I3']})
+    return drugs, diags, drugs, mdas, diags, ddas
+
+
+def test_found_edges_have_visits_within_time_delta(visits):
+    pkg = PKG(*_patient(visits))
+
+    assert {frozenset(edge) for edge in pkg.found_mdas} == {frozenset(('D1', 'I1'))}
+    assert pkg.found_ddas == {('I1', 'I2')}
+    assert (pkg.found_drugs, pkg.found_diags) == ({'D1'}, {'I1', 'I2'})
+    assert {frozenset((u, v)) for u, v, state in pkg.graph.edges(data='state') if state == 'found'} == \
+        {frozenset(('D1', 'I1')), frozenset(('I1', 'I2'))}
+
+
+def _pkg(associations, visits, **kwargs):
+    drugs = visits([('D1', '2020-01-20'), ('X', '2020-02-01')], 'rx_cui')
+    diags = visits([('I1', '2020-01-10'), ('I2', '2020-01-15')], 'icd_code')
+    return PKG(drugs, diags, *associations.patient_associations(drugs, diags), **kwargs)
+
+
+def test_graph_is_networkx_unless_compact_is_asked_for(associations, visits):
+    graph = _pkg(associations, visits).graph
+    compact = _pkg(associations, visits, compact=True).graph
+
+    assert isinstance(graph, nx.Graph)
+    assert isinstance(compact, CompactGraph)
+    assert dict(graph.nodes(data='color')) == dict(compact.to_networkx().nodes(data='color'))
+    assert list(graph.edges(data='color')) == list(compact.iter_edges())
+    assert sorted(graph.edges(data='state')) == sorted(compact.to_networkx().edges(data='state'))
+
+
+def test_found_counts_per_window_equal_the_graphs_of_that_time_delta(visits):
+    windows = [3, 10, 90, 365]
+    graph = PKG(*_patient(visits), compact=True).graph
+
+    assert graph.found_counts(windows) == [len(PKG(*_patient(visits), time_delta=days).found_edges) for days in windows]
+    assert graph.found_counts(windows) == [0, 2, 2, 4]
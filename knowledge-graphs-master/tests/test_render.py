@@ -0,0 +1,25 @@
+import render
+from labels import LabelResolver
+from make_graph import CompactGraph, DDA, DIAG, DRUG, FOUND, MDA
+
+
+def _graph(extra_diag: str) -> CompactGraph:
+    """ Small patient graph, the nodes other than extra_diag are shared by every graph """
+    return CompactGraph(['1191', '250.00', '401.9', extra_diag], [DRUG, DIAG, DIAG, DIAG],
+        [(0, 1), (1, 2), (2, 3)], [MDA, DDA, DDA], [FOUND, 0, 0])
+
+
+def _plots(folder, graphs) -> bytes:
+    """ Render the graphs in one process like a PlotRenderer worker, the complete plot of the last one """
+    render._renderer['label_resolver'] = LabelResolver()    ## no source, labels are the codes
+    for patient_id, graph in enumerate(graphs):
+        render._render(patient_id, graph, str(folder))
+    return (folder / f"{len(graphs) - 1}_complete.png").read_bytes()
+
+
+def test_plot_does_not_depend_on_patients_drawn_before(tmp_path):
+    (tmp_path / "alone").mkdir()
+    (tmp_path / "after").mkdir()
+    alone = _plots(tmp_path / "alone", [_graph('272.4')])
+    after = _plots(tmp_path / "after", [_graph('428.0'), _graph('414.01'), _graph('272.4')])
+    assert alone == after
@@ -0,0 +1,31 @@
+import shutil
+
+import pandas as pd
+
+from results_index import ResultsIndex
+
+
+def _write_edgelist(results, phecode, rows):
+    folder = results / f'{phecode}_graph'
+    folder.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(rows, columns=['node1', 'node2', 'count', 'strength', 'color']).to_csv(folder / f'{phecode}_edgelist.csv', index=False)
+
+
+def test_update_drops_deleted_phecodes(tmp_path):
+    results = tmp_path / 'results'
+    _write_edgelist(results, '278', [('I1', 'D1', 5, 0.5, 'blue'), ('I1', 'I2', 3, 0.3, 'red')])
+    _write_edgelist(results, '250.2', [('D1', 'I1', 8, 0.8, 'blue')])
+    index = ResultsIndex(str(tmp_path / 'index'))
+    assert sorted(index.update(str(results))) == ['250.2', '278']
+    assert index.edge('D1', 'I1').phecode.tolist() == ['250.2', '278']
+
+    shutil.rmtree(results / '278_graph')
+    (results / '250.2_graph' / '250.2_edgelist.csv').unlink()
+    index = ResultsIndex(str(tmp_path / 'index'))
+    assert sorted(index.update(str(results))) == ['250.2', '278']
+    assert index.edge('D1', 'I1').empty and index.node('I1').empty and index.phecode('278').empty
+    assert index.update(str(results)) == []
+
+    _write_edgelist(results, '278', [('I1', 'I2', 4, 0.4, 'red')])
+    assert index.update(str(results)) == ['278']
+    assert index.node('I1')[['node1', 'node2', 'phecode', 'count']].values.tolist() == [['I1', 'I2', '278', 4]]
@@ -0,0 +1,56 @@
+import pandas as pd
+
+from file_source import FileSource
+from table_source import TableSource
+
+
+def _write_tables(table_dir):
+    """ Small table dumps in the layout of table_files/ """
+    table_dir.mkdir()
+    for name, rows in [
+        ('medi_associations.csv', ['D1,I1', 'D2,I2']),
+        ('medi_drug_labels.csv', ['D1,drug one', 'D2,drug two']),
+        ('medi_disease_labels.csv', ['ICD10CM,I1,disease one']),
+        ('disgenet_uml_mappings.csv', ['C1,ICD10CM,I2']),
+        ('disgenet_uml_labels.csv', ['C1,disease two']),
+    ]:
+        (table_dir / name).write_text('\n'.join(rows) + '\n')
+    (table_dir / 'icd_associations.csv').write_text('disease1,disease2\nI1,I2\n')
+    (table_dir / 'icd_phewas.csv').write_text('icd_code,phewas_code\nI2,278\n')
+
+
+def test_export_from_table_files(tmp_path):
+    _write_tables(tmp_path / 'tables')
+    pd.DataFrame({'explorys_patient_id': [2, 1, 2], 'rx_cui': ['D1', 'D2', 'D2'],
+                  'prescription_date': ['2020-01-02 10:00', '2020-03-01', '2020-01-01']}).to_csv(tmp_path / 'drugs.csv', index=False)
+    pd.DataFrame({'explorys_patient_id': [1, 3], 'icd_code': ['I2', 'I1'],
+                  'diagnosis_date': ['2020-02-01', '2020-02-03']}).to_csv(tmp_path / 'diagnoses.csv', index=False)
+
+    tables = TableSource(str(tmp_path / 'tables'), str(tmp_path / 'drugs.csv'), str(tmp_path / 'diagnoses.csv'))
+    source = FileSource.export(tables, str(tmp_path / 'data'), tables.get_patient_ids(2), ['278'], num_partitions=2)
+
+    assert source.get_patient_ids(10) == [1, 2]
+    assert source.get_feature_patients('278') == [1]
+    assert source.get_medi().values.tolist() == [['D1', 'I1'], ['D2', 'I2']]
+    assert source.get_icd_associations().values.tolist() == [['I1', 'I2']]
+    assert source.get_labels_bulk(['D1', 'I1', 'I2', 'X']) == {'D1': 'drug one', 'I1': 'disease one', 'I2': 'disease two', 'X': 'X'}
+
+    drugs = source.get_drugs(2)
+    assert drugs.rx_cui.tolist() == ['D2', 'D1']
+    assert pd.to_datetime(drugs.new_date).dt.strftime('%Y-%m-%d').tolist() == ['2020-01-01', '2020-01-02']
+    assert source.get_diags(1).icd_code.tolist() == ['I2']
+
+
+def test_sample_draws_from_all_patients(tmp_path):
+    _write_tables(tmp_path / 'tables')
+    patients = list(range(1, 101))
+    pd.DataFrame({'explorys_patient_id': patients, 'rx_cui': 'D1', 'prescription_date': '2020-01-01'}).to_csv(tmp_path / 'drugs.csv', index=False)
+    pd.DataFrame({'explorys_patient_id': [1], 'icd_code': ['I1'], 'diagnosis_date': ['2020-01-01']}).to_csv(tmp_path / 'diagnoses.csv', index=False)
+    tables = TableSource(str(tmp_path / 'tables'), str(tmp_path / 'drugs.csv'), str(tmp_path / 'diagnoses.csv'))
+    source = FileSource.export(tables, str(tmp_path / 'data'), patients, num_partitions=2)
+
+    sample = source.sample_patient_ids(20, seed=1)
+    assert sample == source.sample_patient_ids(20, seed=1) == tables.sample_patient_ids(20, seed=1)
+    assert len(set(sample)) == 20 and set(sample) <= set(patients)
+    assert max(sample) > 20
+    assert sorted(source.sample_patient_ids(200, seed=1)) == patients
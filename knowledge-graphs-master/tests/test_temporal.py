@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from make_graph import PKG, TemporalPKG
+from temporal_store import TemporalStore
+
+
+# Z is in no association table
+PATIENTS = {
+    # X prescribed first and diagnosed later, its drug-diag edges become diag-diag edges
+    1: ([('X', '2020-01-10'), ('D1', '2020-01-20'), ('D2', '2020-06-01')],
+        [('I1', '2020-02-01'), ('X', '2020-03-20'), ('I2', '2020-03-20'), ('Z', '2020-04-01')]),
+    # lags shrink with later visits, an edge found only after a long gap
+    2: ([('D1', '2020-01-01'), ('D1', '2020-09-01'), ('X', '2020-09-05')],
+        [('I1', '2020-06-01'), ('I1', '2020-09-10'), ('I2', '2021-01-01')]),
+    3: ([], [('I2', '2020-01-01'), ('I1', '2020-01-01')]),
+}
+
+
+@pytest.fixture
+def sequences(associations, visits):
+    """ (patient_id, drugs, diags, TemporalPKG) of every patient, for a window of days """
+    def sequences(window):
+        for patient_id, (drug_rows, diag_rows) in PATIENTS.items():
+            drugs, diags = visits(drug_rows, 'rx_cui'), visits(diag_rows, 'icd_code')
+            yield patient_id, drugs, diags, TemporalPKG(drugs, diags, *associations.patient_associations(drugs, diags), window=window)
+    return sequences
+
+
+@pytest.mark.parametrize('window', [None, 30])
+def test_every_step_equals_pkg_of_its_prefix(window, associations, sequences, signature):
+    for patient_id, drugs, diags, sequence in sequences(window):
+        assert len(sequence) > 1 or patient_id == 3
+        for step, (date, graph) in enumerate(sequence.snapshots()):
+            before = lambda visits: visits[visits.new_date.values.astype('datetime64[D]') <= date]
+            rebuilt = PKG(before(drugs), before(diags), *associations.patient_associations(before(drugs), before(diags)), compact=True).graph
+            assert signature(graph) == signature(rebuilt), (patient_id, step)
+            assert signature(sequence.snapshot(step)) == signature(rebuilt), (patient_id, step)
+
+
+def test_store_returns_the_stored_sequences(tmp_path, sequences, signature):
+    stored_sequences = {patient_id: sequence for patient_id, _, _, sequence in sequences(30)}
+    with TemporalStore(str(tmp_path)) as store:
+        for patient_id, sequence in stored_sequences.items():
+            store.append(patient_id, sequence)
+
+    store = TemporalStore(str(tmp_path))
+    assert [patient_id for patient_id, _ in store] == list(stored_sequences)
+    for patient_id, sequence in stored_sequences.items():
+        stored = store.get(patient_id)
+        assert stored.window == 30
+        assert store.watermark(patient_id) == sequence.dates[-1]
+        np.testing.assert_array_equal(stored.dates, sequence.dates)
+        assert [signature(graph) for _, graph in stored.snapshots()] == [signature(graph) for _, graph in sequence.snapshots()]